@@ -1,6 +1,10 @@
 import datetime
 import logging
 
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+
 from mapreduce import control
 from mapreduce import operation as op
 
@@ -8,93 +12,123 @@ import request_handler
 import models
 import consts
 import points
-
-class ActivitySummaryExerciseItem:
-    def __init__(self):
-        self.c_problems = 0
-        self.c_correct = 0
-        self.time_taken = 0
-        self.points_earned = 0
-        self.exercise = None
-
-class ActivitySummaryVideoItem:
-    def __init__(self):
-        self.seconds_watched = 0
-        self.points_earned = 0
-        self.playlist_titles = None
-        self.video_title = None
-
-class DailyActivitySummary:
-
-    def __init__(self):
-        self.user = None
-        self.date = None
-        self.hourly_summaries = {}
-
-    def has_activity(self):
-        return len(self.hourly_summaries) > 0
-
-    @staticmethod
-    def build(user, date, problem_logs, video_logs):
+from daily_activity_summary import start_of_day, DailyActivitySummary, HourlyActivitySummary, ActivitySummaryExerciseItem, ActivitySummaryVideoItem
+
+# DailyActivityLogs are rolled up incrementally.
+#
+# LogVideoProgress adds each VideoLog, and problem_log_queue each ProblemLog,
+# to a per-user, per-day DailyActivitySummary held in memcache as they're logged.
+# Twice a day CompactDailyActivityLogs visits only the users who've been
+# active since the last compaction and writes a DailyActivityLog for each
+# finished day, straight from that day's bucket when the bucket saw all of
+# the day's activity and from the day's logs when it didn't (evicted, or
+# created after the user's first action of the day). The DailyActivityLog
+# mapreduce is kept around as a backstop for users the compaction misses.
+#
+# Buckets are updated with a plain get and set, so two requests for the same
+# user racing each other can lose one's delta. Every delta also increments a
+# counter next to the bucket, and a bucket whose count doesn't match the
+# counter is never trusted.
+
+DELTAS_SECONDS = 60 * 60 * 24 * 3
+DELTAS_KEY_FORMAT = "daily_activity_deltas_%s_%s"
+DELTAS_COUNT_KEY_FORMAT = "daily_activity_deltas_count_%s_%s"
+
+COMPACTION_URL = "/admin/compactdailyactivitylogs"
+COMPACTION_BATCH_SIZE = 50
+COMPACTION_MAX_DAYS = 30
+
+def get_deltas_keys(user, date):
+    key_args = (user.email(), date.strftime("%Y-%m-%d"))
+    return (DELTAS_KEY_FORMAT % key_args, DELTAS_COUNT_KEY_FORMAT % key_args)
+
+def add_problem_log_delta(problem_log, dt_last_activity):
+    dt = problem_log.time_done
+    add_delta(problem_log.user, dt, dt_last_activity, lambda summary: summary.get_hourly_summary(dt.hour).add_problem_log(problem_log))
+
+def add_video_log_delta(video_log, dt_last_activity):
+    dt = video_log.time_watched
+    add_delta(video_log.user, dt, dt_last_activity, lambda summary: summary.get_hourly_summary(dt.hour).add_video_log(video_log))
+
+# Makes sure the buckets of dates aren't trusted, for deltas that were lost before they could be added
+def invalidate_deltas(user, dates):
+    for date in dates:
+        key, count_key = get_deltas_keys(user, start_of_day(date))
+        memcache.incr(count_key)
+
+# dt_last_activity is the user's last_activity from before this action
+def add_delta(user, dt, dt_last_activity, fxn_add):
+    date = start_of_day(dt)
+    key, count_key = get_deltas_keys(user, date)
+
+    memcache.add(count_key, 0, time=DELTAS_SECONDS)
+    c_deltas = memcache.incr(count_key)
+    if c_deltas is None:
+        return
+
+    bucket = memcache.get(key)
+    if bucket is None:
         summary = DailyActivitySummary()
         summary.user = user
+        summary.date = date
 
-        # Chop off hours, minutes, and seconds
-        summary.date = datetime.datetime(date.year, date.month, date.day)
-
-        date_next = date + datetime.timedelta(days=1)
-        problem_logs_filtered = filter(lambda problem_log: date <= problem_log.time_done < date_next, problem_logs)
-        video_logs_filtered = filter(lambda video_log: date <= video_log.time_watched < date_next, video_logs)
-
-        for problem_log in problem_logs_filtered:
-            hour = problem_log.time_done.hour
-            if not summary.hourly_summaries.has_key(hour):
-                summary.hourly_summaries[hour] = HourlyActivitySummary(summary.date, hour)
-            summary.hourly_summaries[hour].add_problem_log(problem_log)
-
-        for video_log in video_logs_filtered:
-            hour = video_log.time_watched.hour
-            if not summary.hourly_summaries.has_key(hour):
-                summary.hourly_summaries[hour] = HourlyActivitySummary(summary.date, hour)
-            summary.hourly_summaries[hour].add_video_log(video_log)
-
-        return summary
+        # A new bucket only has the whole day if this is the user's first action of the day
+        complete = dt_last_activity is None or dt_last_activity < date
+        bucket = (complete, 0, summary)
 
-class HourlyActivitySummary:
+    complete, c_bucket_deltas, summary = bucket
+    fxn_add(summary)
 
-    def __init__(self, date, hour):
-        self.date = datetime.datetime(date.year, date.month, date.day, hour)
-        self.dict_exercises = {}
-        self.dict_videos = {}
+    memcache.set(key, (complete, c_bucket_deltas + 1, summary), time=DELTAS_SECONDS)
 
-    def has_video_activity(self):
-        return len(self.dict_videos) > 0
-
-    def has_exercise_activity(self):
-        return len(self.dict_exercises) > 0
-
-    def add_problem_log(self, problem_log):
-        if not self.dict_exercises.has_key(problem_log.exercise):
-            self.dict_exercises[problem_log.exercise] = ActivitySummaryExerciseItem()
-
-        summary_item = self.dict_exercises[problem_log.exercise]
-        summary_item.time_taken += problem_log.time_taken_capped_for_reporting()
-        summary_item.points_earned += problem_log.points_earned
-        summary_item.c_problems += 1
-        summary_item.exercise = problem_log.exercise
-        if problem_log.correct:
-            summary_item.c_correct += 1
-
-    def add_video_log(self, video_log):
-        video_key = video_log.key_for_video()
-        if not self.dict_videos.has_key(video_key):
-            self.dict_videos[video_key] = ActivitySummaryVideoItem()
+# Returns the DailyActivitySummary of every day from dt_start through dt_end with activity,
+# using complete buckets where possible and a single pass over the logs for the rest
+def get_daily_activity_summaries(user, dt_start, dt_end):
+    dates = []
+    dt = start_of_day(dt_start)
+    while dt <= dt_end:
+        dates.append(dt)
+        dt += datetime.timedelta(days=1)
 
-        summary_item = self.dict_videos[video_key]
-        summary_item.seconds_watched += video_log.seconds_watched
-        summary_item.points_earned += video_log.points_earned
-        summary_item.playlist_titles = video_log.playlist_titles
-        summary_item.video_title = video_log.video_title
+    keys_by_date = {}
+    keys = []
+    for date in dates:
+        keys_by_date[date] = get_deltas_keys(user, date)
+        keys.extend(keys_by_date[date])
+
+    cached = memcache.get_multi(keys)
+
+    summaries = {}
+    dates_missing = []
+    for date in dates:
+        key, count_key = keys_by_date[date]
+        bucket = cached.get(key)
+        if bucket and bucket[0] and bucket[1] == cached.get(count_key):
+            summaries[date] = bucket[2]
+        else:
+            dates_missing.append(date)
+
+    # Only fetch the logs of the days that are missing, one span per run of consecutive days
+    for dt_a, dt_b in get_runs_of_days(dates_missing):
+        problem_logs = models.ProblemLog.get_for_user_between_dts(user, dt_a, dt_b).fetch(100000)
+        video_logs = models.VideoLog.get_for_user_between_dts(user, dt_a, dt_b).fetch(100000)
+
+        summaries_built = DailyActivitySummary.build_many(user, problem_logs, video_logs)
+        for date, summary in summaries_built.iteritems():
+            if dt_a <= date < dt_b:
+                summaries[date] = summary
+
+    return [summaries[date] for date in dates if summaries.has_key(date) and summaries[date].has_activity()]
+
+# Returns (start, end) spans covering the sorted dates, one per run of consecutive days
+def get_runs_of_days(dates):
+    runs = []
+    for date in dates:
+        if runs and runs[-1][1] == date:
+            runs[-1][1] = date + datetime.timedelta(days=1)
+        else:
+            runs.append([date, date + datetime.timedelta(days=1)])
+    return [tuple(run) for run in runs]
 
 def fill_realtime_recent_daily_activity_summaries(daily_activity_logs, user_data, dt_end):
 
@@ -109,25 +143,18 @@ def fill_realtime_recent_daily_activity_summaries(daily_activity_logs, user_data
     if user_data.last_daily_summary:
         dt_start = max(dt_end - datetime.timedelta(days=2), user_data.last_daily_summary)
 
-    problem_logs = models.ProblemLog.get_for_user_between_dts(user_data.user, dt_start, dt_end).fetch(100000)
-    video_logs = models.VideoLog.get_for_user_between_dts(user_data.user, dt_start, dt_end).fetch(100000)
-
     # Chop off hours, minutes, and seconds
-    dt_start = datetime.datetime(dt_start.year, dt_start.month, dt_start.day)
-    dt_end = datetime.datetime(dt_end.year, dt_end.month, dt_end.day)
-
-    dt = dt_start
+    dt_start = start_of_day(dt_start)
+    dt_end = start_of_day(dt_end)
 
-    while dt <= dt_end:
-        summary = DailyActivitySummary.build(user_data.user, dt, problem_logs, video_logs)
-        if summary.has_activity():
-            log = models.DailyActivityLog.build(user_data.user, dt, summary)
-            daily_activity_logs.append(log)
-        dt += datetime.timedelta(days=1)
+    for summary in get_daily_activity_summaries(user_data.user, dt_start, dt_end):
+        daily_activity_logs.append(models.DailyActivityLog.build(user_data.user, summary.date, summary))
 
     return daily_activity_logs
 
-def daily_activity_summary_map(user_data):
+# Returns the DailyActivityLogs and UserData to put to bring user_data's
+# summaries up to date, summarizing at most max_days days
+def compact_daily_activity(user_data, max_days):
 
     # Start summarizing after the last summary
     dt_start = user_data.last_daily_summary or datetime.datetime.min
@@ -146,34 +173,28 @@ def daily_activity_summary_map(user_data):
     dt_start = max(dt_start, dt_end - datetime.timedelta(days=30))
 
     # Chop off hours, minutes, and seconds
-    dt_start = datetime.datetime(dt_start.year, dt_start.month, dt_start.day)
-    dt_end = datetime.datetime(dt_end.year, dt_end.month, dt_end.day)
+    dt_start = start_of_day(dt_start)
+    dt_end = start_of_day(dt_end)
 
     # If at least one day has passed b/w last summary and latest activity
-    if (dt_end - dt_start) >= datetime.timedelta(days=1):
-
-        # Only iterate over 3 days per mapreduce
-        dt_end = min(dt_end, dt_start + datetime.timedelta(days=3))
-
-        dt = dt_start
-        list_entities_to_put = []
+    if (dt_end - dt_start) < datetime.timedelta(days=1):
+        return []
 
-        problem_logs = models.ProblemLog.get_for_user_between_dts(user_data.user, dt_start, dt_end).fetch(100000)
-        video_logs = models.VideoLog.get_for_user_between_dts(user_data.user, dt_start, dt_end).fetch(100000)
+    dt_end = min(dt_end, dt_start + datetime.timedelta(days=max_days))
 
-        while dt <= dt_end:
-            summary = DailyActivitySummary.build(user_data.user, dt, problem_logs, video_logs)
-            if summary.has_activity():
-                log = models.DailyActivityLog.build(user_data.user, dt, summary)
-                list_entities_to_put.append(log)
+    entities = []
+    for summary in get_daily_activity_summaries(user_data.user, dt_start, dt_end):
+        entities.append(models.DailyActivityLog.build(user_data.user, summary.date, summary))
 
-            dt += datetime.timedelta(days=1)
+    user_data.last_daily_summary = dt_end
+    entities.append(user_data)
 
-        user_data.last_daily_summary = dt_end
+    return entities
 
-        for entity in list_entities_to_put:
-            yield op.db.Put(entity)
-        yield op.db.Put(user_data)
+def daily_activity_summary_map(user_data):
+    # Only iterate over 3 days per mapreduce
+    for entity in compact_daily_activity(user_data, 3):
+        yield op.db.Put(entity)
 
 class StartNewDailyActivityLogMapReduce(request_handler.RequestHandler):
     def get(self):
@@ -189,4 +210,49 @@ class StartNewDailyActivityLogMapReduce(request_handler.RequestHandler):
                 shard_count = 64)
         self.response.out.write("OK: " + str(mapreduce_id))
 
+class CompactDailyActivityLogs(request_handler.RequestHandler):
 
+    # Admin-only restriction is handled by /admin/* URL pattern
+    # so this can be called by a cron job.
+    def get(self):
+        # Everyone active before the day of the last compaction has already been summarized
+        dt_since = None
+        last_compaction = models.Setting.last_daily_activity_compaction()
+        if last_compaction:
+            dt_since = datetime.datetime.strptime(last_compaction, "%Y-%m-%d")
+        if dt_since is None:
+            dt_since = start_of_day(datetime.datetime.now() - datetime.timedelta(days=2))
+
+        self.add_task(dt_since, start_of_day(datetime.datetime.now()))
+        self.response.out.write("OK")
+
+    # Called by the task queue, compacts one batch of users and chains the next
+    def post(self):
+        dt_since = self.request_date("since", "%Y-%m-%d")
+        dt_started = self.request_date("started", "%Y-%m-%d")
+        cursor = self.request_string("cursor")
+
+        query = models.UserData.all()
+        query.filter("last_activity >=", dt_since)
+        if cursor:
+            query.with_cursor(cursor)
+
+        user_datas = query.fetch(COMPACTION_BATCH_SIZE)
+
+        entities = []
+        for user_data in user_datas:
+            entities.extend(compact_daily_activity(user_data, COMPACTION_MAX_DAYS))
+        db.put(entities)
+
+        if len(user_datas) == COMPACTION_BATCH_SIZE:
+            self.add_task(dt_since, dt_started, query.cursor())
+        else:
+            models.Setting.last_daily_activity_compaction(dt_started.strftime("%Y-%m-%d"))
+
+    def add_task(self, dt_since, dt_started, cursor=""):
+        params = {
+            "since": dt_since.strftime("%Y-%m-%d"),
+            "started": dt_started.strftime("%Y-%m-%d"),
+            "cursor": cursor,
+        }
+        taskqueue.add(url=COMPACTION_URL, params=params)
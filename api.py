@@ -148,8 +148,11 @@ class ImportUserData(request_handler.RequestHandler):
             user_data.assigned_exercises = user_data_dict['assigned_exercises']
             user_data.need_to_reassess = user_data_dict['need_to_reassess']
             user_data.points = user_data_dict['points']          
+            coaches_changed = set(user_data.coaches) ^ set(user_data_dict['coaches'])
             user_data.coaches = user_data_dict['coaches']
             user_data.put()
+            for coach_email in coaches_changed:
+                UserData.clear_roster_memcache_for(coach_email)
 
             proficient_dates = {}    
             correct_in_a_row = {}
@@ -282,7 +285,7 @@ class JsonApiDict():
             'api_url': "http://www.khanacademy.org/api/playlistvideos?playlist=%s" % (urllib.quote_plus(playlist.title)),
         }
 
-@layer_cache.cache_with_key("json_playlists_%s" % Setting.cached_library_content_date())
+@layer_cache.cache_with_key_fxn(lambda: "json_playlists_%s" % Setting.cached_library_content_date())
 def get_playlists_json():
     return json.dumps(get_playlist_api_dicts(), indent=4)
 
@@ -303,7 +306,7 @@ def get_playlist_videos_json(playlist_title):
 
     return json.dumps(get_playlist_video_api_dicts(playlist, video_key_dict, video_playlist_key_dict), indent=4)
 
-@layer_cache.cache_with_key("json_video_library_%s" % Setting.cached_library_content_date())
+@layer_cache.cache_with_key_fxn(lambda: "json_video_library_%s" % Setting.cached_library_content_date())
 def get_video_library_json_compressed():
     playlist_api_dicts = []
     playlists = get_all_topic_playlists()
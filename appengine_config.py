@@ -1,12 +1,16 @@
-# Uncomment this function to enable AppStats performance recording:
-# http://code.google.com/appengine/docs/python/tools/appstats.html
-#
-# Once enabled, go to http://localhost:8080/_ah/stats/ for detailed perf stats.
-#
-# Do not leave uncommented unless actively profiling, because AppStats logging
-# incurs a slight performance penalty.
-#def webapp_add_wsgi_middleware(app):
-#    from google.appengine.ext.appstats import recording
-#    app = recording.appstats_wsgi_middleware(app)
-#    return app
+def webapp_add_wsgi_middleware(app):
+    # Scope request_cache's memoized values to a single request
+    import request_cache
+    app = request_cache.request_cache_middleware(app)
 
+    # Uncomment the following lines to enable AppStats performance recording:
+    # http://code.google.com/appengine/docs/python/tools/appstats.html
+    #
+    # Once enabled, go to http://localhost:8080/_ah/stats/ for detailed perf stats.
+    #
+    # Do not leave uncommented unless actively profiling, because AppStats logging
+    # incurs a slight performance penalty.
+    #from google.appengine.ext.appstats import recording
+    #app = recording.appstats_wsgi_middleware(app)
+
+    return app
@@ -1,3 +1,7 @@
+import bisect
+import heapq
+import re
+
 from google.appengine.ext import db
 
 import app
@@ -5,16 +9,69 @@ from app import App
 import request_handler
 import consts
 import layer_cache
-from models import Video, Playlist, VideoPlaylist
+from models import Video, Playlist, VideoPlaylist, Setting
 
 from django.utils import simplejson
 import logging
 
 CACHE_EXPIRATION_SECONDS = 60 * 60 * 24 * 3 # Expires after three days
 MAX_RESULTS_PER_TYPE = 10
+CACHE_CONTROL_SECONDS = 60 * 60 # Browsers and proxies can reuse each query's results for an hour
 VIDEO_TITLE_MEMCACHE_KEY = "video_title_dicts"
 PLAYLIST_TITLE_MEMCACHE_KEY = "playlist_title_dicts"
 
+MEMOIZED_QUERY_LENGTH = 2
+
+WORD_START_REGEX = re.compile(r"\b\w", re.UNICODE)
+
+# Every title is indexed at the start of each of its words, as the lowercase rest
+# of the title from there. A query matches a title if it is a prefix of one of
+# those, so "frac" and "adding frac" both match "Adding Fractions".
+#
+# The suffixes are kept in one sorted list, so all of a query's matches are
+# next to each other and are found with a binary search. They're ranked by how
+# far into the title the match starts, then by the title's original order.
+class PrefixIndex(object):
+
+    def __init__(self, title_dicts):
+        self.title_dicts = title_dicts
+
+        entries = []
+        for ix, title_dict in enumerate(title_dicts):
+            title = title_dict["title"].lower()
+            for match in WORD_START_REGEX.finditer(title):
+                position = match.start()
+                entries.append((title[position:], position, ix))
+        entries.sort()
+
+        self.memoized_results = {}
+        self.suffixes = [entry[0] for entry in entries]
+        self.positions = [entry[1] for entry in entries]
+        self.title_indexes = [entry[2] for entry in entries]
+
+    def search(self, query, limit):
+        # Short queries match a large share of the titles, so their results are kept
+        if len(query) <= MEMOIZED_QUERY_LENGTH:
+            key = (query, limit)
+            results = self.memoized_results.get(key)
+            if results is None:
+                results = self.memoized_results[key] = self.search_suffixes(query, limit)
+            return results
+        return self.search_suffixes(query, limit)
+
+    def search_suffixes(self, query, limit):
+        start = bisect.bisect_left(self.suffixes, query)
+        end = bisect.bisect_left(self.suffixes, query + u"\uffff", start)
+
+        # Titles are listed once, at their earliest match
+        dict_positions = {}
+        for position, title_ix in zip(self.positions[start:end], self.title_indexes[start:end]):
+            if position < dict_positions.get(title_ix, position + 1):
+                dict_positions[title_ix] = position
+
+        ranked = heapq.nsmallest(limit, [(position, title_ix) for title_ix, position in dict_positions.iteritems()])
+        return [self.title_dicts[title_ix] for position, title_ix in ranked]
+
 class Autocomplete(request_handler.RequestHandler):
 
     def get(self):
@@ -27,25 +84,26 @@ class Autocomplete(request_handler.RequestHandler):
 
         if query:
 
-            # Instead of using memcache and iterating through all videos and playlists, we could use the "fake prefix match" example at 
+            # Instead of using memcache and searching through all videos and playlists, we could use the "fake prefix match" example at 
             # code.google.com/appengine/docs/python/datastore/queriesandindexes.html to query the GAE datastore directly
-            # for any Video/Playlist titles prefixed by query, but this would A) be less powerful b/c it only matches prefixes
+            # for any Video/Playlist titles prefixed by query, but this would A) only match the start of titles
             # and B) require us to make us to use a title_lowercase DerivedProperty or something similar to avoid case
             # sensitivity issues.
             #
-            # However, memcache fits this solution because it's very quick, full-substring searches are much stronger than
-            # prefix-only, and it's acceptable for this data to rarely and briefly be out-of-date.
+            # However, memcache fits this solution because it's very quick, matching the start of any word is much stronger
+            # than matching only the start of titles, and it's acceptable for this data to rarely and briefly be out-of-date.
 
-            video_results = filter(lambda video_dict: query in video_dict["title"].lower(), video_title_dicts())
-            playlist_results = filter(lambda playlist_dict: query in playlist_dict["title"].lower(), playlist_title_dicts())
+            video_results = video_title_index().search(query, MAX_RESULTS_PER_TYPE)
+            playlist_results = playlist_title_index().search(query, MAX_RESULTS_PER_TYPE)
 
-            video_results = sorted(video_results, key=lambda dict: dict["title"].lower().index(query))[:MAX_RESULTS_PER_TYPE]
-            playlist_results = sorted(playlist_results, key=lambda dict: dict["title"].lower().index(query))[:MAX_RESULTS_PER_TYPE]
+        self.response.headers['Cache-Control'] = 'public, max-age=%s' % CACHE_CONTROL_SECONDS
 
         json = simplejson.dumps({"query": query, "videos": video_results, "playlists": playlist_results}, ensure_ascii=False)
         self.response.out.write(json)
 
-@layer_cache.cache_with_key(VIDEO_TITLE_MEMCACHE_KEY, expiration=CACHE_EXPIRATION_SECONDS)
+@layer_cache.cache_with_key_fxn(
+        lambda: "%s_%s" % (VIDEO_TITLE_MEMCACHE_KEY, Setting.cached_library_content_date()),
+        expiration=CACHE_EXPIRATION_SECONDS)
 def video_title_dicts():
     live_video_dict = {}
     for video_playlist in VideoPlaylist.all().filter('live_association = ', True):
@@ -54,6 +112,22 @@ def video_title_dicts():
     live_videos = filter(lambda video: video.key() in live_video_dict, Video.all())
     return map(lambda video: {"title": video.title, "url": "/video/%s" % video.readable_id}, live_videos)
 
-@layer_cache.cache_with_key(PLAYLIST_TITLE_MEMCACHE_KEY, expiration=CACHE_EXPIRATION_SECONDS)
+@layer_cache.cache_with_key_fxn(
+        lambda: "%s_%s" % (PLAYLIST_TITLE_MEMCACHE_KEY, Setting.cached_library_content_date()),
+        expiration=CACHE_EXPIRATION_SECONDS)
 def playlist_title_dicts():
     return map(lambda playlist: {"title": playlist.title, "url": "/#%s" % playlist.title}, Playlist.all())
+
+@layer_cache.cache_with_key_fxn(
+        lambda: "video_title_index_%s" % Setting.cached_library_content_date(),
+        expiration=CACHE_EXPIRATION_SECONDS,
+        layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def video_title_index():
+    return PrefixIndex(video_title_dicts())
+
+@layer_cache.cache_with_key_fxn(
+        lambda: "playlist_title_index_%s" % Setting.cached_library_content_date(),
+        expiration=CACHE_EXPIRATION_SECONDS,
+        layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def playlist_title_index():
+    return PrefixIndex(playlist_title_dicts())
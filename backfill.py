@@ -1,5 +1,7 @@
 import logging
 
+from google.appengine.ext import db
+
 from mapreduce import control
 from mapreduce import operation as op
 
@@ -13,6 +15,91 @@ def user_exercise_update_map(user_exercise):
         user_exercise.exercise_model = models.Exercise.get_by_name(user_exercise.exercise)
         yield op.db.Put(user_exercise)
 
+# Rekeys legacy UserData entities so UserData.get_for can find them with get_by_key_name.
+# Their UserExercises stay parented to the legacy key until user_exercise_reparent_map
+# moves them, which should be run once this is done.
+def user_data_rekey_map(user_data):
+    if user_data.user is None:
+        return
+
+    key_name = models.UserData.get_key_name(user_data.user)
+    if user_data.key().name() == key_name:
+        return
+
+    user_data_keyed = models.UserData.get_by_key_name(key_name)
+    if user_data_keyed is None or (user_data.points or 0) > (user_data_keyed.points or 0):
+        # Keep whichever duplicate has the most points, just like UserData.get_for's query did
+        values = {}
+        for name in models.UserData.properties():
+            values[name] = getattr(user_data, name)
+        yield op.db.Put(models.UserData(key_name=key_name, **values))
+
+    yield op.db.Delete(user_data)
+
+# Moves UserExercises that aren't keyed by exercise name under their user's rekeyed UserData,
+# so UserData.get_or_insert_exercise finds them with get_by_key_name instead of its 'user =' query.
+# The rekeyed UserData doesn't have to exist yet, its key is all that's needed as a parent.
+def user_exercise_reparent_map(user_exercise):
+    if user_exercise.user is None:
+        return
+
+    parent_key = db.Key.from_path("UserData", models.UserData.get_key_name(user_exercise.user))
+    key = user_exercise.key()
+    if key.parent() == parent_key and key.name() == user_exercise.exercise:
+        return
+
+    user_exercise_keyed = models.UserExercise.get_by_key_name(user_exercise.exercise, parent=parent_key)
+    if user_exercise_keyed is None or (user_exercise.total_done or 0) > (user_exercise_keyed.total_done or 0):
+        # Keep whichever duplicate has the most problems done, just like get_or_insert_exercise's query did
+        values = {}
+        for name in models.UserExercise.properties():
+            values[name] = getattr(user_exercise, name)
+        yield op.db.Put(models.UserExercise(parent=parent_key, key_name=user_exercise.exercise, **values))
+
+    yield op.db.Delete(user_exercise)
+
+    # Cached lists of the user's UserExercises still hold the old key
+    user_exercise.clear_memcache()
+
+# Re-puts DailyActivityLogs so summaries pickled before DailyActivityLog.activity_summary
+# was encoded are rewritten with daily_activity_summary's encoding
+def daily_activity_log_encoding_map(daily_activity_log):
+    if daily_activity_log.activity_summary is not None:
+        yield op.db.Put(daily_activity_log)
+
+class StartNewDailyActivityLogEncodingMapReduce(request_handler.RequestHandler):
+    def get(self):
+        # Admin-only restriction is handled by /admin/* URL pattern
+        mapreduce_id = control.start_map(
+                name = "EncodeDailyActivityLog",
+                handler_spec = "backfill.daily_activity_log_encoding_map",
+                reader_spec = "mapreduce.input_readers.DatastoreInputReader",
+                reader_parameters = {"entity_kind": "models.DailyActivityLog"},
+                shard_count = 64)
+        self.response.out.write("OK: " + str(mapreduce_id))
+
+class StartNewUserDataRekeyMapReduce(request_handler.RequestHandler):
+    def get(self):
+        # Admin-only restriction is handled by /admin/* URL pattern
+        mapreduce_id = control.start_map(
+                name = "RekeyUserData",
+                handler_spec = "backfill.user_data_rekey_map",
+                reader_spec = "mapreduce.input_readers.DatastoreInputReader",
+                reader_parameters = {"entity_kind": "models.UserData"},
+                shard_count = 64)
+        self.response.out.write("OK: " + str(mapreduce_id))
+
+class StartNewUserExerciseReparentMapReduce(request_handler.RequestHandler):
+    def get(self):
+        # Admin-only restriction is handled by /admin/* URL pattern
+        mapreduce_id = control.start_map(
+                name = "ReparentUserExercise",
+                handler_spec = "backfill.user_exercise_reparent_map",
+                reader_spec = "mapreduce.input_readers.DatastoreInputReader",
+                reader_parameters = {"entity_kind": "models.UserExercise"},
+                shard_count = 64)
+        self.response.out.write("OK: " + str(mapreduce_id))
+
 class StartNewBackfillMapReduce(request_handler.RequestHandler):
     def get(self):
         # Admin-only restriction is handled by /admin/* URL pattern
@@ -1,6 +1,7 @@
 from google.appengine.api import memcache
 
 import util
+import models
 import models_badges
 import logging
 
@@ -12,6 +13,20 @@ class BadgeContextType:
     EXERCISE = 1
     PLAYLIST = 2
 
+# Facts are the pieces of user state badges are checked against.
+# Each badge lists the facts its is_satisfied_by depends on in self.facts, and
+# util_badges only checks the badges that depend on a fact that just changed.
+class BadgeFact:
+    USER_EXERCISE = 0 # Streak and problem counts of the UserExercise being worked on
+    PROFICIENCY = 1 # UserData's set of proficient exercises
+    POINTS = 2 # UserData's points
+    PROBLEM_LOGS = 3 # Most recent ProblemLogs in the LastActionCache
+    VIDEO_LOGS = 4 # Most recent VideoLogs in the LastActionCache
+    PLAYLIST_TIME = 5 # Time watched in the UserPlaylist being watched
+    TENURE = 6 # Time since the user joined, checked whenever there's new activity
+
+    ALL = [USER_EXERCISE, PROFICIENCY, POINTS, PROBLEM_LOGS, VIDEO_LOGS, PLAYLIST_TIME, TENURE]
+
 class BadgeCategory:
     # Sorted by astronomical size...
     BRONZE = 0 # Meteorite, "Common"
@@ -55,6 +70,9 @@ class Badge:
         self.name = self.__class__.__name__.lower()
         self.badge_context_type = BadgeContextType.NONE
 
+        # Badges that don't say which facts they depend on are checked after any change
+        self.facts = BadgeFact.ALL
+
         # is_teaser_if_unknown replaces the badge's description with question marks
         # on the "all badges" page if the badge hasn't been achieved yet
         self.is_teaser_if_unknown = False
@@ -134,8 +152,17 @@ class Badge:
     # Overridden by individual badge implementations which each grab various parameters from args and kwargs
     # *args and **kwargs should contain all the data necessary for is_already_owned_by's logic, and implementations of is_already_owned_by
     # should never talk to the datastore or memcache, etc.
+    #
+    # Callers checking many badges should pass badges_owned, a set of user_data.badges, so each check is a set lookup.
     def is_already_owned_by(self, user_data, *args, **kwargs):
-        return self.name in user_data.badges
+        return self.name in Badge.get_badges_owned(user_data, kwargs)
+
+    @staticmethod
+    def get_badges_owned(user_data, kwargs):
+        badges_owned = kwargs.get("badges_owned", None)
+        if badges_owned is None:
+            return user_data.badges or []
+        return badges_owned
 
     # Calculates target_context and target_context_name from data passed in and calls complete_award_to appropriately.
     #
@@ -169,10 +196,16 @@ class Badge:
 
             user_badge.put()
 
+            models_badges.UserBadge.clear_summary_memcache_for(user)
+            models_badges.BadgeCountShard.increment(self.name)
+
         UserBadgeNotifier.push_for_user(user, user_badge)
 
     def frequency(self):
-        return models_badges.UserBadge.count_by_badge_name(self.name)
+        if not models.Setting.badge_counts_reconciled():
+            models_badges.BadgeCountShard.queue_reconciliation()
+            return models_badges.BadgeCountShard.get_fallback_count(self.name)
+        return models_badges.BadgeCountShard.get_counts().get(self.name, 0)
 
 class UserBadgeNotifier:
 
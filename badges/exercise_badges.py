@@ -13,7 +13,7 @@ class ExerciseBadge(Badge):
         if user_exercise is None:
             return False
 
-        return self.name_with_target_context(models.Exercise.to_display_name(user_exercise.exercise)) in user_data.badges
+        return self.name_with_target_context(models.Exercise.to_display_name(user_exercise.exercise)) in Badge.get_badges_owned(user_data, kwargs)
 
     def award_to(self, user, user_data, *args, **kwargs):
         user_exercise = kwargs.get("user_exercise", None)
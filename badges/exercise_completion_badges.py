@@ -1,9 +1,13 @@
 import models
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 
 # All badges awarded for completing some subset of exercises inherit from ExerciseCompletionBadge
 class ExerciseCompletionBadge(Badge):
 
+    def __init__(self):
+        Badge.__init__(self)
+        self.facts = [BadgeFact.PROFICIENCY]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_data = kwargs.get("user_data", None)
         if user_data is None:
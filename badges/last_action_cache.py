@@ -1,45 +1,181 @@
 from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 from google.appengine.datastore import entity_pb
 
-import copy
+import array
+import calendar
+import datetime
+import hashlib
+import struct
+import time
 import logging
 
+import models
+import models_badges
+import request_handler
+
 # LastActionCache stores a highly compressed cache of the most recent actions
-# each individual user has taken. The data is stored in memcache only at the moment
-# for performance reasons. If reliability becomes an issue we can consider persisting this data
-# in the datastore in a background thread.
+# each individual user has taken. It is read from and written to memcache on every action request.
+#
+# Memcache can evict it at any time, so every store() also queues the user for a snapshot.
+# Snapshots are written asynchronously by tasks that run at most every SNAPSHOT_SECONDS per shard
+# of users and save everyone queued since the last run in batched puts of LastActionCacheSnapshot entities.
+# When memcache misses, get_for_user loads the snapshot with a single get, then tries converting
+# a cache stored in the legacy format, and only if neither is there does it rebuild the cache
+# from the user's most recent ProblemLogs and VideoLogs.
 #
 # LastActionCache is used to quickly assess badge completion based on each users' recent actions.
 #
-# LastActionCache explicitly stores only the protobuf versions of each cached action for extremely
-# fast serialization and deserialization of the action cache to and from memcache on every action request.
-# We only take the time to turn each protobuf instance into a real DB model on demand (when needed for badge assessment).
+# LastActionCache only keeps the handful of fields badges look at, one fixed-width array per field
+# (timestamps, time taken, correctness, exercise, seconds watched). Each array is a ring buffer holding
+# the most recent CACHED_ACTIONS_PER_TYPE actions, and the whole cache is stored in memcache as a single
+# string built from the raw bytes of the arrays, so loading and storing it on every action request is cheap
+# and badges read fields directly instead of deserializing full ProblemLog and VideoLog models.
+#
+# Exercise names are interned per user: each problem stores the index of its exercise in self.exercise_names.
+#
+# Actions are indexed from 0 (oldest) to count - 1 (most recent), e.g.
+#
+# c_logs = action_cache.get_problem_log_count()
+# last_correct = action_cache.get_problem_correct(c_logs - 1)
 
 class LastActionCache:
 
     CACHED_ACTIONS_PER_TYPE = 500
 
+    # Bump VERSION whenever the encoding below changes
+    VERSION = 2
+
+    # version, problem count, oldest problem, video count, oldest video,
+    # length of joined exercise names, length of last video key
+    HEADER_FORMAT = "!BHHHHII"
+
     @staticmethod
     def key_for_user(user):
-        return "last_action_cache_%s" % user.email()
+        return LastActionCache.key_for_email(user.email())
+
+    @staticmethod
+    def key_for_email(email):
+        return "last_action_cache_v%s_%s" % (LastActionCache.VERSION, email)
 
     @staticmethod
     def get_for_user(user):
-        action_cache = memcache.get(LastActionCache.key_for_user(user))
+        key = LastActionCache.key_for_user(user)
+
+        action_cache = LastActionCache.decode_or_none(user, memcache.get(key))
+        if action_cache is not None:
+            return action_cache
+
+        snapshot = models_badges.LastActionCacheSnapshot.get_by_key_name(key)
+        if snapshot is not None:
+            action_cache = LastActionCache.decode_or_none(user, snapshot.encoded)
+            if action_cache is not None:
+                memcache.set(key, snapshot.encoded)
+                return action_cache
+
+        action_cache = LastActionCache.convert_legacy_or_none(user)
         if action_cache is None:
+            action_cache = LastActionCache.rebuild_for_user(user)
+        action_cache.store()
+        return action_cache
+
+    # Caches stored before VERSION 2 are a pickled LastActionCache holding the last
+    # ProblemLogs and VideoLogs as encoded protobufs under LEGACY_KEY_FORMAT.
+    # Converting one is a lot cheaper than the two fetches of a rebuild, and
+    # for the first day after deploy most users only have a legacy cache.
+    LEGACY_KEY_FORMAT = "last_action_cache_%s"
+
+    @staticmethod
+    def convert_legacy_or_none(user):
+        legacy_key = LastActionCache.LEGACY_KEY_FORMAT % user.email()
+        try:
+            legacy = memcache.get(legacy_key)
+            if legacy is None:
+                return None
+
             action_cache = LastActionCache(user)
+            for encoded in getattr(legacy, "problem_logs", []):
+                action_cache.push_problem_log(db.model_from_protobuf(entity_pb.EntityProto(encoded)), store=False)
+            for encoded in getattr(legacy, "video_logs", []):
+                action_cache.push_video_log(db.model_from_protobuf(entity_pb.EntityProto(encoded)), store=False)
+        except Exception, e:
+            logging.error("Ignoring unreadable legacy LastActionCache for %s: %s" % (user.email(), e))
+            return None
+
+        memcache.delete(legacy_key)
+        return action_cache
+
+    @staticmethod
+    def decode_or_none(user, encoded):
+        if encoded is None:
+            return None
+        try:
+            return LastActionCache.decode(user, encoded)
+        except (struct.error, ValueError), e:
+            logging.error("Ignoring unreadable LastActionCache for %s: %s" % (user.email(), e))
+            return None
+
+    # Rebuild the cache from the user's most recent logs, one bounded fetch per kind
+    @staticmethod
+    def rebuild_for_user(user):
+        action_cache = LastActionCache(user)
+
+        query = models.ProblemLog.all()
+        query.filter('user =', user)
+        query.order('-time_done')
+        problem_logs = query.fetch(LastActionCache.CACHED_ACTIONS_PER_TYPE)
+
+        query = models.VideoLog.all()
+        query.filter('user =', user)
+        query.order('-time_watched')
+        video_logs = query.fetch(LastActionCache.CACHED_ACTIONS_PER_TYPE)
+
+        problem_logs.reverse()
+        for problem_log in problem_logs:
+            action_cache.push_problem_log(problem_log, store=False)
+
+        video_logs.reverse()
+        for video_log in video_logs:
+            action_cache.push_video_log(video_log, store=False)
+
         return action_cache
 
     def __init__(self, user):
-        self.problem_logs = [] # Protobuf version of problem logs for extremely fast (de)serialization
-        self.problem_log_models = {} # Deserialized problem log models
+        self.problem_time_done = array.array("d") # Seconds since the epoch
+        self.problem_time_taken = array.array("i")
+        self.problem_correct = array.array("b")
+        self.problem_exercise = array.array("H") # Index into self.exercise_names
+        self.problem_start = 0 # Position of the oldest problem once the ring buffer is full
+
+        self.video_time_watched = array.array("d") # Seconds since the epoch
+        self.video_seconds_watched = array.array("i")
+        self.video_start = 0 # Position of the oldest video once the ring buffer is full
+
+        self.exercise_names = []
+        self.exercise_ids = {}
 
-        self.video_logs = [] # Protobuf version of video logs for extremely fast (de)serialization
-        self.video_log_models = {} # Deserialized video log models
+        # Only the most recent video's key is needed, by LogVideoProgress
+        self.last_video_key = ""
 
         self.user = user
 
+    @staticmethod
+    def timestamp_from_datetime(dt):
+        return calendar.timegm(dt.timetuple()) + dt.microsecond / 1000000.0
+
+    @staticmethod
+    def datetime_from_timestamp(timestamp):
+        return datetime.datetime.utcfromtimestamp(timestamp)
+
+    def get_exercise_id(self, exercise_name):
+        exercise_id = self.exercise_ids.get(exercise_name)
+        if exercise_id is None:
+            exercise_id = len(self.exercise_names)
+            self.exercise_names.append(exercise_name)
+            self.exercise_ids[exercise_name] = exercise_id
+        return exercise_id
+
     # Push a new problem log to the cache and return the LastActionCache
     @staticmethod
     def get_cache_and_push_problem_log(user, problem_log):
@@ -47,19 +183,53 @@ class LastActionCache:
         action_cache.push_problem_log(problem_log)
         return action_cache
 
-    # Push a new problem log using protobuf for fast serialization/pickle
-    def push_problem_log(self, problem_log):
-        self.problem_logs.append(db.model_to_protobuf(problem_log).Encode())
-        if len(self.problem_logs) > LastActionCache.CACHED_ACTIONS_PER_TYPE:
-            self.problem_logs = self.problem_logs[-1 * LastActionCache.CACHED_ACTIONS_PER_TYPE:]
+    # Push a new problem log, overwriting the oldest one if the cache is full.
+    # ProblemLogs are saved before they're pushed, so a cache that was just rebuilt
+    # from the datastore may already hold this one, in which case it's skipped.
+    def push_problem_log(self, problem_log, store=True):
+        timestamp = LastActionCache.timestamp_from_datetime(problem_log.time_done)
+        c_problems = len(self.problem_time_done)
+        if c_problems and timestamp <= self.get_problem_timestamp(c_problems - 1):
+            return
+
+        values = (timestamp,
+                  problem_log.time_taken or 0,
+                  bool(problem_log.correct),
+                  self.get_exercise_id(problem_log.exercise))
+        columns = (self.problem_time_done, self.problem_time_taken, self.problem_correct, self.problem_exercise)
+
+        if len(self.problem_time_done) < LastActionCache.CACHED_ACTIONS_PER_TYPE:
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            ix = self.problem_start
+            for column, value in zip(columns, values):
+                column[ix] = value
+            self.problem_start = (ix + 1) % len(self.problem_time_done)
+
+        if store:
+            self.store()
+
+    def get_problem_log_count(self):
+        return len(self.problem_time_done)
+
+    def problem_position(self, ix):
+        return (self.problem_start + ix) % len(self.problem_time_done)
 
-        self.store()
+    def get_problem_timestamp(self, ix):
+        return self.problem_time_done[self.problem_position(ix)]
 
-    # Get a new problem log from the cache via protobuf deserialization
-    def get_problem_log(self, ix):
-        if not self.problem_log_models.has_key(ix):
-            self.problem_log_models[ix] = db.model_from_protobuf(entity_pb.EntityProto(self.problem_logs[ix]))
-        return self.problem_log_models[ix]
+    def get_problem_time_done(self, ix):
+        return LastActionCache.datetime_from_timestamp(self.get_problem_timestamp(ix))
+
+    def get_problem_time_taken(self, ix):
+        return self.problem_time_taken[self.problem_position(ix)]
+
+    def get_problem_correct(self, ix):
+        return bool(self.problem_correct[self.problem_position(ix)])
+
+    def get_problem_exercise(self, ix):
+        return self.exercise_names[self.problem_exercise[self.problem_position(ix)]]
 
     # Push a new video log to the cache and return the LastActionCache
     @staticmethod
@@ -68,30 +238,238 @@ class LastActionCache:
         action_cache.push_video_log(video_log)
         return action_cache
 
-    # Push a new video log to the cache using protobuf for fast serialization/pickle
-    def push_video_log(self, video_log):
-        self.video_logs.append(db.model_to_protobuf(video_log).Encode())
-        if len(self.video_logs) > LastActionCache.CACHED_ACTIONS_PER_TYPE:
-            self.video_logs = self.video_logs[-1 * LastActionCache.CACHED_ACTIONS_PER_TYPE:]
+    # Push a new video log, overwriting the oldest one if the cache is full
+    def push_video_log(self, video_log, store=True):
+        values = (LastActionCache.timestamp_from_datetime(video_log.time_watched),
+                  video_log.seconds_watched or 0)
+        columns = (self.video_time_watched, self.video_seconds_watched)
+
+        if len(self.video_time_watched) < LastActionCache.CACHED_ACTIONS_PER_TYPE:
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            ix = self.video_start
+            for column, value in zip(columns, values):
+                column[ix] = value
+            self.video_start = (ix + 1) % len(self.video_time_watched)
+
+        self.last_video_key = str(video_log.key_for_video())
+
+        if store:
+            self.store()
 
-        self.store()
+    def get_video_log_count(self):
+        return len(self.video_time_watched)
 
-    # Get a new video log from the cache via protobuf deserialization
-    def get_video_log(self, ix):
-        if not self.video_log_models.has_key(ix):
-            self.video_log_models[ix] = db.model_from_protobuf(entity_pb.EntityProto(self.video_logs[ix]))
-        return self.video_log_models[ix]
+    def video_position(self, ix):
+        return (self.video_start + ix) % len(self.video_time_watched)
 
-    def get_last_video_log(self):
-        c = len(self.video_logs)
+    def get_video_timestamp(self, ix):
+        return self.video_time_watched[self.video_position(ix)]
+
+    def get_video_time_watched(self, ix):
+        return LastActionCache.datetime_from_timestamp(self.get_video_timestamp(ix))
+
+    def get_video_seconds_watched(self, ix):
+        return self.video_seconds_watched[self.video_position(ix)]
+
+    def get_last_video_time_watched(self):
+        c = len(self.video_time_watched)
         if c <= 0:
             return None
-        return self.get_video_log(c - 1)
+        return self.get_video_time_watched(c - 1)
+
+    def get_last_video_key(self):
+        return self.last_video_key or None
+
+    def encode(self):
+        exercise_names = "\n".join(self.exercise_names)
+        header = struct.pack(LastActionCache.HEADER_FORMAT,
+                LastActionCache.VERSION,
+                len(self.problem_time_done), self.problem_start,
+                len(self.video_time_watched), self.video_start,
+                len(exercise_names), len(self.last_video_key))
+
+        return "".join([
+            header,
+            self.problem_time_done.tostring(),
+            self.problem_time_taken.tostring(),
+            self.problem_correct.tostring(),
+            self.problem_exercise.tostring(),
+            self.video_time_watched.tostring(),
+            self.video_seconds_watched.tostring(),
+            exercise_names,
+            self.last_video_key,
+            ])
+
+    @staticmethod
+    def decode(user, encoded):
+        header_size = struct.calcsize(LastActionCache.HEADER_FORMAT)
+        (version, c_problems, problem_start, c_videos, video_start, len_exercise_names, len_last_video_key) = \
+                struct.unpack(LastActionCache.HEADER_FORMAT, encoded[:header_size])
+
+        if version != LastActionCache.VERSION:
+            raise ValueError("unknown LastActionCache version %s" % version)
+
+        action_cache = LastActionCache(user)
+        action_cache.problem_start = problem_start
+        action_cache.video_start = video_start
+
+        offset = header_size
+        for column, count in [
+                (action_cache.problem_time_done, c_problems),
+                (action_cache.problem_time_taken, c_problems),
+                (action_cache.problem_correct, c_problems),
+                (action_cache.problem_exercise, c_problems),
+                (action_cache.video_time_watched, c_videos),
+                (action_cache.video_seconds_watched, c_videos),
+                ]:
+            size = count * column.itemsize
+            column.fromstring(encoded[offset:offset + size])
+            offset += size
+
+        exercise_names = encoded[offset:offset + len_exercise_names]
+        offset += len_exercise_names
+        if exercise_names:
+            action_cache.exercise_names = exercise_names.split("\n")
+            for exercise_id, exercise_name in enumerate(action_cache.exercise_names):
+                action_cache.exercise_ids[exercise_name] = exercise_id
+
+        action_cache.last_video_key = encoded[offset:offset + len_last_video_key]
+        offset += len_last_video_key
+
+        if offset != len(encoded):
+            raise ValueError("LastActionCache is %s bytes, expected %s" % (len(encoded), offset))
+
+        return action_cache
 
     def store(self):
-        # Wipe out deserialized models before serialization for speed
-        self.problem_log_models = {}
-        self.video_log_models = {}
+        memcache.set(LastActionCache.key_for_user(self.user), self.encode())
+        queue_snapshot(self.user.email())
+
+SNAPSHOT_URL = "/admin/lastactioncachesnapshots"
+SNAPSHOT_SECONDS = 60
+SNAPSHOT_SHARDS = 16
+SNAPSHOT_BATCH_SIZE = 200
+SNAPSHOT_TASK_SECONDS = 20
+SNAPSHOT_LOCK_SECONDS = 60
+SNAPSHOT_PENDING_SECONDS = 10 * 60
+SNAPSHOT_QUEUE_SECONDS = 60 * 60 * 24
+
+SNAPSHOT_PENDING_KEY_FORMAT = "last_action_cache_snapshot_pending_%s"
+SNAPSHOT_SLOT_KEY_FORMAT = "last_action_cache_snapshot_slot_%s_%s"
+SNAPSHOT_SEQUENCE_KEY_FORMAT = "last_action_cache_snapshot_sequence_%s"
+SNAPSHOT_PROCESSED_KEY_FORMAT = "last_action_cache_snapshot_processed_%s"
+SNAPSHOT_LOCK_KEY_FORMAT = "last_action_cache_snapshot_lock_%s"
+
+# Users are spread over SNAPSHOT_SHARDS queues by a hash of their email, each with
+# its own sequence, lock and tasks, so neither the sequence counter nor a single
+# task writing snapshots limits how many users can be snapshotted.
+def get_snapshot_shard(email):
+    return int(hashlib.md5(email).hexdigest()[:8], 16) % SNAPSHOT_SHARDS
+
+# Queue a user for the next snapshot. Users already waiting for a snapshot are only queued once,
+# so no matter how many actions they take, each snapshot run costs one put per user.
+# The pending flag expires after SNAPSHOT_PENDING_SECONDS, so a user whose slot
+# was evicted from memcache is queued again by their next action.
+def queue_snapshot(email):
+    pending_key = SNAPSHOT_PENDING_KEY_FORMAT % email
+    if not memcache.add(pending_key, True, time=SNAPSHOT_PENDING_SECONDS):
+        return
+
+    shard = get_snapshot_shard(email)
+    sequence_key = SNAPSHOT_SEQUENCE_KEY_FORMAT % shard
+    if memcache.add(sequence_key, 0, time=SNAPSHOT_QUEUE_SECONDS):
+        # The sequence is new, either the shard's first or one that expired and restarted
+        # from 0, so the processed count left behind belongs to the old sequence
+        memcache.delete(SNAPSHOT_PROCESSED_KEY_FORMAT % shard)
+    sequence = memcache.incr(sequence_key)
+    if sequence is None or not memcache.set(SNAPSHOT_SLOT_KEY_FORMAT % (shard, sequence), email, time=SNAPSHOT_QUEUE_SECONDS):
+        memcache.delete(pending_key)
+        return
+
+    # One task per shard and SNAPSHOT_SECONDS window picks up everyone queued in the shard
+    window = int(time.time()) / SNAPSHOT_SECONDS
+    add_snapshot_task(shard, "lastactioncachesnapshots-%s-%s" % (shard, window))
+
+def add_snapshot_task(shard, name=None, countdown=SNAPSHOT_SECONDS):
+    try:
+        taskqueue.add(url=SNAPSHOT_URL, params={"shard": shard}, countdown=countdown, name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # A task for this window has already been added
+        pass
+    except taskqueue.Error, e:
+        logging.error("Failed to add LastActionCache snapshot task: %s" % e)
+
+# Writes the shard's queued snapshots in batches of SNAPSHOT_BATCH_SIZE for up to
+# SNAPSHOT_TASK_SECONDS, and adds a task to carry on right away if users are still waiting.
+# Returns False if another task is already writing the shard's snapshots.
+def write_snapshots(shard):
+    lock_key = SNAPSHOT_LOCK_KEY_FORMAT % shard
+    if not memcache.add(lock_key, True, time=SNAPSHOT_LOCK_SECONDS):
+        return False
+
+    try:
+        sequence_key = SNAPSHOT_SEQUENCE_KEY_FORMAT % shard
+        processed_key = SNAPSHOT_PROCESSED_KEY_FORMAT % shard
+        processed = memcache.get(processed_key) or 0
+        dt_start = time.time()
+
+        while True:
+            sequence = memcache.get(sequence_key) or 0
+            if sequence < processed:
+                # The sequence expired and restarted, either while this task was running
+                # or before a task from the old sequence wrote its processed count
+                processed = 0
+
+            if sequence <= processed:
+                break
+
+            if time.time() - dt_start >= SNAPSHOT_TASK_SECONDS:
+                add_snapshot_task(shard, countdown=0)
+                break
+
+            last = min(sequence, processed + SNAPSHOT_BATCH_SIZE)
+            write_snapshot_batch(shard, processed + 1, last)
+
+            processed = last
+            memcache.set(processed_key, processed, time=SNAPSHOT_QUEUE_SECONDS)
+    finally:
+        memcache.delete(lock_key)
+
+    return True
+
+def write_snapshot_batch(shard, first, last):
+    slot_keys = [SNAPSHOT_SLOT_KEY_FORMAT % (shard, ix) for ix in range(first, last + 1)]
+    emails = set(memcache.get_multi(slot_keys).values())
+
+    c_lost = len(slot_keys) - len(emails)
+    if c_lost > 0:
+        # Evicted slots, or users queued again after their pending flag expired.
+        # Evicted users are queued again by their next action.
+        logging.info("%s LastActionCache snapshot slots missing or repeated in shard %s" % (c_lost, shard))
+
+    # Clear the pending flags before reading the caches so any action
+    # taken from here on queues its user for the next snapshot
+    memcache.delete_multi([SNAPSHOT_PENDING_KEY_FORMAT % email for email in emails])
+
+    keys = [LastActionCache.key_for_email(email) for email in emails]
+    encoded_by_key = memcache.get_multi(keys)
+
+    snapshots = []
+    for key in keys:
+        if key in encoded_by_key:
+            snapshots.append(models_badges.LastActionCacheSnapshot(key_name = key, encoded = db.Blob(encoded_by_key[key])))
+    db.put(snapshots)
+
+    memcache.delete_multi(slot_keys)
 
-        memcache.set(LastActionCache.key_for_user(self.user), self)
+class WriteLastActionCacheSnapshots(request_handler.RequestHandler):
 
+    # Admin-only restriction is handled by /admin/* URL pattern
+    # so this can be called by the task queue.
+    def post(self):
+        shard = self.request_int("shard", default=0)
+        if not write_snapshots(shard):
+            # Another task is busy writing this shard's snapshots, try again once it's done
+            add_snapshot_task(shard)
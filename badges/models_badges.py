@@ -1,7 +1,12 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 
+import logging
+import random
+
 class UserBadge(db.Model):
     user = db.UserProperty()
     date = db.DateTimeProperty(auto_now_add=True)
@@ -33,3 +38,127 @@ class UserBadge(db.Model):
         query.filter('badge_name = ', name)
         return query.count(100000)
 
+    @staticmethod
+    def get_summary_key_for(user):
+        return "user_badge_summary_%s" % user.email()
+
+    # One UserBadge per badge the user owns, most recently achieved first, each with
+    # .count and the .list_context_names / .list_context_names_hidden it was achieved in.
+    # Cached in memcache until the user is awarded a new badge.
+    @staticmethod
+    def get_summary_for(user):
+        key = UserBadge.get_summary_key_for(user)
+        user_badges = memcache.get(key)
+        if user_badges is None:
+            user_badges = []
+            user_badge_last = None
+            for user_badge in UserBadge.get_for(user):
+                if user_badge_last and user_badge_last.badge_name == user_badge.badge_name:
+                    user_badge_last.count += 1
+                    if user_badge_last.count > 1:
+                        user_badge_last.list_context_names_hidden.append(user_badge.target_context_name)
+                    else:
+                        user_badge_last.list_context_names.append(user_badge.target_context_name)
+                else:
+                    user_badge.count = 1
+                    user_badge.list_context_names = [user_badge.target_context_name]
+                    user_badge.list_context_names_hidden = []
+                    user_badges.append(user_badge)
+                    user_badge_last = user_badge
+
+            user_badges.sort(reverse=True, key=lambda user_badge: user_badge.date)
+            memcache.set(key, user_badges)
+        return user_badges
+
+    @staticmethod
+    def clear_summary_memcache_for(user):
+        memcache.delete(UserBadge.get_summary_key_for(user))
+
+# Number of times each badge has been awarded, spread over SHARD_COUNT entities per badge
+# so concurrent awards of a popular badge don't contend on a single entity.
+# Incremented as badges are awarded and periodically reconciled with the UserBadges
+# by util_badges.StartNewBadgeCountMapReduce.
+#
+# The shards only count awards made since they were deployed until the first
+# reconciliation fills them in, so until then Badge.frequency counts UserBadges
+# and calls queue_reconciliation to get that first reconciliation going.
+class BadgeCountShard(db.Model):
+    badge_name = db.StringProperty()
+    count = db.IntegerProperty(default = 0)
+
+    SHARD_COUNT = 10
+    COUNTS_KEY = "badge_counts"
+    COUNTS_EXPIRATION_SECONDS = 60 * 10
+
+    RECONCILE_URL = "/admin/startnewbadgecountmapreduce"
+    RECONCILE_QUEUED_KEY = "badge_counts_reconcile_queued"
+    RECONCILE_QUEUED_SECONDS = 60 * 60 * 6 # Try again if the reconciliation hasn't finished by then
+    FALLBACK_COUNT_KEY_FORMAT = "badge_count_fallback_%s"
+
+    @staticmethod
+    def get_key_name(badge_name, shard):
+        return "%s:%s" % (badge_name, shard)
+
+    @staticmethod
+    def increment(badge_name):
+        key_name = BadgeCountShard.get_key_name(badge_name, random.randint(0, BadgeCountShard.SHARD_COUNT - 1))
+        def txn():
+            shard = BadgeCountShard.get_by_key_name(key_name)
+            if shard is None:
+                shard = BadgeCountShard(key_name = key_name, badge_name = badge_name)
+            shard.count += 1
+            shard.put()
+        db.run_in_transaction(txn)
+
+    # Replace all of a badge's shards with a single total
+    @staticmethod
+    def set_count(badge_name, count):
+        shards = []
+        for shard in range(BadgeCountShard.SHARD_COUNT):
+            shards.append(BadgeCountShard(
+                key_name = BadgeCountShard.get_key_name(badge_name, shard),
+                badge_name = badge_name,
+                count = count if shard == 0 else 0))
+        db.put(shards)
+
+    @staticmethod
+    def queue_reconciliation():
+        if not memcache.add(BadgeCountShard.RECONCILE_QUEUED_KEY, True, time=BadgeCountShard.RECONCILE_QUEUED_SECONDS):
+            return
+        try:
+            taskqueue.add(url=BadgeCountShard.RECONCILE_URL, method="GET")
+        except taskqueue.Error, e:
+            logging.error("Failed to queue badge count reconciliation: %s" % e)
+            memcache.delete(BadgeCountShard.RECONCILE_QUEUED_KEY)
+
+    # The badge's count straight from its UserBadges, for before the shards are reconciled
+    @staticmethod
+    def get_fallback_count(badge_name):
+        key = BadgeCountShard.FALLBACK_COUNT_KEY_FORMAT % badge_name
+        count = memcache.get(key)
+        if count is None:
+            count = UserBadge.count_by_badge_name(badge_name)
+            memcache.set(key, count, time=BadgeCountShard.COUNTS_EXPIRATION_SECONDS)
+        return count
+
+    # Dict of badge name to count for all badges, cached for a few minutes
+    @staticmethod
+    def get_counts(bust_cache = False):
+        counts = None
+        if not bust_cache:
+            counts = memcache.get(BadgeCountShard.COUNTS_KEY)
+
+        if counts is None:
+            counts = {}
+            for shard in BadgeCountShard.all():
+                counts[shard.badge_name] = counts.get(shard.badge_name, 0) + shard.count
+            memcache.set(BadgeCountShard.COUNTS_KEY, counts, time=BadgeCountShard.COUNTS_EXPIRATION_SECONDS)
+
+        return counts
+
+
+# Datastore copy of a LastActionCache's encoded string, keyed by LastActionCache.key_for_email,
+# so an evicted LastActionCache can be reloaded with one get.
+class LastActionCacheSnapshot(db.Model):
+    encoded = db.BlobProperty()
+    dt_updated = db.DateTimeProperty(auto_now = True)
@@ -14,7 +14,7 @@ class PlaylistBadge(Badge):
         if user_playlist is None:
             return False
 
-        return self.name_with_target_context(user_playlist.title) in user_data.badges
+        return self.name_with_target_context(user_playlist.title) in Badge.get_badges_owned(user_data, kwargs)
 
     def award_to(self, user, user_data, *args, **kwargs):
         user_playlist = kwargs.get("user_playlist", None)
@@ -1,11 +1,15 @@
 import util
 
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from playlist_badges import PlaylistBadge
 
 # All badges awarded for watching a specific amount of playlist time inherit from PlaylistTimeBadge
 class PlaylistTimeBadge(PlaylistBadge):
 
+    def __init__(self):
+        PlaylistBadge.__init__(self)
+        self.facts = [BadgeFact.PLAYLIST_TIME]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_playlist = kwargs.get("user_playlist", None)
 
@@ -1,10 +1,14 @@
 import models
 import util
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 
 # All badges awarded for getting a certain number of points inherit from PointBadge
 class PointBadge(Badge):
 
+    def __init__(self):
+        Badge.__init__(self)
+        self.facts = [BadgeFact.POINTS]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_data = kwargs.get("user_data", None)
         if user_data is None:
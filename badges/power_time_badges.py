@@ -3,7 +3,7 @@ import datetime
 import util
 import logging
 
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from exercise_badges import ExerciseBadge
 
 # All badges awarded for watching a specific amount of playlist time *and* 
@@ -11,40 +11,43 @@ from exercise_badges import ExerciseBadge
 # inherit from PowerTimeBadge
 class PowerTimeBadge(Badge):
 
+    def __init__(self):
+        Badge.__init__(self)
+        self.facts = [BadgeFact.PROBLEM_LOGS, BadgeFact.VIDEO_LOGS]
+
     def is_satisfied_by(self, *args, **kwargs):
         action_cache = kwargs.get("action_cache", None)
 
         if action_cache is None:
             return False
 
-        c_problem_logs = len(action_cache.problem_logs)
-        c_video_logs = len(action_cache.video_logs)
+        c_problem_logs = action_cache.get_problem_log_count()
+        c_video_logs = action_cache.get_video_log_count()
 
         if c_video_logs < 1 or c_problem_logs < 1:
             return False
 
-        date_video_end = action_cache.get_video_log(c_video_logs - 1).time_watched
-        date_problem_end = action_cache.get_problem_log(c_problem_logs - 1).time_done
+        # Timestamps are in seconds
+        timestamp_video_end = action_cache.get_video_timestamp(c_video_logs - 1)
+        timestamp_problem_end = action_cache.get_problem_timestamp(c_problem_logs - 1)
 
-        date_end = max(date_video_end, date_problem_end)
-        date_start = date_end - datetime.timedelta(seconds = self.seconds_allotted)
+        timestamp_end = max(timestamp_video_end, timestamp_problem_end)
+        timestamp_start = timestamp_end - self.seconds_allotted
 
         seconds_watched = 0
         for i in range(c_video_logs):
-            video_log = action_cache.get_video_log(c_video_logs - i - 1)
-            if video_log.time_watched < date_start:
+            if action_cache.get_video_timestamp(c_video_logs - i - 1) < timestamp_start:
                 break
-            seconds_watched += video_log.seconds_watched
+            seconds_watched += action_cache.get_video_seconds_watched(c_video_logs - i - 1)
 
         if seconds_watched < self.video_seconds_required:
             return False
 
         problems_correct = 0
         for i in range(c_problem_logs):
-            problem_log = action_cache.get_problem_log(c_problem_logs - i - 1)
-            if problem_log.time_done < date_start:
+            if action_cache.get_problem_timestamp(c_problem_logs - i - 1) < timestamp_start:
                 break
-            if problem_log.correct:
+            if action_cache.get_problem_correct(c_problem_logs - i - 1):
                 problems_correct += 1
 
         if problems_correct < self.problems_required:
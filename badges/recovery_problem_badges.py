@@ -1,10 +1,14 @@
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from exercise_badges import ExerciseBadge
 import logging
 
 # All badges awarded for getting exercise problems correct after having some trouble inherit from RecoveryProblemBadge
 class RecoveryProblemBadge(ExerciseBadge):
 
+    def __init__(self):
+        ExerciseBadge.__init__(self)
+        self.facts = [BadgeFact.PROBLEM_LOGS]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_exercise = kwargs.get("user_exercise", None)
         action_cache = kwargs.get("action_cache", None)
@@ -12,30 +16,28 @@ class RecoveryProblemBadge(ExerciseBadge):
         if user_exercise is None or action_cache is None:
             return False
 
-        c_logs = len(action_cache.problem_logs)
+        c_logs = action_cache.get_problem_log_count()
         if c_logs >= self.problems_wrong_out_of:
 
             # Make sure they got the last problem correct in this exercise
-            last_problem_log = action_cache.get_problem_log(c_logs - 1)
-            if (last_problem_log.exercise != user_exercise.exercise or not last_problem_log.correct):
+            if (action_cache.get_problem_exercise(c_logs - 1) != user_exercise.exercise or not action_cache.get_problem_correct(c_logs - 1)):
                 return False
 
             # Make sure they got the second-to-last problem wrong in this exercise
-            second_last_problem_log = action_cache.get_problem_log(c_logs - 2)
-            if (second_last_problem_log.exercise != user_exercise.exercise or second_last_problem_log.correct):
+            if (action_cache.get_problem_exercise(c_logs - 2) != user_exercise.exercise or action_cache.get_problem_correct(c_logs - 2)):
                 return False
 
             c_wrong = 0
 
             for i in range(self.problems_wrong_out_of):
 
-                problem_log = action_cache.get_problem_log(c_logs - i - 1)
+                ix = c_logs - i - 1
 
                 # Make sure they stick with the same exercise and aren't jumping around
-                if problem_log.exercise != user_exercise.exercise:
+                if action_cache.get_problem_exercise(ix) != user_exercise.exercise:
                     return False
 
-                if not problem_log.correct:
+                if not action_cache.get_problem_correct(ix):
                     c_wrong += 1
 
             return c_wrong >= self.problems_wrong
@@ -1,9 +1,13 @@
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from exercise_badges import ExerciseBadge
 
 # All badges awarded for completing a streak of certain length inherit from StreakBadge
 class StreakBadge(ExerciseBadge):
 
+    def __init__(self):
+        ExerciseBadge.__init__(self)
+        self.facts = [BadgeFact.USER_EXERCISE]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_exercise = kwargs.get("user_exercise", None)
         if user_exercise is None:
@@ -2,12 +2,16 @@ import models
 import datetime
 import util
 import logging
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 
 # All badges awarded for completing being a member of the Khan Academy for various periods of time
 # from TenureBadge
 class TenureBadge(Badge):
 
+    def __init__(self):
+        Badge.__init__(self)
+        self.facts = [BadgeFact.TENURE]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_data = kwargs.get("user_data", None)
         action_cache = kwargs.get("action_cache", None)
@@ -19,17 +23,15 @@ class TenureBadge(Badge):
             return False
 
         # Make sure they've seen recent activity of any sort in the past 30 days
-        c_problem_logs = len(action_cache.problem_logs)
-        c_video_logs = len(action_cache.video_logs)
+        c_problem_logs = action_cache.get_problem_log_count()
+        c_video_logs = action_cache.get_video_log_count()
 
         if c_problem_logs > 0:
-            problem_log = action_cache.get_problem_log(c_problem_logs - 1)
-            if util.seconds_since(problem_log.time_done) < 60 * 60 * 24 * 30:
+            if util.seconds_since(action_cache.get_problem_time_done(c_problem_logs - 1)) < 60 * 60 * 24 * 30:
                 return True
 
         if c_video_logs > 0:
-            video_log = action_cache.get_video_log(c_video_logs - 1)
-            if util.seconds_since(video_log.time_watched) < 60 * 60 * 24 * 30:
+            if util.seconds_since(action_cache.get_video_time_watched(c_video_logs - 1)) < 60 * 60 * 24 * 30:
                 return True
 
         return False
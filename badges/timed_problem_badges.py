@@ -1,4 +1,4 @@
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from exercise_badges import ExerciseBadge
 import logging
 
@@ -6,6 +6,10 @@ import logging
 # within a specific amount of time inherit from TimedProblemBadge
 class TimedProblemBadge(ExerciseBadge):
 
+    def __init__(self):
+        ExerciseBadge.__init__(self)
+        self.facts = [BadgeFact.PROBLEM_LOGS]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_exercise = kwargs.get("user_exercise", None)
         action_cache = kwargs.get("action_cache", None)
@@ -13,7 +17,7 @@ class TimedProblemBadge(ExerciseBadge):
         if user_exercise is None or action_cache is None:
             return False
 
-        c_logs = len(action_cache.problem_logs)
+        c_logs = action_cache.get_problem_log_count()
         if c_logs >= self.problems_required:
 
             time_taken = 0
@@ -21,10 +25,10 @@ class TimedProblemBadge(ExerciseBadge):
 
             for i in range(self.problems_required):
 
-                problem = action_cache.get_problem_log(c_logs - i - 1)
-                time_taken += problem.time_taken
+                ix = c_logs - i - 1
+                time_taken += action_cache.get_problem_time_taken(ix)
 
-                if time_taken > time_allotted or not problem.correct or problem.exercise != user_exercise.exercise:
+                if time_taken > time_allotted or not action_cache.get_problem_correct(ix) or action_cache.get_problem_exercise(ix) != user_exercise.exercise:
                     return False
 
             return time_taken <= time_allotted
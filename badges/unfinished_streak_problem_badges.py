@@ -1,4 +1,4 @@
-from badges import Badge, BadgeContextType, BadgeCategory
+from badges import Badge, BadgeContextType, BadgeCategory, BadgeFact
 from exercise_badges import ExerciseBadge
 import logging
 
@@ -6,6 +6,10 @@ import logging
 # being answered correctly inherit from UnfinishedStreakProblemBadge
 class UnfinishedStreakProblemBadge(ExerciseBadge):
 
+    def __init__(self):
+        ExerciseBadge.__init__(self)
+        self.facts = [BadgeFact.USER_EXERCISE, BadgeFact.PROFICIENCY, BadgeFact.PROBLEM_LOGS]
+
     def is_satisfied_by(self, *args, **kwargs):
         user_data = kwargs.get("user_data", None)
         user_exercise = kwargs.get("user_exercise", None)
@@ -22,15 +26,14 @@ class UnfinishedStreakProblemBadge(ExerciseBadge):
         if user_data.is_proficient_at(user_exercise.exercise):
             return False
 
-        c_logs = len(action_cache.problem_logs)
+        c_logs = action_cache.get_problem_log_count()
 
         # We need a history of at least 10 problem_logs in the action cache
         if c_logs < 10:
             return False
 
         # Make sure the last problem is from this exercise and that they got it right
-        last_problem_log = action_cache.get_problem_log(c_logs - 1)
-        if (last_problem_log.exercise != user_exercise.exercise or not last_problem_log.correct):
+        if (action_cache.get_problem_exercise(c_logs - 1) != user_exercise.exercise or not action_cache.get_problem_correct(c_logs - 1)):
             return False
 
         c_correct = 0
@@ -41,11 +44,11 @@ class UnfinishedStreakProblemBadge(ExerciseBadge):
         # and gotten at least 75% correct but haven't managed to put together a streak, give 'em the badge.
         for i in range(c_logs_examined):
 
-            problem_log = action_cache.get_problem_log(c_logs - i - 1)
+            ix = c_logs - i - 1
 
-            if problem_log.exercise == user_exercise.exercise:
+            if action_cache.get_problem_exercise(ix) == user_exercise.exercise:
                 c_total += 1
-                if problem_log.correct:
+                if action_cache.get_problem_correct(ix):
                     c_correct += 1
 
         # Make sure they've done at least 10 problems in this exercise out of their last 50
@@ -1,6 +1,8 @@
 from google.appengine.api import users
 from mapreduce import control
 from mapreduce import operation as op
+from mapreduce import model
+import datetime
 import sys
 
 import util
@@ -106,8 +108,39 @@ def all_badges_dict():
         dict_badges[badge.name] = badge
     return dict_badges
 
+@layer_cache.cache_with_key("badges_by_context_type", layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def badges_by_context_type():
+    dict_badges = {}
+    for badge in all_badges():
+        dict_badges.setdefault(badge.badge_context_type, []).append(badge)
+    return dict_badges
+
+# Index of which badges depend on each fact, by context type
+@layer_cache.cache_with_key("badges_by_context_type_and_fact", layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def badges_by_context_type_and_fact():
+    dict_badges = {}
+    for badge in all_badges():
+        for fact in badge.facts:
+            dict_badges.setdefault((badge.badge_context_type, fact), []).append(badge)
+    return dict_badges
+
 def badges_with_context_type(badge_context_type):
-    return filter(lambda badge: badge.badge_context_type == badge_context_type, all_badges())
+    return badges_by_context_type().get(badge_context_type, [])
+
+# Badges of badge_context_type that depend on any of facts_changed, in all_badges order.
+# If facts_changed is None every badge of badge_context_type is returned.
+def badges_with_context_type_and_facts(badge_context_type, facts_changed):
+    if facts_changed is None:
+        return badges_with_context_type(badge_context_type)
+
+    index = badges_by_context_type_and_fact()
+
+    names = set()
+    for fact in facts_changed:
+        for badge in index.get((badge_context_type, fact), []):
+            names.add(badge.name)
+
+    return [badge for badge in badges_with_context_type(badge_context_type) if badge.name in names]
 
 def get_badge_counts(user_data):
 
@@ -131,57 +164,45 @@ def get_user_badges(user = None):
     user_badges_dict = {}
 
     if user:
-        user_badges = models_badges.UserBadge.get_for(user)
         badges_dict = all_badges_dict()
-        user_badge_last = None
-        for user_badge in user_badges:
-            if user_badge_last and user_badge_last.badge_name == user_badge.badge_name:
-                user_badge_last.count += 1
-                if user_badge_last.count > 1:
-                    user_badge_last.list_context_names_hidden.append(user_badge.target_context_name)
-                else:
-                    user_badge_last.list_context_names.append(user_badge.target_context_name)
-            else:
-                user_badge.badge = badges_dict.get(user_badge.badge_name)
-                user_badge.count = 1
-                user_badge.list_context_names = [user_badge.target_context_name]
-                user_badge.list_context_names_hidden = []
-                user_badge_last = user_badge
-                user_badges_dict[user_badge.badge_name] = True
-
-    possible_badges = all_badges()
+        for user_badge in models_badges.UserBadge.get_summary_for(user):
+            user_badge.badge = badges_dict.get(user_badge.badge_name)
+            if user_badge.badge is not None:
+                user_badges.append(user_badge)
+            user_badges_dict[user_badge.badge_name] = True
+
+    possible_badges = all_badges_sorted_by_category()
     for badge in possible_badges:
         badge.is_owned = user_badges_dict.has_key(badge.name)
 
-    user_badges = sorted(filter(lambda user_badge: hasattr(user_badge, "badge") and user_badge.badge is not None, user_badges), reverse=True, key=lambda user_badge:user_badge.date)
-    possible_badges = sorted(possible_badges, key=lambda badge:badge.badge_category)
+    user_badges_by_category = {}
+    for user_badge in user_badges:
+        user_badges_by_category.setdefault(user_badge.badge.badge_category, []).append(user_badge)
 
     user_badges_normal = filter(lambda user_badge: user_badge.badge.badge_category != badges.BadgeCategory.MASTER, user_badges)
-    user_badges_master = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.MASTER, user_badges)
-    user_badges_diamond = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.DIAMOND, user_badges)
-    user_badges_platinum = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.PLATINUM, user_badges)
-    user_badges_gold = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.GOLD, user_badges)
-    user_badges_silver = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.SILVER, user_badges)
-    user_badges_bronze = filter(lambda user_badge: user_badge.badge.badge_category == badges.BadgeCategory.BRONZE, user_badges)    
-
-    bronze_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.BRONZE, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    silver_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.SILVER, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    gold_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.GOLD, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    platinum_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.PLATINUM, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    diamond_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.DIAMOND, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    master_badges = sorted(filter(lambda badge:badge.badge_category == badges.BadgeCategory.MASTER, possible_badges), key=lambda badge:badge.points or sys.maxint)
-    
     
     return { 'possible_badges': possible_badges, 
              'user_badges': user_badges, 
              'user_badges_normal': user_badges_normal, 
-             'user_badges_master': user_badges_master,
-             "badge_collections": [bronze_badges, silver_badges, gold_badges, platinum_badges, diamond_badges, master_badges],
-             'bronze_badges': user_badges_bronze,
-             'silver_badges': user_badges_silver,
-             'gold_badges': user_badges_gold,
-             'platinum_badges': user_badges_platinum,
-             'diamond_badges': user_badges_diamond, }
+             'user_badges_master': user_badges_by_category.get(badges.BadgeCategory.MASTER, []),
+             "badge_collections": badge_collections(),
+             'bronze_badges': user_badges_by_category.get(badges.BadgeCategory.BRONZE, []),
+             'silver_badges': user_badges_by_category.get(badges.BadgeCategory.SILVER, []),
+             'gold_badges': user_badges_by_category.get(badges.BadgeCategory.GOLD, []),
+             'platinum_badges': user_badges_by_category.get(badges.BadgeCategory.PLATINUM, []),
+             'diamond_badges': user_badges_by_category.get(badges.BadgeCategory.DIAMOND, []), }
+
+@layer_cache.cache_with_key("all_badges_sorted_by_category", layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def all_badges_sorted_by_category():
+    return sorted(all_badges(), key=lambda badge:badge.badge_category)
+
+# All badges of each category from bronze to master, cheapest first
+@layer_cache.cache_with_key("badge_collections", layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY)
+def badge_collections():
+    collections = []
+    for category in [badges.BadgeCategory.BRONZE, badges.BadgeCategory.SILVER, badges.BadgeCategory.GOLD, badges.BadgeCategory.PLATINUM, badges.BadgeCategory.DIAMOND, badges.BadgeCategory.MASTER]:
+        collections.append(sorted(filter(lambda badge:badge.badge_category == category, all_badges()), key=lambda badge:badge.points or sys.maxint))
+    return collections
 
 class ViewBadges(request_handler.RequestHandler):
 
@@ -217,6 +238,45 @@ class StartNewBadgeMapReduce(request_handler.RequestHandler):
 
         self.response.out.write("OK: " + str(mapreduce_id))
 
+# /admin/startnewbadgecountmapreduce is called periodically by a cron job
+class StartNewBadgeCountMapReduce(request_handler.RequestHandler):
+
+    def get(self):
+
+        # Admin-only restriction is handled by /admin/* URL pattern
+        # so this can be called by a cron job.
+
+        # Count every UserBadge, then reset the BadgeCountShards from the totals once done
+        mapreduce_id = control.start_map(
+                name = "ReconcileBadgeCounts",
+                handler_spec = "badges.util_badges.badge_count_map",
+                reader_spec = "mapreduce.input_readers.DatastoreInputReader",
+                reader_parameters = {"entity_kind": "badges.models_badges.UserBadge"},
+                mapreduce_parameters = {"done_callback": "/admin/reconcilebadgecounts"})
+
+        self.response.out.write("OK: " + str(mapreduce_id))
+
+BADGE_COUNT_COUNTER_FORMAT = "badge_count_%s"
+
+# badge_count_map is called by a background MapReduce task for each UserBadge
+def badge_count_map(user_badge):
+    yield op.counters.Increment(BADGE_COUNT_COUNTER_FORMAT % user_badge.badge_name)
+
+# Called by the task queue when the ReconcileBadgeCounts mapreduce is done
+class ReconcileBadgeCounts(request_handler.RequestHandler):
+
+    def post(self):
+        mapreduce_state = model.MapreduceState.get_by_job_id(self.request.headers.get("Mapreduce-Id"))
+        if mapreduce_state is None or mapreduce_state.result_status != model.MapreduceState.RESULT_SUCCESS:
+            logging.error("Not reconciling badge counts after unsuccessful mapreduce")
+            return
+
+        for badge in all_badges():
+            models_badges.BadgeCountShard.set_count(badge.name, mapreduce_state.counters_map.get(BADGE_COUNT_COUNTER_FORMAT % badge.name))
+
+        models_badges.BadgeCountShard.get_counts(bust_cache=True)
+        models.Setting.badge_counts_reconciled(datetime.datetime.now())
+
 # badge_update_map is called by a background MapReduce task.
 # Each call updates the badges for a single user.
 def badge_update_map(user_data):
@@ -241,53 +301,75 @@ def badge_update_map(user_data):
     if awarded:
         yield op.db.Put(user_data)
 
+# The update_with_* functions take an optional list of badges.BadgeFact values that changed
+# since badges were last checked and only check badges that depend on them.
+# Leaving facts_changed as None checks every badge, which is what the badge mapreduce does.
+#
+# Awarding a badge can award points, so once anything is awarded BadgeFact.POINTS
+# is treated as changed for the no-context badges checked afterwards.
+
 # Award this user any earned no-context badges.
-def update_with_no_context(user, user_data, action_cache = None):
-    possible_badges = badges_with_context_type(badges.BadgeContextType.NONE)
+def update_with_no_context(user, user_data, action_cache = None, facts_changed = None, badges_owned = None):
+    possible_badges = badges_with_context_type_and_facts(badges.BadgeContextType.NONE, facts_changed)
     action_cache = action_cache or last_action_cache.LastActionCache.get_for_user(user)
 
+    if badges_owned is None:
+        badges_owned = set(user_data.badges or [])
+
     awarded = False
     for badge in possible_badges:
-        if not badge.is_already_owned_by(user_data=user_data):
+        if not badge.is_already_owned_by(user_data=user_data, badges_owned=badges_owned):
             if badge.is_satisfied_by(user_data=user_data, action_cache=action_cache):
                 badge.award_to(user=user, user_data=user_data)
+                badges_owned.update(user_data.badges)
                 awarded = True
 
     return awarded
 
 # Award this user any earned Exercise-context badges for the provided UserExercise.
-def update_with_user_exercise(user, user_data, user_exercise, include_other_badges = False, action_cache = None):
-    possible_badges = badges_with_context_type(badges.BadgeContextType.EXERCISE)
+def update_with_user_exercise(user, user_data, user_exercise, include_other_badges = False, action_cache = None, facts_changed = None):
+    possible_badges = badges_with_context_type_and_facts(badges.BadgeContextType.EXERCISE, facts_changed)
     action_cache = action_cache or last_action_cache.LastActionCache.get_for_user(user)
 
+    badges_owned = set(user_data.badges or [])
+
     awarded = False
     for badge in possible_badges:
         # Pass in pre-retrieved user_exercise data so each badge check doesn't have to talk to the datastore
-        if not badge.is_already_owned_by(user_data=user_data, user_exercise=user_exercise):
+        if not badge.is_already_owned_by(user_data=user_data, user_exercise=user_exercise, badges_owned=badges_owned):
             if badge.is_satisfied_by(user_data=user_data, user_exercise=user_exercise, action_cache=action_cache):
                 badge.award_to(user=user, user_data=user_data, user_exercise=user_exercise)
+                badges_owned.update(user_data.badges)
                 awarded = True
 
     if include_other_badges:
-        awarded = update_with_no_context(user, user_data, action_cache=action_cache) or awarded
+        awarded = update_with_no_context(user, user_data, action_cache=action_cache, facts_changed=facts_changed_after_awards(facts_changed, awarded), badges_owned=badges_owned) or awarded
 
     return awarded
 
 # Award this user any earned Playlist-context badges for the provided UserPlaylist.
-def update_with_user_playlist(user, user_data, user_playlist, include_other_badges = False, action_cache = None):
-    possible_badges = badges_with_context_type(badges.BadgeContextType.PLAYLIST)
+def update_with_user_playlist(user, user_data, user_playlist, include_other_badges = False, action_cache = None, facts_changed = None):
+    possible_badges = badges_with_context_type_and_facts(badges.BadgeContextType.PLAYLIST, facts_changed)
     action_cache = action_cache or last_action_cache.LastActionCache.get_for_user(user)
+
+    badges_owned = set(user_data.badges or [])
     
     awarded = False
     for badge in possible_badges:
         # Pass in pre-retrieved user_playlist data so each badge check doesn't have to talk to the datastore
-        if not badge.is_already_owned_by(user_data=user_data, user_playlist=user_playlist):
+        if not badge.is_already_owned_by(user_data=user_data, user_playlist=user_playlist, badges_owned=badges_owned):
             if badge.is_satisfied_by(user_data=user_data, user_playlist=user_playlist, action_cache=action_cache):
                 badge.award_to(user=user, user_data=user_data, user_playlist=user_playlist)
+                badges_owned.update(user_data.badges)
                 awarded = True
 
     if include_other_badges:
-        awarded = update_with_no_context(user, user_data, action_cache=action_cache) or awarded
+        awarded = update_with_no_context(user, user_data, action_cache=action_cache, facts_changed=facts_changed_after_awards(facts_changed, awarded), badges_owned=badges_owned) or awarded
 
     return awarded
 
+def facts_changed_after_awards(facts_changed, awarded):
+    if facts_changed is None or not awarded or badges.BadgeFact.POINTS in facts_changed:
+        return facts_changed
+    return list(facts_changed) + [badges.BadgeFact.POINTS]
+
@@ -15,16 +15,31 @@ Not everything are upsides. You can not use it on every case because:
 - The only way to be sure you have flushed all the GAE instances caches is doing a code upload, no code change required. 
 - The memory available depends on each GAE instance and your app. I've been able to set a 60 millions characters string which
   is like 57 MB at least. You can cache somethings but not everything. 
+
+To keep an instance from running out of memory the cache is bounded: once it holds more than MAX_KEYS_COUNT keys or
+roughly MAX_BYTES bytes the least recently used keys are evicted, and expired keys are swept periodically.
 """
 
 import time
 import logging
 import os
+import array
 
+""" 
+Maps key -> node, where each node is a list [prev, next, key, value, expiry, size].
+The nodes also form a circular doubly linked list anchored at ROOT, ordered from least to most recently used.
+"""
 CACHE = {}
+ROOT = []
+ROOT[:] = [ROOT, ROOT, None, None, None, 0]
+PREV, NEXT, KEY, VALUE, EXPIRY, SIZE = 0, 1, 2, 3, 4, 5
+
 STATS_HITS = 0
 STATS_MISSES = 0
 STATS_KEYS_COUNT = 0
+STATS_EVICTIONS = 0
+STATS_EXPIRATIONS = 0
+STATS_BYTES = 0
 
 """ Flag to deactivate it on local environment. """
 ACTIVE = False if os.environ.get('SERVER_SOFTWARE').startswith('Devel') else True
@@ -35,6 +50,30 @@ Value in seconds.
 """
 DEFAULT_CACHING_TIME = None
 
+"""
+Upper bounds for the cache of each instance. Once either of them is exceeded the least recently used keys are evicted.
+The byte size is approximate, see _approximate_size, unless the caller passes the size to set().
+"""
+MAX_KEYS_COUNT = 2000
+MAX_BYTES = 32 * 1024 * 1024
+
+""" Size accounted for numbers, None and the like, and for anything nested deeper than SIZE_MAX_DEPTH. """
+SMALL_VALUE_SIZE = 16
+
+""" Size accounted for values of types _approximate_size doesn't know about. """
+UNKNOWN_VALUE_SIZE = 1024
+
+""" Containers are sized from their first SIZE_SAMPLE_COUNT items, scaled up to their length. """
+SIZE_SAMPLE_COUNT = 8
+SIZE_MAX_DEPTH = 4
+
+""" Bound here since set() below shadows the builtin. """
+SEQUENCE_TYPES = ( list, tuple, set, frozenset )
+
+""" Expired keys are swept from the whole cache at most once per this many seconds, piggybacking on set() calls. """
+SWEEP_INTERVAL_SECONDS = 60
+LAST_SWEEP = time.time()
+
 URL_KEY = 'URL_%s'
 
 """
@@ -47,52 +86,82 @@ def get( key ):
     if ACTIVE is False:
         return None
         
-    global CACHE, STATS_MISSES, STATS_HITS
+    global CACHE, STATS_MISSES, STATS_HITS, STATS_EXPIRATIONS
         
     """ Return a key stored in the python instance cache or a None if it has expired or it doesn't exist """
-    if key not in CACHE:
+    node = CACHE.get(key)
+    if node is None:
         STATS_MISSES += 1
         return None
     
-    value, expiry = CACHE[key]
-    current_timestamp = time.time()
-    if expiry == None or current_timestamp < expiry:
+    expiry = node[EXPIRY]
+    if expiry == None or time.time() < expiry:
         STATS_HITS += 1
-        return value
+        _move_to_end( node )
+        return node[VALUE]
     else:
         STATS_MISSES += 1
+        STATS_EXPIRATIONS += 1
         delete( key )
         return None
 
-def set( key, value, expiry = DEFAULT_CACHING_TIME ):
+def set( key, value, expiry = DEFAULT_CACHING_TIME, size = None ):
     """
     Sets a key in the current instance
-    key, value, expiry seconds till it expires 
+    key, value, expiry seconds till it expires, size in bytes if the caller knows it better than _approximate_size
     """
     if ACTIVE is False:
         return None
     
-    global CACHE, STATS_KEYS_COUNT
-    if key not in CACHE:
-        STATS_KEYS_COUNT += 1
+    global CACHE, STATS_KEYS_COUNT, STATS_BYTES
     if expiry != None:
         expiry = time.time() + int( expiry )
-    
+
+    if size is None:
+        size = _approximate_size( value )
+    if size > MAX_BYTES:
+        logging.info( "%s not caching key '%s', its %s bytes exceed the cache size" % ( __name__, key, size ) )
+        delete( key )
+        return None
+
+    delete( key )
+    _sweep_if_necessary()
+    _evict( MAX_KEYS_COUNT - 1, MAX_BYTES - size )
+
     try:
-        CACHE[key] = ( value, expiry )
+        last = ROOT[PREV]
+        node = [last, ROOT, key, value, expiry, size]
+        CACHE[key] = node
+        last[NEXT] = node
+        ROOT[PREV] = node
+        STATS_KEYS_COUNT += 1
+        STATS_BYTES += size
     except MemoryError:
         """ It doesn't seems to catch the exception, something in the GAE's python runtime probably """
         logging.info( "%s memory error setting key '%s'" % ( __name__, key ) )
+        _evict( MAX_KEYS_COUNT / 2, MAX_BYTES / 2 )
  
 def delete( key ):
     """ 
     Deletes the key stored in the cache of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing, use expiry when setting a value instead.
     """
-    global CACHE, STATS_KEYS_COUNT
-    if key in CACHE:
+    global CACHE, STATS_KEYS_COUNT, STATS_BYTES
+    node = CACHE.pop(key, None)
+    if node is not None:
         STATS_KEYS_COUNT -= 1
-        del CACHE[key]
+        STATS_BYTES -= node[SIZE]
+        _unlink( node )
+
+def sweep():
+    """ Deletes every expired key of the current instance, not all the instances. Returns the number of deleted keys. """
+    global LAST_SWEEP, STATS_EXPIRATIONS
+    LAST_SWEEP = time.time()
+    expired = [node[KEY] for node in CACHE.itervalues() if node[EXPIRY] is not None and node[EXPIRY] <= LAST_SWEEP]
+    for key in expired:
+        delete( key )
+    STATS_EXPIRATIONS += len(expired)
+    return len(expired)
 
 def dump():
     """
@@ -107,18 +176,25 @@ def flush():
     Resets the cache of the current instance, not all the instances.
     There's no reason to use it except for debugging when developing.
     """
-    global CACHE, STATS_KEYS_COUNT
+    global CACHE, STATS_KEYS_COUNT, STATS_BYTES
     CACHE = {}
+    ROOT[:] = [ROOT, ROOT, None, None, None, 0]
     STATS_KEYS_COUNT = 0
+    STATS_BYTES = 0
     
 def stats():
-    """ Return the hits and misses stats, the number of keys and the cache memory address of the current instance, not all the instances."""
-    global CACHE, STATS_MISSES, STATS_HITS, STATS_KEYS_COUNT
+    """ Return the hits, misses, evictions and size stats, the number of keys and the cache memory address of the current instance, not all the instances."""
+    global CACHE, STATS_MISSES, STATS_HITS, STATS_KEYS_COUNT, STATS_EVICTIONS, STATS_EXPIRATIONS, STATS_BYTES
     memory_address = "0x" + str("%X" % id( CACHE )).zfill(16)
     return {'cache_memory_address': memory_address,
             'hits': STATS_HITS,
             'misses': STATS_MISSES ,
             'keys_count': STATS_KEYS_COUNT,
+            'max_keys_count': MAX_KEYS_COUNT,
+            'evictions': STATS_EVICTIONS,
+            'expirations': STATS_EXPIRATIONS,
+            'bytes': STATS_BYTES,
+            'max_bytes': MAX_BYTES,
             }
     
 def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME ):
@@ -133,3 +209,65 @@ def cacheit( keyformat, expiry=DEFAULT_CACHING_TIME ):
             return data
         return wrapper
     return decorator
+
+def _approximate_size( value, depth = 0 ):
+    """
+    Estimates the bytes value takes up without serializing it, since set() is called on hot paths
+    with values as big as the whole video library. Strings and arrays are measured exactly,
+    containers and objects' attributes are sampled, which is close enough for the usual lists
+    of models or dicts of similar values.
+    """
+    if isinstance( value, basestring ):
+        return len( value )
+    if isinstance( value, array.array ):
+        return len( value ) * value.itemsize
+    if value is None or isinstance( value, ( int, long, float, bool ) ) or depth >= SIZE_MAX_DEPTH:
+        return SMALL_VALUE_SIZE
+
+    if isinstance( value, dict ):
+        return _approximate_items_size( value.iteritems(), len( value ), depth, True )
+    if isinstance( value, SEQUENCE_TYPES ):
+        return _approximate_items_size( iter( value ), len( value ), depth, False )
+    if hasattr( value, '__dict__' ):
+        return SMALL_VALUE_SIZE + _approximate_size( value.__dict__, depth + 1 )
+    return UNKNOWN_VALUE_SIZE
+
+def _approximate_items_size( items, count, depth, is_dict ):
+    sampled_size = 0
+    sampled_count = 0
+    for item in items:
+        if sampled_count >= SIZE_SAMPLE_COUNT:
+            break
+        if is_dict:
+            sampled_size += _approximate_size( item[0], depth + 1 ) + _approximate_size( item[1], depth + 1 )
+        else:
+            sampled_size += _approximate_size( item, depth + 1 )
+        sampled_count += 1
+    if not sampled_count:
+        return SMALL_VALUE_SIZE
+    return SMALL_VALUE_SIZE + sampled_size * count / sampled_count
+
+def _unlink( node ):
+    prev, next = node[PREV], node[NEXT]
+    prev[NEXT] = next
+    next[PREV] = prev
+
+def _move_to_end( node ):
+    """ Marks the node as the most recently used one """
+    _unlink( node )
+    last = ROOT[PREV]
+    node[PREV] = last
+    node[NEXT] = ROOT
+    last[NEXT] = node
+    ROOT[PREV] = node
+
+def _evict( max_keys_count, max_bytes ):
+    """ Deletes the least recently used keys until there are at most max_keys_count keys using at most max_bytes """
+    global STATS_EVICTIONS
+    while CACHE and ( STATS_KEYS_COUNT > max_keys_count or STATS_BYTES > max_bytes ):
+        delete( ROOT[NEXT][KEY] )
+        STATS_EVICTIONS += 1
+
+def _sweep_if_necessary():
+    if time.time() - LAST_SWEEP >= SWEEP_INTERVAL_SECONDS:
+        sweep()
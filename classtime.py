@@ -31,20 +31,18 @@ class ClassTimeAnalyzer:
 
         classtime_table = ClassTimeTable(dt_start_ctz, dt_end_ctz)
 
+        dt_end_utc = self.dt_to_utc(dt_end_ctz)
+
         for student_email in student_emails:
             student = users.User(email=student_email)
 
-            problem_logs = ProblemLog.get_for_user_between_dts(student, self.dt_to_utc(dt_start_ctz), self.dt_to_utc(dt_end_ctz))
-            video_logs = VideoLog.get_for_user_between_dts(student, self.dt_to_utc(dt_start_ctz), self.dt_to_utc(dt_end_ctz))
-
-            problem_and_video_logs = []
-
-            for problem_log in problem_logs:
-                problem_and_video_logs.append(problem_log)
-            for video_log in video_logs:
-                problem_and_video_logs.append(video_log)
+            problem_logs = list(ProblemLog.get_for_user_between_dts(student, dt_start_utc, dt_end_utc))
+            video_logs = list(VideoLog.get_for_user_between_dts(student, dt_start_utc, dt_end_utc))
 
-            problem_and_video_logs = sorted(problem_and_video_logs, key=lambda log: log.time_started())
+            # Each query is ordered by time_done or time_watched, which is nearly
+            # the order of time_started(), so a single sort of both is cheap.
+            # Ties keep problems before videos.
+            problem_and_video_logs = sorted(problem_logs + video_logs, key=lambda log: log.time_started())
 
             chunk_current = None
 
@@ -120,6 +118,16 @@ class ClassTimeTable:
 
         self.update_student_total(chunk)
 
+    # Renders each chunk's description and activity class and then drops its logs,
+    # which keeps finished days' tables small enough to cache
+    def drop_activities(self):
+        for row in self.rows:
+            for chunk in row.chunks:
+                if chunk is not None:
+                    chunk.description()
+                    chunk.activity_class()
+                    chunk.activities = []
+
     def balance(self):
         width = 0
         height = len(self.rows)
@@ -146,6 +154,7 @@ class ClassTimeChunk:
         self.end = None
         self.activities = []
         self.cached_activity_class = None
+        self.cached_description = None
 
     def minutes_spent(self):
         return util.minutes_between(self.start, self.end)
@@ -220,6 +229,10 @@ class ClassTimeChunk:
         return None
 
     def description(self):
+
+        if self.cached_description is not None:
+            return self.cached_description
+
         dict_videos = {}
         dict_exercises = {}
 
@@ -262,5 +275,6 @@ class ClassTimeChunk:
 
         desc = ("<b>%s</b> - <b>%s</b><br/>(<em>~%.0f min.</em>)" % (self.start.strftime("%I:%M%p"), self.end.strftime("%I:%M%p"), self.minutes_spent())) + "<br/>" + desc_videos + desc_exercises
 
+        self.cached_description = desc
         return desc
 
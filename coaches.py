@@ -112,6 +112,7 @@ class RegisterCoach(request_handler.RequestHandler):
         coach_email = self.request.get('coach').lower()            
         user_data.coaches.append(coach_email)
         user_data.put()
+        UserData.clear_roster_memcache_for(coach_email)
         self.redirect("/coaches")
             
 
@@ -131,6 +132,7 @@ class UnregisterCoach(request_handler.RequestHandler):
             elif coach_email.lower() in user_data.coaches:
                 user_data.coaches.remove(coach_email.lower())
                 user_data.put()          
+            UserData.clear_roster_memcache_for(coach_email)
         self.redirect("/coaches") 
 
 
@@ -0,0 +1,244 @@
+import datetime
+import struct
+
+from google.appengine.api import users
+from google.appengine.ext import db
+
+# DailyActivitySummary holds one user's exercise and video activity for one day,
+# bucketed by hour. DailyActivityLog stores one per day and the activity and focus
+# graphs load up to a month or more of them on every profile view.
+#
+# Summaries are stored with encode() and decode() rather than pickled. The encoding
+# starts with its VERSION, then interns every string (user, exercise names, video keys,
+# video and playlist titles) once in a table of UTF-8 strings and writes each hour's
+# exercise and video items as fixed-width records that refer to strings by index.
+#
+# These classes used to live in activity_summary, which still imports them so
+# DailyActivityLogs pickled before the encoding existed keep loading.
+
+VERSION = 1
+
+HEADER_FORMAT = "!BHBBHHB" # version, year, month, day, user, c_strings, c_hours
+HOUR_FORMAT = "!BHH" # hour, c_exercises, c_videos
+EXERCISE_FORMAT = "!Hiiii" # exercise, c_problems, c_correct, time_taken, points_earned
+VIDEO_FORMAT = "!HHiiH" # video key, video title, seconds_watched, points_earned, c_playlist_titles
+
+# String index and playlist title count used for None
+NONE_INDEX = 0xFFFF
+
+def start_of_day(dt):
+    return datetime.datetime(dt.year, dt.month, dt.day)
+
+class ActivitySummaryExerciseItem:
+    def __init__(self):
+        self.c_problems = 0
+        self.c_correct = 0
+        self.time_taken = 0
+        self.points_earned = 0
+        self.exercise = None
+
+class ActivitySummaryVideoItem:
+    def __init__(self):
+        self.seconds_watched = 0
+        self.points_earned = 0
+        self.playlist_titles = None
+        self.video_title = None
+
+class DailyActivitySummary:
+
+    def __init__(self):
+        self.user = None
+        self.date = None
+        self.hourly_summaries = {}
+
+    def has_activity(self):
+        return len(self.hourly_summaries) > 0
+
+    def get_hourly_summary(self, hour):
+        if not self.hourly_summaries.has_key(hour):
+            self.hourly_summaries[hour] = HourlyActivitySummary(self.date, hour)
+        return self.hourly_summaries[hour]
+
+    @staticmethod
+    def build(user, date, problem_logs, video_logs):
+        # Chop off hours, minutes, and seconds
+        date = start_of_day(date)
+
+        summary = DailyActivitySummary.build_many(user, problem_logs, video_logs).get(date)
+        if summary is None:
+            summary = DailyActivitySummary()
+            summary.user = user
+            summary.date = date
+
+        return summary
+
+    # Buckets every log by day and hour in a single pass,
+    # returning a dict of DailyActivitySummary keyed by day
+    @staticmethod
+    def build_many(user, problem_logs, video_logs):
+        summaries = {}
+
+        def get_summary(dt):
+            date = start_of_day(dt)
+            if not summaries.has_key(date):
+                summary = DailyActivitySummary()
+                summary.user = user
+                summary.date = date
+                summaries[date] = summary
+            return summaries[date]
+
+        for problem_log in problem_logs:
+            get_summary(problem_log.time_done).get_hourly_summary(problem_log.time_done.hour).add_problem_log(problem_log)
+
+        for video_log in video_logs:
+            get_summary(video_log.time_watched).get_hourly_summary(video_log.time_watched.hour).add_video_log(video_log)
+
+        return summaries
+
+class HourlyActivitySummary:
+
+    def __init__(self, date, hour):
+        self.date = datetime.datetime(date.year, date.month, date.day, hour)
+        self.dict_exercises = {}
+        self.dict_videos = {}
+
+    def has_video_activity(self):
+        return len(self.dict_videos) > 0
+
+    def has_exercise_activity(self):
+        return len(self.dict_exercises) > 0
+
+    def add_problem_log(self, problem_log):
+        if not self.dict_exercises.has_key(problem_log.exercise):
+            self.dict_exercises[problem_log.exercise] = ActivitySummaryExerciseItem()
+
+        summary_item = self.dict_exercises[problem_log.exercise]
+        summary_item.time_taken += problem_log.time_taken_capped_for_reporting()
+        summary_item.points_earned += problem_log.points_earned
+        summary_item.c_problems += 1
+        summary_item.exercise = problem_log.exercise
+        if problem_log.correct:
+            summary_item.c_correct += 1
+
+    def add_video_log(self, video_log):
+        video_key = video_log.key_for_video()
+        if not self.dict_videos.has_key(video_key):
+            self.dict_videos[video_key] = ActivitySummaryVideoItem()
+
+        summary_item = self.dict_videos[video_key]
+        summary_item.seconds_watched += video_log.seconds_watched
+        summary_item.points_earned += video_log.points_earned
+        summary_item.playlist_titles = video_log.playlist_titles
+        summary_item.video_title = video_log.video_title
+
+def encode(summary):
+    strings = []
+    string_indexes = {}
+
+    def index_of(s):
+        if s is None:
+            return NONE_INDEX
+        if not string_indexes.has_key(s):
+            string_indexes[s] = len(strings)
+            strings.append(s)
+        return string_indexes[s]
+
+    user_index = NONE_INDEX
+    if summary.user:
+        user_index = index_of(summary.user.email())
+
+    records = []
+    for hour in sorted(summary.hourly_summaries.keys()):
+        hourly_summary = summary.hourly_summaries[hour]
+        records.append(struct.pack(HOUR_FORMAT, hour, len(hourly_summary.dict_exercises), len(hourly_summary.dict_videos)))
+
+        for exercise, item in hourly_summary.dict_exercises.iteritems():
+            records.append(struct.pack(EXERCISE_FORMAT, index_of(exercise),
+                item.c_problems, item.c_correct, item.time_taken, item.points_earned))
+
+        for video_key, item in hourly_summary.dict_videos.iteritems():
+            playlist_titles = item.playlist_titles
+            c_playlist_titles = NONE_INDEX if playlist_titles is None else len(playlist_titles)
+            records.append(struct.pack(VIDEO_FORMAT, index_of(None if video_key is None else str(video_key)), index_of(item.video_title),
+                item.seconds_watched, item.points_earned, c_playlist_titles))
+            if playlist_titles:
+                records.append(struct.pack("!%dH" % len(playlist_titles), *[index_of(title) for title in playlist_titles]))
+
+    strings = [unicode(s).encode("utf-8") for s in strings]
+
+    header = struct.pack(HEADER_FORMAT, VERSION,
+            summary.date.year, summary.date.month, summary.date.day,
+            user_index, len(strings), len(summary.hourly_summaries))
+
+    return "".join([
+        header,
+        struct.pack("!%dH" % len(strings), *[len(s) for s in strings]),
+        "".join(strings),
+        "".join(records),
+        ])
+
+def decode(encoded):
+    offset = struct.calcsize(HEADER_FORMAT)
+    (version, year, month, day, user_index, c_strings, c_hours) = struct.unpack(HEADER_FORMAT, encoded[:offset])
+
+    if version != VERSION:
+        raise ValueError("unknown DailyActivitySummary version %s" % version)
+
+    lengths = struct.unpack_from("!%dH" % c_strings, encoded, offset)
+    offset += 2 * c_strings
+
+    strings = []
+    for length in lengths:
+        strings.append(encoded[offset:offset + length].decode("utf-8"))
+        offset += length
+
+    summary = DailyActivitySummary()
+    summary.date = datetime.datetime(year, month, day)
+    if user_index != NONE_INDEX:
+        summary.user = users.User(strings[user_index])
+
+    hour_size = struct.calcsize(HOUR_FORMAT)
+    exercise_size = struct.calcsize(EXERCISE_FORMAT)
+    video_size = struct.calcsize(VIDEO_FORMAT)
+
+    for ix in xrange(c_hours):
+        (hour, c_exercises, c_videos) = struct.unpack_from(HOUR_FORMAT, encoded, offset)
+        offset += hour_size
+
+        hourly_summary = summary.get_hourly_summary(hour)
+
+        for ix_exercise in xrange(c_exercises):
+            (exercise_index, c_problems, c_correct, time_taken, points_earned) = struct.unpack_from(EXERCISE_FORMAT, encoded, offset)
+            offset += exercise_size
+
+            item = ActivitySummaryExerciseItem()
+            item.exercise = strings[exercise_index] if exercise_index != NONE_INDEX else None
+            item.c_problems = c_problems
+            item.c_correct = c_correct
+            item.time_taken = time_taken
+            item.points_earned = points_earned
+            hourly_summary.dict_exercises[item.exercise] = item
+
+        for ix_video in xrange(c_videos):
+            (video_key_index, video_title_index, seconds_watched, points_earned, c_playlist_titles) = struct.unpack_from(VIDEO_FORMAT, encoded, offset)
+            offset += video_size
+
+            item = ActivitySummaryVideoItem()
+            item.video_title = strings[video_title_index] if video_title_index != NONE_INDEX else None
+            item.seconds_watched = seconds_watched
+            item.points_earned = points_earned
+
+            if c_playlist_titles != NONE_INDEX:
+                playlist_title_indexes = struct.unpack_from("!%dH" % c_playlist_titles, encoded, offset)
+                offset += 2 * c_playlist_titles
+                item.playlist_titles = [strings[title_index] for title_index in playlist_title_indexes]
+
+            video_key = None
+            if video_key_index != NONE_INDEX:
+                video_key = db.Key(str(strings[video_key_index]))
+            hourly_summary.dict_videos[video_key] = item
+
+    if offset != len(encoded):
+        raise ValueError("DailyActivitySummary is %s bytes, expected %s" % (len(encoded), offset))
+
+    return summary
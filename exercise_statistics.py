@@ -1,6 +1,10 @@
 import math
 import functools
 import logging
+import random
+import time
+
+from google.appengine.ext import db
 
 from mapreduce import control
 from mapreduce import operation as op
@@ -8,6 +12,70 @@ from mapreduce import operation as op
 import request_handler
 import models
 import consts
+from quantile_sketch import QuantileSketch
+
+# Each exercise's fast problem time is the FASTEST_EXERCISE_PERCENTILE of the time taken
+# on its recent correct answers, which is estimated with a QuantileSketch instead of
+# fetching and sorting the exercise's latest ProblemLogs.
+#
+# problem_log_queue records the time taken on every correct answer it saves into the
+# exercise's sketch for the current week. Each week's sketch is split across SHARD_COUNT
+# entities so popular exercises don't serialize all their answers through a single
+# entity group. The weekly mapreduce merges the current and previous weeks' shards,
+# and only falls back to fetching ProblemLogs when they haven't seen enough answers.
+
+class ExerciseTimeTakenSketchShard(db.Model):
+    exercise = db.StringProperty()
+    week = db.IntegerProperty()
+    encoded = db.BlobProperty()
+
+    SHARD_COUNT = 10
+
+    @staticmethod
+    def get_key_name(exercise_name, week, shard):
+        return "%s:%s:%s" % (exercise_name, week, shard)
+
+    @staticmethod
+    def get_key_names(exercise_name, week):
+        return [ExerciseTimeTakenSketchShard.get_key_name(exercise_name, week, shard) for shard in range(ExerciseTimeTakenSketchShard.SHARD_COUNT)]
+
+    @staticmethod
+    def add(exercise_name, list_time_taken):
+        week = current_week()
+        key_name = ExerciseTimeTakenSketchShard.get_key_name(exercise_name, week, random.randint(0, ExerciseTimeTakenSketchShard.SHARD_COUNT - 1))
+        def txn():
+            shard = ExerciseTimeTakenSketchShard.get_by_key_name(key_name)
+            if shard is None:
+                shard = ExerciseTimeTakenSketchShard(key_name = key_name, exercise = exercise_name, week = week)
+                sketch = QuantileSketch()
+            else:
+                sketch = QuantileSketch.decode(shard.encoded)
+            for time_taken in list_time_taken:
+                sketch.add(time_taken)
+            shard.encoded = db.Blob(sketch.encode())
+            shard.put()
+        db.run_in_transaction(txn)
+
+def current_week():
+    return int(time.time()) / (60 * 60 * 24 * 7)
+
+def is_counted(time_taken):
+    # Ignore outliers
+    return time_taken > 3.0 and time_taken < consts.MAX_WORKING_ON_PROBLEM_SECONDS
+
+# Adds the time taken on each correct ProblemLog to its exercise's sketch
+def record_problem_logs(problem_logs):
+    dict_time_taken = {}
+    for problem_log in problem_logs:
+        if problem_log.correct and is_counted(problem_log.time_taken):
+            dict_time_taken.setdefault(problem_log.exercise, []).append(float(problem_log.time_taken))
+
+    for exercise_name, list_time_taken in dict_time_taken.iteritems():
+        try:
+            ExerciseTimeTakenSketchShard.add(exercise_name, list_time_taken)
+        except db.Error, e:
+            # Missing a few answers barely moves the percentile
+            logging.warning("Failed to record time taken for %s: %s" % (exercise_name, e))
 
 # /admin/startnewexercisestatisticsmapreduce is called periodically by a cron job
 class StartNewExerciseStatisticsMapReduce(request_handler.RequestHandler):
@@ -29,6 +97,40 @@ class StartNewExerciseStatisticsMapReduce(request_handler.RequestHandler):
 # statistics_update_map is called by a background MapReduce task.
 # Each call updates the statistics for a single exercise.
 def statistics_update_map(exercise):
+
+    week = current_week()
+    key_names = ExerciseTimeTakenSketchShard.get_key_names(exercise.name, week) + ExerciseTimeTakenSketchShard.get_key_names(exercise.name, week - 1)
+
+    sketch = QuantileSketch()
+    for shard in ExerciseTimeTakenSketchShard.get_by_key_name(key_names):
+        if shard is not None:
+            sketch.merge(QuantileSketch.decode(shard.encoded))
+
+    # Shards from before last week aren't read anymore, including any
+    # left over from weeks the mapreduce didn't run in
+    query = ExerciseTimeTakenSketchShard.all(keys_only=True)
+    query.filter('exercise =', exercise.name)
+    query.filter('week <', week - 1)
+    for key in query.fetch(1000):
+        yield op.db.Delete(key)
+
+    if sketch.count > consts.REQUIRED_PROBLEMS_FOR_EXERCISE_STATISTICS:
+        fastest_percentile = sketch.quantile(consts.FASTEST_EXERCISE_PERCENTILE)
+    else:
+        # Not enough recent answers, e.g. for rarely done exercises or before
+        # the sketches have filled up, so look at the latest ProblemLogs instead
+        fastest_percentile = fastest_percentile_from_problem_logs(exercise)
+
+    if fastest_percentile is None:
+        return
+
+    fastest_percentile = min(consts.MAX_SECONDS_PER_FAST_PROBLEM, fastest_percentile)
+    fastest_percentile = max(consts.MIN_SECONDS_PER_FAST_PROBLEM, fastest_percentile)
+
+    exercise.seconds_per_fast_problem = fastest_percentile
+    yield op.db.Put(exercise)
+
+def fastest_percentile_from_problem_logs(exercise):
     
     # Get the last 5,000 correct problems for this exercise for analysis
     query = models.ProblemLog.all()
@@ -41,22 +143,16 @@ def statistics_update_map(exercise):
     list_time_taken = []
 
     for problem_log in problem_logs:
-        # Ignore outliers
-        if problem_log.time_taken > 3.0 and problem_log.time_taken < consts.MAX_WORKING_ON_PROBLEM_SECONDS:
+        if is_counted(problem_log.time_taken):
             list_time_taken.append(float(problem_log.time_taken))
 
     if len(list_time_taken) <= consts.REQUIRED_PROBLEMS_FOR_EXERCISE_STATISTICS:
-        return
+        return None
 
     list_time_taken = sorted(list_time_taken)
 
     # The smallest times are the fastest 10th percentile
-    fastest_percentile = percentile(list_time_taken, consts.FASTEST_EXERCISE_PERCENTILE)
-    fastest_percentile = min(consts.MAX_SECONDS_PER_FAST_PROBLEM, fastest_percentile)
-    fastest_percentile = max(consts.MIN_SECONDS_PER_FAST_PROBLEM, fastest_percentile)
-
-    exercise.seconds_per_fast_problem = fastest_percentile
-    yield op.db.Put(exercise)
+    return percentile(list_time_taken, consts.FASTEST_EXERCISE_PERCENTILE)
 
 # See http://code.activestate.com/recipes/511478-finding-the-percentile-of-the-values/
 def percentile(N, percent, key=lambda x:x):
@@ -1,13 +1,16 @@
 import os
 import Cookie
+import datetime
 import logging
 import unicodedata
 from google.appengine.api import users
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import db
 
 from app import App
 import facebook
+import request_cache
 
 FACEBOOK_ID_EMAIL_PREFIX = "http://facebookid.khanacademy.org/"
 
@@ -19,27 +22,134 @@ FACEBOOK_CACHE_EXPIRATION_SECONDS = 60 * 60 * 24 * 20
 def is_facebook_email(email):
     return email.startswith(FACEBOOK_ID_EMAIL_PREFIX)
 
-def get_facebook_nickname(user):
+# Facebook nicknames are resolved in batches: get_facebook_nicknames looks every user up
+# in the request cache, then memcache, then FacebookNickname entities in the datastore,
+# and only asks the Graph API about whoever is left, with a single multi-id request
+# per GRAPH_BATCH_SIZE users. Nicknames found in the Graph API are saved to the
+# datastore too, so memcache evictions don't turn into bursts of Graph API calls.
+# Like the memcache entries, saved nicknames are refreshed from the Graph API
+# once they're FACEBOOK_CACHE_EXPIRATION_SECONDS old.
+#
+# Tests can swap in LocalGraphAPI to avoid calling out to Facebook:
+#
+# facebook_util.GRAPH_API = facebook_util.LocalGraphAPI({"1234": {"id": "1234", "name": "Jane"}})
+
+GRAPH_BATCH_SIZE = 50
+
+NICKNAME_KEY_FORMAT = "facebook_nickname_%s"
+
+class FacebookNickname(db.Model):
+    # key_name is the user's Facebook email
+    nickname = db.StringProperty()
+    dt_updated = db.DateTimeProperty(auto_now=True)
+
+class LocalGraphAPI:
+    # In-process stand-in for facebook.GraphAPI that serves profiles from a dict
+
+    def __init__(self, profiles=None):
+        self.profiles = profiles or {}
+        self.requests = 0
 
-    email = user.email()
+    def get_object(self, id):
+        return self.get_objects([id])[id]
 
-    memcache_key = "facebook_nickname_%s" % email
-    name = memcache.get(memcache_key)
-    if name is not None:
-        return name
+    def get_objects(self, ids):
+        self.requests += 1
+        for id in ids:
+            if id not in self.profiles:
+                raise facebook.GraphAPIError("OAuthException", "Unknown id %s" % id)
+        return dict((id, self.profiles[id]) for id in ids)
 
-    id = email.replace(FACEBOOK_ID_EMAIL_PREFIX, "")
-    graph = facebook.GraphAPI()
+GRAPH_API = facebook.GraphAPI()
+
+def get_facebook_nickname(user):
+    return get_facebook_nicknames([user])[user.email()]
+
+# Returns a dict of nicknames keyed by email
+def get_facebook_nicknames(users):
+    nicknames = {}
+
+    emails = []
+    for user in users:
+        email = user.email()
+        name = request_cache.get(NICKNAME_KEY_FORMAT % email)
+        if name is not None:
+            nicknames[email] = name
+        elif email not in emails:
+            emails.append(email)
+
+    if emails:
+        cached = memcache.get_multi(emails, key_prefix=NICKNAME_KEY_FORMAT % "")
+        nicknames.update(cached)
+        emails = [email for email in emails if email not in cached]
+
+    # Nicknames saved longer ago than FACEBOOK_CACHE_EXPIRATION_SECONDS are asked about again,
+    # and only used if the Graph API can't tell us about them anymore
+    stale = {}
+
+    if emails:
+        found = {}
+        dt_expired = datetime.datetime.now() - datetime.timedelta(seconds=FACEBOOK_CACHE_EXPIRATION_SECONDS)
+        for email, facebook_nickname in zip(emails, FacebookNickname.get_by_key_name(emails)):
+            if facebook_nickname is not None:
+                if facebook_nickname.dt_updated and facebook_nickname.dt_updated < dt_expired:
+                    stale[email] = facebook_nickname.nickname
+                else:
+                    found[email] = facebook_nickname.nickname
+        memcache.set_multi(found, key_prefix=NICKNAME_KEY_FORMAT % "", time=FACEBOOK_CACHE_EXPIRATION_SECONDS)
+        nicknames.update(found)
+        emails = [email for email in emails if email not in found]
+
+    if emails:
+        found = {}
+        for ix in range(0, len(emails), GRAPH_BATCH_SIZE):
+            found.update(fetch_facebook_nicknames(emails[ix:ix + GRAPH_BATCH_SIZE]))
+
+        if found:
+            db.put([FacebookNickname(key_name=email, nickname=name) for email, name in found.iteritems()])
+
+        for email, name in stale.iteritems():
+            if email not in found:
+                found[email] = name
+
+        if found:
+            memcache.set_multi(found, key_prefix=NICKNAME_KEY_FORMAT % "", time=FACEBOOK_CACHE_EXPIRATION_SECONDS)
+        nicknames.update(found)
+
+    for email, name in nicknames.iteritems():
+        request_cache.set(NICKNAME_KEY_FORMAT % email, name)
+
+    # Fall back to the email for anyone Facebook couldn't tell us about
+    for user in users:
+        if user.email() not in nicknames:
+            nicknames[user.email()] = user.email()
+
+    return nicknames
+
+# Returns a dict of nicknames keyed by email for the emails the Graph API knows about
+def fetch_facebook_nicknames(emails):
+    ids = {}
+    for email in emails:
+        ids[email.replace(FACEBOOK_ID_EMAIL_PREFIX, "")] = email
 
     try:
-        profile = graph.get_object(id)
-        # Workaround http://code.google.com/p/googleappengine/issues/detail?id=573
-        name = unicodedata.normalize('NFKD', profile["name"]).encode('ascii', 'ignore')
-        memcache.set(memcache_key, name, time=FACEBOOK_CACHE_EXPIRATION_SECONDS)
+        profiles = GRAPH_API.get_objects(ids.keys())
     except (facebook.GraphAPIError, urlfetch.DownloadError, AttributeError):
-        name = email
-
-    return name
+        # The whole batch fails if any one id is bad, so ask about each id on its own
+        profiles = {}
+        if len(ids) > 1:
+            for id in ids:
+                try:
+                    profiles[id] = GRAPH_API.get_object(id)
+                except (facebook.GraphAPIError, urlfetch.DownloadError, AttributeError):
+                    pass
+
+    nicknames = {}
+    for id, profile in profiles.iteritems():
+        if ids.has_key(id) and profile and profile.get("name"):
+            # Workaround http://code.google.com/p/googleappengine/issues/detail?id=573
+            nicknames[ids[id]] = unicodedata.normalize('NFKD', profile["name"]).encode('ascii', 'ignore')
+    return nicknames
 
 def get_current_facebook_user():
 
@@ -1,6 +1,7 @@
 from google.appengine.api import memcache
 import logging
 import cachepy
+import request_cache
 from app import App
 
 # layer_cache provides an easy way to cache the result of functions in
@@ -60,20 +61,63 @@ from app import App
 # Persist the cached values across different uploaded app verions
 # (by default this will not happen w/ memcache):
 # @layer_cache.cache_with_key(... persist_across_app_versions=True)
+#
+# Protect an expensive function from cache stampedes. When the cached value
+# is missing, only the request that wins a short memcache lease recomputes it
+# while concurrent requests keep serving the previously computed value
+# (for at most SINGLE_FLIGHT_STALE_SECONDS past its expiration):
+# @layer_cache.cache_with_key(... single_flight=True)
+#
+# Anything a cached function computes from a previous value is returned
+# to its caller but never cached itself, so an enclosing cached function
+# can't store the previous value's data under a new key.
+#
+# If the key itself changes whenever the value is invalidated (e.g. it
+# includes a content date), pass a function returning a stable key under
+# which the previous value can be found:
+# @layer_cache.cache_with_key_fxn(
+#         lambda: "all_exercises_%s" % Setting.cached_exercises_date(),
+#         single_flight=True,
+#         stale_key_fxn=lambda: "all_exercises")
+#
+#
+# _____Caching many values at once:_____
+#
+# Cache the per-object results of a function that is called with a whole
+# list of objects. Cachepy is checked first, then all remaining keys are
+# fetched from memcache with a single get_multi. The target is only called
+# once, with the list of objects that missed, and must return their results
+# in the same order. The new results are written back with a single set_multi:
+#
+# @layer_cache.cache_with_key_fxn_multi(lambda object: "layer_cache_key_for_object_%s" % object.id())
+# def calculate_object_averages(objects):
+#   ... do lots of long-running work, ideally in batches...
+#   return [result_for_cache_for_object(object) for object in objects]
+#
+# averages = calculate_object_averages(objects) # One result per object, in order
 
 DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS = 60 * 60 * 24 * 10 # Expire after 10 days by default
 DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE = 0 # Cache in both memcache and cachepy by default
 SINGLE_LAYER_MEMCACHE_ONLY = 1
 SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY = 2
 
+SINGLE_FLIGHT_LEASE_SECONDS = 30 # Max time a single request may hold the right to recompute a value
+SINGLE_FLIGHT_STALE_SECONDS = 60 * 10 # How long past its expiration a previous value may still be served
+SINGLE_FLIGHT_LEASE_KEY_FORMAT = "layer_cache_lease_%s"
+SINGLE_FLIGHT_STALE_KEY_FORMAT = "layer_cache_stale_%s"
+SINGLE_FLIGHT_STALE_COUNTER = "layer_cache_stale_results"
+MAX_MEMCACHE_RELATIVE_EXPIRATION_SECONDS = 60 * 60 * 24 * 30 # Memcache treats larger values as absolute timestamps
+
 def cache_with_key(
         key, 
         expiration=DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS,
         layer = DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE,
-        persist_across_app_versions = False):
+        persist_across_app_versions = False,
+        single_flight = False,
+        stale_key_fxn = None):
     def decorator(target):
         def wrapper(*args, **kwargs):
-            return layer_cache_check_set_return(target, lambda: key, expiration, layer, persist_across_app_versions, *args, **kwargs)
+            return layer_cache_check_set_return(target, lambda: key, expiration, layer, persist_across_app_versions, single_flight, stale_key_fxn, *args, **kwargs)
         return wrapper
     return decorator
 
@@ -81,10 +125,12 @@ def cache_with_key_fxn(
         key_fxn, 
         expiration=DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS,
         layer = DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE,
-        persist_across_app_versions = False):
+        persist_across_app_versions = False,
+        single_flight = False,
+        stale_key_fxn = None):
     def decorator(target):
         def wrapper(*args, **kwargs):
-            return layer_cache_check_set_return(target, key_fxn, expiration, layer, persist_across_app_versions, *args, **kwargs)
+            return layer_cache_check_set_return(target, key_fxn, expiration, layer, persist_across_app_versions, single_flight, stale_key_fxn, *args, **kwargs)
         return wrapper
     return decorator
 
@@ -94,6 +140,8 @@ def layer_cache_check_set_return(
         expiration = DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS, 
         layer = DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE,
         persist_across_app_versions = False,
+        single_flight = False,
+        stale_key_fxn = None,
         *args, 
         **kwargs):
 
@@ -113,10 +161,40 @@ def layer_cache_check_set_return(
         if layer != SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY:
             result = memcache.get(key, namespace=namespace)
             if result is not None:
-                cachepy.set(key, result)
+                cachepy.set(key, result, expiry=expiration)
                 return result
 
-    result = target(*args, **kwargs)
+    lease_key = None
+    stale_key = None
+    if single_flight:
+        stale_key = key
+        if stale_key_fxn:
+            stale_key = stale_key_fxn(*args, **kwargs)
+        stale_key = SINGLE_FLIGHT_STALE_KEY_FORMAT % stale_key
+
+        if not bust_cache:
+            if memcache.add(SINGLE_FLIGHT_LEASE_KEY_FORMAT % key, True, time=SINGLE_FLIGHT_LEASE_SECONDS, namespace=namespace):
+                lease_key = SINGLE_FLIGHT_LEASE_KEY_FORMAT % key
+            else:
+                # Another request is already recomputing this value,
+                # so serve the previous one while it does.
+                result = memcache.get(stale_key, namespace=namespace)
+                if result is not None:
+                    request_cache.increment(SINGLE_FLIGHT_STALE_COUNTER)
+                    return result
+                # Nothing to fall back on, recompute it here as well
+
+    c_stale = stale_results_served()
+    try:
+        result = target(*args, **kwargs)
+    finally:
+        if lease_key:
+            memcache.delete(lease_key, namespace=namespace)
+
+    if stale_results_served() > c_stale:
+        # target was served a previous value by a nested single_flight function,
+        # so don't cache what it built from it, under the new key or the stale one
+        return result
 
     # In case the key's value has been changed by target's execution
     key = key_fxn(*args, **kwargs)
@@ -128,5 +206,96 @@ def layer_cache_check_set_return(
         if not memcache.set(key, result, time=expiration, namespace=namespace):
             logging.error("Memcache set failed for %s" % key)
 
+    if stale_key:
+        stale_expiration = min(expiration + SINGLE_FLIGHT_STALE_SECONDS, MAX_MEMCACHE_RELATIVE_EXPIRATION_SECONDS)
+        if not memcache.set(stale_key, result, time=stale_expiration, namespace=namespace):
+            logging.error("Memcache set failed for %s" % stale_key)
+
     return result
 
+# How many previous values single_flight functions have served during this request
+def stale_results_served():
+    return request_cache.counters().get(SINGLE_FLIGHT_STALE_COUNTER, 0)
+
+def cache_with_key_fxn_multi(
+        key_fxn,
+        expiration=DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS,
+        layer = DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE,
+        persist_across_app_versions = False):
+    def decorator(target):
+        def wrapper(list_args, bust_cache=False):
+            return layer_cache_check_set_return_multi(target, key_fxn, list_args, expiration, layer, persist_across_app_versions, bust_cache)
+        return wrapper
+    return decorator
+
+def layer_cache_check_set_return_multi(
+        target,
+        key_fxn,
+        list_args,
+        expiration = DEFAULT_LAYER_CACHE_EXPIRATION_SECONDS,
+        layer = DUAL_LAYER_MEMCACHE_AND_IN_APP_MEMORY_CACHE,
+        persist_across_app_versions = False,
+        bust_cache = False):
+
+    keys = map(key_fxn, list_args)
+    namespace = App.version
+
+    if persist_across_app_versions:
+        namespace = None
+
+    results = {}
+
+    if not bust_cache:
+        if layer != SINGLE_LAYER_MEMCACHE_ONLY:
+            for key in keys:
+                result = cachepy.get(key)
+                if result is not None:
+                    results[key] = result
+
+        if layer != SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY:
+            keys_missing = [key for key in keys if key not in results]
+            if keys_missing:
+                for key, result in memcache.get_multi(keys_missing, namespace=namespace).iteritems():
+                    if result is not None:
+                        if layer != SINGLE_LAYER_MEMCACHE_ONLY:
+                            cachepy.set(key, result, expiry=expiration)
+                        results[key] = result
+
+    args_missing = []
+    keys_missing = []
+    keys_missing_set = set()
+    for arg, key in zip(list_args, keys):
+        if key not in results and key not in keys_missing_set:
+            args_missing.append(arg)
+            keys_missing.append(key)
+            keys_missing_set.add(key)
+
+    if args_missing:
+        c_stale = stale_results_served()
+        list_results = target(args_missing)
+        if len(list_results) != len(args_missing):
+            # zip would silently drop the extra args and fail with a KeyError below
+            raise ValueError("%s returned %s results for %s args, expected one result per arg" %
+                    (getattr(target, "__name__", target), len(list_results), len(args_missing)))
+
+        results_missing = {}
+        for key, result in zip(keys_missing, list_results):
+            results_missing[key] = result
+
+        if stale_results_served() > c_stale:
+            # Built from a previous value served by a nested single_flight function
+            results.update(results_missing)
+            return [results[key] for key in keys]
+
+        if layer != SINGLE_LAYER_MEMCACHE_ONLY:
+            for key, result in results_missing.iteritems():
+                cachepy.set(key, result, expiry=expiration)
+
+        if layer != SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY:
+            keys_failed = memcache.set_multi(results_missing, time=expiration, namespace=namespace)
+            if keys_failed:
+                logging.error("Memcache set_multi failed for %s" % keys_failed)
+
+        results.update(results_missing)
+
+    return [results[key] for key in keys]
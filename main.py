@@ -50,6 +50,7 @@ import consts
 
 from search import Searchable
 import search
+import search_index
 
 from app import App
 import app
@@ -59,6 +60,8 @@ import points
 import exercise_statistics
 import backfill
 import activity_summary
+import problem_log_queue
+import video_progress_queue
 
 from models import UserExercise, Exercise, UserData, Video, Playlist, ProblemLog, VideoPlaylist, ExerciseVideo, ExercisePlaylist, ExerciseGraph, Setting, UserVideo, UserPlaylist, VideoLog
 
@@ -71,6 +74,7 @@ from about import blog
 
 from badges import util_badges
 from badges import last_action_cache
+from badges.badges import BadgeFact
 
 from mailing_lists import util_mailing_lists
 from profiles import util_profile
@@ -599,11 +603,6 @@ class LogVideoProgress(request_handler.RequestHandler):
 
             if video:
 
-                user_data = UserData.get_or_insert_for(user)
-                user_video = UserVideo.get_for_video_and_user(video, user, insert_if_missing=True)
-
-                video_points_previous = points.VideoPointCalculator(user_video)
-
                 seconds_watched = 0
                 try:
                     # Seconds watched is restricted by both the scrubber's position
@@ -622,77 +621,12 @@ class LogVideoProgress(request_handler.RequestHandler):
                 except ValueError:
                     pass # Ignore if we can't parse
 
-                action_cache=last_action_cache.LastActionCache.get_for_user(user)
-                last_video_log = action_cache.get_last_video_log()
-
-                # If the last video logged is not this video and the times being credited
-                # overlap, don't give points for this video. Can only get points for one video
-                # at a time.
-                if last_video_log and last_video_log.key_for_video() != video.key():
-                    dt_now = datetime.datetime.now()
-                    if last_video_log.time_watched > (dt_now - datetime.timedelta(seconds=seconds_watched)):
-                        return
-
-                video_log = VideoLog()
-                video_log.user = user
-                video_log.video = video
-                video_log.video_title = video.title
-                video_log.seconds_watched = seconds_watched
-
-                if last_second_watched > user_video.last_second_watched:
-                    user_video.last_second_watched = last_second_watched
-
-                if seconds_watched > 0:
-                    user_video.seconds_watched += seconds_watched
-                    user_data.total_seconds_watched += seconds_watched
-
-                    # Update seconds_watched of all associated UserPlaylists
-                    query = VideoPlaylist.all()
-                    query.filter('video =', video)
-                    query.filter('live_association = ', True)
-
-                    first_video_playlist = True
-                    for video_playlist in query:
-                        user_playlist = UserPlaylist.get_for_playlist_and_user(video_playlist.playlist, user, insert_if_missing=True)
-                        user_playlist.title = video_playlist.playlist.title
-                        user_playlist.seconds_watched += seconds_watched
-                        user_playlist.last_watched = datetime.datetime.now()
-                        user_playlist.put()
-
-                        video_log.playlist_titles.append(user_playlist.title)
-
-                        if first_video_playlist:
-                            action_cache.push_video_log(video_log)
-
-                        util_badges.update_with_user_playlist(
-                                user, 
-                                user_data, 
-                                user_playlist,
-                                include_other_badges = first_video_playlist,
-                                action_cache = action_cache)
-
-                        first_video_playlist = False
-
-                user_video.last_watched = datetime.datetime.now()
-                user_video.duration = video.duration
-
-                user_data.last_activity = user_video.last_watched
+                # Progress is saved in batches of heartbeats, see video_progress_queue
+                progress = video_progress_queue.log_progress(user, video, seconds_watched, last_second_watched)
+                if progress is None:
+                    return
 
-                video_points_total = points.VideoPointCalculator(user_video)
-                video_points_received = video_points_total - video_points_previous
-
-                if not user_video.completed and video_points_total >= consts.VIDEO_POINTS_BASE:
-                    # Just finished this video for the first time
-                    user_video.completed = True
-                    user_data.videos_completed = -1
-
-                if video_points_received > 0:
-                    video_log.points_earned = video_points_received
-                    user_data.add_points(video_points_received)
-
-                db.put([user_video, video_log, user_data])
-
-                points_total = user_data.points
+                points_total, video_points_total = progress
 
         json = simplejson.dumps({"points": points_total, "video_points": video_points_total}, ensure_ascii=False)
         self.response.out.write(json)
@@ -907,7 +841,7 @@ class ViewAllExercises(request_handler.RequestHandler):
         if user:
             user_data = UserData.get_or_insert_for(user)
             
-            ex_graph = ExerciseGraph(user_data)
+            ex_graph = ExerciseGraph.get_for(user_data)
             if user_data.reassess_from_graph(ex_graph):
                 user_data.put()
 
@@ -1183,6 +1117,12 @@ class RegisterAnswer(request_handler.RequestHandler):
             elapsed_time = int(float(time.time()) - start_time)
 
             user_exercise = db.get(key)
+            if user_exercise is None:
+                # The UserExercise was moved by backfill.user_exercise_reparent_map
+                # after this problem was shown, so show it again with its new key
+                self.redirect('/exercises?exid=' + exid)
+                return
+
             user_data = UserData.get_for(user_exercise.user)
             exercise = user_exercise.exercise_model
 
@@ -1190,6 +1130,7 @@ class RegisterAnswer(request_handler.RequestHandler):
             user_exercise.seconds_per_fast_problem = exercise.seconds_per_fast_problem
             user_exercise.summative = exercise.summative
 
+            dt_last_activity = user_data.last_activity
             user_data.last_activity = user_exercise.last_done
             
             # If a non-admin tries to answer a problem out-of-order, just ignore it and
@@ -1202,11 +1143,15 @@ class RegisterAnswer(request_handler.RequestHandler):
             problem_log = ProblemLog()
             proficient = user_data.is_proficient_at(exid)
 
+            # Only badges that depend on what this answer changed need to be checked
+            badge_facts_changed = [BadgeFact.USER_EXERCISE, BadgeFact.PROBLEM_LOGS, BadgeFact.TENURE]
+
             if correct:
                 suggested = user_data.is_suggested(exid)
                 points_possible = points.ExercisePointCalculator(exercise, user_exercise, suggested, proficient)
                 problem_log.points_earned = points_possible
                 user_data.add_points(points_possible)
+                badge_facts_changed.append(BadgeFact.POINTS)
             
             problem_log.user = user
             problem_log.exercise = exid
@@ -1233,20 +1178,31 @@ class RegisterAnswer(request_handler.RequestHandler):
                     user_exercise.proficient_date = datetime.datetime.now()                    
                     user_data.reassess_if_necessary()
                     problem_log.earned_proficiency = True
+                    badge_facts_changed.append(BadgeFact.PROFICIENCY)
             else:
                 # Just in case RegisterCorrectness didn't get called.
                 user_exercise.reset_streak()
 
-            util_badges.update_with_user_exercise(
-                user, 
-                user_data, 
-                user_exercise, 
-                include_other_badges = True, 
-                action_cache=last_action_cache.LastActionCache.get_cache_and_push_problem_log(user, problem_log))
-
             user_exercise.clear_memcache()
+
             db.put([user_data, problem_log, user_exercise])
 
+            # Evaluate badges in the background when possible, only the ProblemLog,
+            # streak and points need to be saved before the user sees the next problem.
+            if not (problem_log_queue.ENABLED and problem_log_queue.enqueue(user, problem_log, user_exercise, badge_facts_changed, dt_last_activity)):
+                activity_summary.add_problem_log_delta(problem_log, dt_last_activity)
+
+                awarded = util_badges.update_with_user_exercise(
+                    user, 
+                    user_data, 
+                    user_exercise, 
+                    include_other_badges = True, 
+                    action_cache=last_action_cache.LastActionCache.get_cache_and_push_problem_log(user, problem_log),
+                    facts_changed = badge_facts_changed)
+
+                if awarded:
+                    user_data.put()
+
             self.redirect_via_refresh_if_webkit("/exercises?exid=%s" % exid)
         else:
             # Redirect to display the problem again which requires authentication
@@ -1271,6 +1227,9 @@ class RegisterCorrectness(request_handler.RequestHandler):
             correct = int(self.request.get('correct'))
             hint_used = self.request_bool('hint_used', default=False)
             user_exercise = db.get(key)
+            if user_exercise is None:
+                # Moved by backfill.user_exercise_reparent_map, RegisterAnswer will redirect
+                return
 
             user_exercise.schedule_review(correct == 1, self.get_time())
             if correct == 0:
@@ -1299,6 +1258,9 @@ class ResetStreak(request_handler.RequestHandler):
         if user:
             key = self.request.get('key')
             userExercise = db.get(key)
+            if userExercise is None:
+                # Moved by backfill.user_exercise_reparent_map, RegisterAnswer will redirect
+                return
             userExercise.reset_streak()
             userExercise.put()
         else:
@@ -1484,7 +1446,9 @@ class GenerateLibraryContent(request_handler.RequestHandler):
 
 @layer_cache.cache_with_key_fxn(
         lambda *args, **kwargs: "library_content_html_%s" % Setting.cached_library_content_date(),
-        persist_across_app_versions = True
+        persist_across_app_versions = True,
+        single_flight = True,
+        stale_key_fxn = lambda *args, **kwargs: "library_content_html"
         ) 
 def library_content_html(bust_cache = False):
 
@@ -2075,8 +2039,8 @@ class Search(request_handler.RequestHandler):
             self.render_template("searchresults.html", template_values)
             return
         searched_phrases = []
-        playlists = Playlist.search(query, limit=50, searched_phrases_out=searched_phrases)
-        videos = Video.search(query, limit=50, searched_phrases_out=searched_phrases)
+        playlists = search_index.get_playlists_index().search(query, limit=50, searched_phrases_out=searched_phrases)
+        videos = search_index.get_videos_index().search(query, limit=50)
         template_values.update({
                            'playlists': playlists,
                            'videos': videos,
@@ -2169,9 +2133,18 @@ def real_main():
         ('/admin/fixplaylistref', FixPlaylistRef),
         ('/admin/deletestaleplaylists', DeleteStalePlaylists),
         ('/admin/startnewbadgemapreduce', util_badges.StartNewBadgeMapReduce),
+        ('/admin/startnewbadgecountmapreduce', util_badges.StartNewBadgeCountMapReduce),
+        ('/admin/reconcilebadgecounts', util_badges.ReconcileBadgeCounts),
         ('/admin/startnewexercisestatisticsmapreduce', exercise_statistics.StartNewExerciseStatisticsMapReduce),
         ('/admin/backfill', backfill.StartNewBackfillMapReduce),
+        ('/admin/rekeyuserdata', backfill.StartNewUserDataRekeyMapReduce),
+        ('/admin/reparentuserexercises', backfill.StartNewUserExerciseReparentMapReduce),
+        ('/admin/encodedailyactivitylogs', backfill.StartNewDailyActivityLogEncodingMapReduce),
         ('/admin/dailyactivitylog', activity_summary.StartNewDailyActivityLogMapReduce),
+        ('/admin/compactdailyactivitylogs', activity_summary.CompactDailyActivityLogs),
+        ('/admin/problemlogqueue', problem_log_queue.ProcessProblemLogQueue),
+        ('/admin/videoprogressqueue', video_progress_queue.ProcessVideoProgressQueue),
+        ('/admin/lastactioncachesnapshots', last_action_cache.WriteLastActionCacheSnapshots),
 
         ('/coaches', coaches.ViewCoaches),
         ('/registercoach', coaches.RegisterCoach),  
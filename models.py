@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 import datetime, logging
 import math
+import heapq
 from google.appengine.api import users
 from google.appengine.api import memcache
 
 from google.appengine.ext import db
 import object_property
+import daily_activity_summary
 import cajole
 import app
 import util
@@ -15,27 +17,80 @@ import points
 from search import Searchable
 from app import App
 import layer_cache
+import cachepy
+import request_cache
 from discussion import models_discussion
 
 # Setting stores per-application key-value pairs
 # for app-wide settings that must be synchronized
 # across all GAE instances.
+#
+# Settings such as cached_exercises_date act as content versions
+# that are read while building cache keys on nearly every request,
+# so reads go through each instance's cachepy (for a few seconds)
+# and memcache before falling back to the datastore.
 class Setting(db.Model):
 
     value = db.StringProperty()
 
+    _CACHE_KEY_FORMAT = "Setting_%s"
+    _IN_APP_CACHE_SECONDS = 10 # How long other instances may keep using an old version after it changes
+    _MEMCACHE_SECONDS = 60 * 60
+    _MEMCACHE_LOCK_SECONDS = 10 # How long reads can't add a version to memcache after it changes
+
+    # Cached for settings that don't exist, since None means nothing is cached.
+    # Values are always strings, so it's never mistaken for one.
+    _MISSING = ()
+
     @staticmethod
     def get_or_set_with_key(key, val = None):
         if val is None:
-            setting = Setting.get_by_key_name(key)
-            if setting is not None:
-                return setting.value
-            return None
+            return Setting.get_cached(key)
         else:
-            setting = Setting.get_or_insert(key)
+            return Setting.set_cached(key, val)
+
+    @staticmethod
+    def get_cached(key):
+        cache_key = Setting._CACHE_KEY_FORMAT % key
+
+        value = cachepy.get(cache_key)
+        if value is None:
+            value = memcache.get(cache_key)
+            if value is None:
+                setting = Setting.get_by_key_name(key)
+                if setting is None:
+                    value = Setting._MISSING
+                else:
+                    value = setting.value
+                # Use add so we never clobber a version set by a concurrent write
+                memcache.add(cache_key, value, time=Setting._MEMCACHE_SECONDS)
+
+            cachepy.set(cache_key, value, expiry=Setting._IN_APP_CACHE_SECONDS)
+
+        if value == Setting._MISSING:
+            return None
+        return value
+
+    @staticmethod
+    def set_cached(key, val):
+        def txn():
+            setting = Setting.get_by_key_name(key)
+            if setting is None:
+                setting = Setting(key_name=key)
             setting.value = str(val)
             setting.put()
             return setting.value
+        value = db.run_in_transaction(txn)
+
+        # Two concurrent bumps could finish their memcache sets in the opposite order of
+        # their transactions and leave the older version in memcache, so delete it instead.
+        # A read that got the old version from the datastore before the put could still
+        # add it back after the delete, so keep adds out for a few seconds.
+        cache_key = Setting._CACHE_KEY_FORMAT % key
+        memcache.delete(cache_key, seconds=Setting._MEMCACHE_LOCK_SECONDS)
+        cachepy.set(cache_key, value, expiry=Setting._IN_APP_CACHE_SECONDS)
+
+        return value
 
     @staticmethod
     def cached_library_content_date(val = None):
@@ -45,6 +100,14 @@ class Setting(db.Model):
     def cached_exercises_date(val = None):
         return Setting.get_or_set_with_key("cached_exercises_date", val)
 
+    @staticmethod
+    def last_daily_activity_compaction(val = None):
+        return Setting.get_or_set_with_key("last_daily_activity_compaction", val)
+
+    @staticmethod
+    def badge_counts_reconciled(val = None):
+        return Setting.get_or_set_with_key("badge_counts_reconciled", val)
+
     @staticmethod
     def count_videos(val = None):
         return Setting.get_or_set_with_key("count_videos", val) or 0
@@ -147,12 +210,32 @@ class Exercise(db.Model):
         query.filter('exercise =', self.key())
         return query
 
-    @layer_cache.cache_with_key_fxn(lambda self: "related_videos_%s" % self.key(), layer=layer_cache.SINGLE_LAYER_MEMCACHE_ONLY)
     def related_videos_fetch(self):
-        exercise_videos = self.related_videos().fetch(10)
-        for exercise_video in exercise_videos:
-            exercise_video.video # Pre-cache video entity
-        return exercise_videos
+        return Exercise.related_videos_fetch_multi([self])[0]
+
+    @staticmethod
+    @layer_cache.cache_with_key_fxn_multi(lambda exercise: "related_videos_%s" % exercise.key(), layer=layer_cache.SINGLE_LAYER_MEMCACHE_ONLY)
+    def related_videos_fetch_multi(exercises):
+        list_exercise_videos = [exercise.related_videos().fetch(10) for exercise in exercises]
+
+        # Pre-cache all video entities with a single batch get
+        video_keys = []
+        for exercise_videos in list_exercise_videos:
+            for exercise_video in exercise_videos:
+                video_keys.append(exercise_video.key_for_video())
+
+        videos = {}
+        for video in db.get(video_keys):
+            if video:
+                videos[video.key()] = video
+
+        for exercise_videos in list_exercise_videos:
+            for exercise_video in exercise_videos:
+                video = videos.get(exercise_video.key_for_video())
+                if video:
+                    exercise_video.video = video
+
+        return list_exercise_videos
 
     _CURRENT_SANITIZER = "http://caja.appspot.com/"
     def ensure_sanitized(self):
@@ -168,13 +251,21 @@ class Exercise(db.Model):
         self.put()
     
     @staticmethod
-    @layer_cache.cache_with_key_fxn(lambda *args, **kwargs: "all_exercises_%s" % Setting.cached_exercises_date())
+    @layer_cache.cache_with_key_fxn(
+            lambda *args, **kwargs: "all_exercises_%s" % Setting.cached_exercises_date(),
+            single_flight = True,
+            stale_key_fxn = lambda *args, **kwargs: "all_exercises"
+            )
     def get_all_use_cache():
         query = Exercise.all().order('h_position')
         return query.fetch(200)
 
     @staticmethod
-    @layer_cache.cache_with_key_fxn(lambda *args, **kwargs: "all_exercises_dict_%s" % Setting.cached_exercises_date())
+    @layer_cache.cache_with_key_fxn(
+            lambda *args, **kwargs: "all_exercises_dict_%s" % Setting.cached_exercises_date(),
+            single_flight = True,
+            stale_key_fxn = lambda *args, **kwargs: "all_exercises_dict"
+            )
     def get_dict_use_cache():
         exercises = Exercise.get_all_use_cache()
         dict_exercises = {}
@@ -219,6 +310,7 @@ class UserExercise(db.Model):
         return UserExercise._USER_EXERCISE_KEY_FORMAT % user.email()
 
     @staticmethod
+    @request_cache.cache_with_key_fxn(lambda user: UserExercise.get_key_for_user(user))
     def get_for_user_use_cache(user):
         user_exercises_key = UserExercise.get_key_for_user(user)
         user_exercises = memcache.get(user_exercises_key)
@@ -229,8 +321,24 @@ class UserExercise(db.Model):
             memcache.set(user_exercises_key, user_exercises)
         return user_exercises
 
+    @staticmethod
+    @layer_cache.cache_with_key_fxn_multi(
+            lambda user: UserExercise.get_key_for_user(user),
+            layer=layer_cache.SINGLE_LAYER_MEMCACHE_ONLY,
+            persist_across_app_versions=True)
+    def get_for_users_use_cache(users):
+        # Same cache entries as get_for_user_use_cache, but fetched for many users with one memcache round trip
+        list_user_exercises = []
+        for user in users:
+            query = UserExercise.all()
+            query.filter('user =', user)
+            list_user_exercises.append(query.fetch(1000))
+        return list_user_exercises
+
     def clear_memcache(self):
         memcache.delete(UserExercise.get_key_for_user(self.user))
+        request_cache.delete(UserExercise.get_key_for_user(self.user))
+        ExerciseGraph.clear_request_cache(self.user)
     
     def put(self):
         self.clear_memcache()
@@ -298,12 +406,12 @@ class UserExercise(db.Model):
         if proficient:
             if self.exercise not in user_data.proficient_exercises:
                     user_data.proficient_exercises.append(self.exercise)
-                    user_data.need_to_reassess = True
+                    user_data.mark_need_to_reassess(self.exercise)
                     user_data.put()
         else:
             if self.exercise in user_data.proficient_exercises:
                     user_data.proficient_exercises.remove(self.exercise)
-                    user_data.need_to_reassess = True
+                    user_data.mark_need_to_reassess(self.exercise)
                     user_data.put()
 
 class UserData(db.Model):
@@ -318,6 +426,7 @@ class UserData(db.Model):
     assigned_exercises = db.StringListProperty()
     badges = db.StringListProperty() # All awarded badges
     need_to_reassess = db.BooleanProperty()
+    assessment_version = db.StringProperty() # See get_assessment_version
     points = db.IntegerProperty()
     total_seconds_watched = db.IntegerProperty(default = 0)
     coaches = db.StringListProperty()
@@ -337,12 +446,33 @@ class UserData(db.Model):
                 return user_data
         return UserData()
 
+    _REQUEST_CACHE_KEY_FORMAT = "UserData.get_for_%s"
+
+    @staticmethod
+    def get_request_cache_key(user):
+        return UserData._REQUEST_CACHE_KEY_FORMAT % (user.email() if user else None)
+
+    @staticmethod
+    def get_key_name(user):
+        return "user_email_key_%s" % user.email()
+
     @staticmethod    
+    @request_cache.cache_with_key_fxn(lambda user: UserData.get_request_cache_key(user))
     def get_for(user):
-        query = UserData.all()
-        query.filter('user =', user)
-        query.order('-points') # Temporary workaround for issue 289
-        return query.get()
+        if user is None:
+            return None
+
+        user_data = UserData.get_by_key_name(UserData.get_key_name(user))
+        if user_data is None:
+            # There are some old entities lying around that aren't keyed by email.
+            # We have to check for them here, but once backfill.user_data_rekey_map has
+            # rekeyed all legacy entities, this can just be the get_by_key_name above.
+            request_cache.increment("user_data_queries")
+            query = UserData.all()
+            query.filter('user =', user)
+            query.order('-points') # Temporary workaround for issue 289
+            user_data = query.get()
+        return user_data
     
     @staticmethod    
     def get_or_insert_for(user):
@@ -351,7 +481,7 @@ class UserData(db.Model):
         user_data = UserData.get_for(user)
         if user_data is None:
             user_data = UserData.get_or_insert(
-                key_name=user.nickname(),
+                key_name=UserData.get_key_name(user),
                 user=user,
                 moderator=False,
                 last_login=datetime.datetime.now(),
@@ -362,6 +492,7 @@ class UserData(db.Model):
                 points=0,
                 coaches=[]
                 )
+            request_cache.set(UserData.get_request_cache_key(user), user_data)
         return user_data
 
     def get_or_insert_exercise(self, exercise):
@@ -371,7 +502,8 @@ class UserData(db.Model):
 
         if not userExercise:
             # There are some old entities lying around that don't have keys.
-            # We have to check for them here, but once we have reparented and rekeyed legacy entities,
+            # We have to check for them here, but once backfill.user_data_rekey_map and
+            # backfill.user_exercise_reparent_map have reparented and rekeyed legacy entities,
             # this entire function can just be a call to .get_or_insert()
             query = UserExercise.all()
             query.filter('user =', self.user)
@@ -407,12 +539,65 @@ class UserData(db.Model):
         self.all_proficient_exercises = all_proficient_exercises
         self.suggested_exercises = suggested_exercises
         self.need_to_reassess = False
+        self.assessment_version = UserData.get_assessment_version(ex_graph.topology, ex_graph.user_exercises.values())
         return is_changed
+
+    # Besides explicit proficiency, all_proficient_exercises and suggested_exercises
+    # depend on the exercises and on which of them the user has ever missed a problem in.
+    # The version records both as of the last reassessment, so reassess_incrementally
+    # can tell whether the stored lists are still a correct starting point.
+    # Once missed, an exercise stays missed, so counting them is enough.
+    @staticmethod
+    def get_assessment_version(topology, user_exercises):
+        missed = set()
+        for user_exercise in user_exercises:
+            ix = topology.index_by_name.get(user_exercise.exercise)
+            if ix is not None and user_exercise.streak != user_exercise.total_done:
+                missed.add(ix)
+        return "%s:%s" % (Setting.cached_exercises_date(), len(missed))
     
+    def mark_need_to_reassess(self, exid):
+        # If exid is the only exercise whose explicit proficiency changed since the last
+        # assessment, remember it for this request so reassess_if_necessary can
+        # reassess incrementally instead of rebuilding the whole ExerciseGraph.
+        if self.need_to_reassess:
+            self.reassess_exid = None
+        else:
+            self.reassess_exid = exid
+        self.need_to_reassess = True
+
+    def reassess_incrementally(self, exid, user=None):
+        if user is None:
+            user = util.get_current_user()
+
+        topology = ExerciseGraphTopology.get_use_cache()
+        user_exercises = UserExercise.get_for_user_use_cache(user)
+
+        # Only build on the stored lists if nothing else they depend on changed since they were assessed
+        assessment_version = UserData.get_assessment_version(topology, user_exercises)
+        reassessment = None
+        if self.assessment_version == assessment_version:
+            reassessment = ExerciseGraph.reassess_incrementally(topology, self, user_exercises, exid)
+
+        if reassessment is None:
+            return self.reassess_from_graph(ExerciseGraph.get_for(self, user))
+
+        is_changed = (reassessment["all_proficient_exercises"] != self.all_proficient_exercises or
+                      reassessment["suggested_exercises"] != self.suggested_exercises)
+        self.all_proficient_exercises = reassessment["all_proficient_exercises"]
+        self.suggested_exercises = reassessment["suggested_exercises"]
+        self.need_to_reassess = False
+        self.assessment_version = assessment_version
+        return is_changed
+
     def reassess_if_necessary(self, user=None):
         if not self.need_to_reassess or self.all_proficient_exercises is None:
             return False
-        ex_graph = ExerciseGraph(self, user)
+        exid = getattr(self, "reassess_exid", None)
+        self.reassess_exid = None
+        if exid:
+            return self.reassess_incrementally(exid, user)
+        ex_graph = ExerciseGraph.get_for(self, user)
         return self.reassess_from_graph(ex_graph)
         
     def is_proficient_at(self, exid, user=None):
@@ -432,7 +617,7 @@ class UserData(db.Model):
         if user_exercise.last_review + user_exercise.get_review_interval() > time:
             return False
 
-        ex_graph = ExerciseGraph(self)
+        ex_graph = ExerciseGraph.get_for(self)
         review_exercise_names = map(lambda exercise: exercise.name, ex_graph.get_review_exercises(time))
         return (exid in review_exercise_names)
 
@@ -440,8 +625,33 @@ class UserData(db.Model):
         self.reassess_if_necessary()
         return (exid in self.suggested_exercises)
 
-    def get_students_data(self):
-        coach_email = self.user.email()   
+    # Each coach's roster of students is kept in memcache as a list of
+    # (UserData key, email) pairs so class pages don't have to query every
+    # UserData that lists the coach (twice, for mixed case coach emails).
+    # RegisterCoach and UnregisterCoach clear the roster of the coach they change.
+    #
+    # The class's total points are kept next to it and incremented by add_points,
+    # so the live class points poll is a single memcache read.
+
+    _ROSTER_KEY_FORMAT = "coach_roster_%s"
+    _ROSTER_POINTS_KEY_FORMAT = "coach_roster_points_%s"
+    _ROSTER_SECONDS = 60 * 60 * 24
+    _ROSTER_POINTS_SECONDS = 60 * 10 # Rebuilt every so often in case an increment was missed
+
+    @staticmethod
+    def get_roster_key(coach_email):
+        return UserData._ROSTER_KEY_FORMAT % coach_email.lower()
+
+    @staticmethod
+    def get_roster_points_key(coach_email):
+        return UserData._ROSTER_POINTS_KEY_FORMAT % coach_email.lower()
+
+    @staticmethod
+    def clear_roster_memcache_for(coach_email):
+        memcache.delete_multi([UserData.get_roster_key(coach_email), UserData.get_roster_points_key(coach_email)])
+
+    @staticmethod
+    def query_students_data(coach_email):
         query = db.GqlQuery("SELECT * FROM UserData WHERE coaches = :1", coach_email)
         students_data = []
         for student_data in query:
@@ -453,15 +663,89 @@ class UserData(db.Model):
         	    if student_data.key().id_or_name() not in students_set:
         		    students_data.append(student_data)
         return students_data
-   
+
+    def set_roster(self, students_data):
+        roster = map(lambda student_data: (str(student_data.key()), student_data.user.email()), students_data)
+        memcache.set(UserData.get_roster_key(self.user.email()), roster, time=UserData._ROSTER_SECONDS)
+        return roster
+
+    def get_students_data(self):
+        roster = memcache.get(UserData.get_roster_key(self.user.email()))
+        if roster is None:
+            students_data = UserData.query_students_data(self.user.email())
+            self.set_roster(students_data)
+            return students_data
+
+        coach_emails = [self.user.email(), self.user.email().lower()]
+        students_data = db.get(map(lambda (key, email): key, roster))
+        for student_data in students_data:
+            if student_data is None or (coach_emails[0] not in student_data.coaches and coach_emails[1] not in student_data.coaches):
+                # A student was deleted, rekeyed or had their coaches changed without going
+                # through RegisterCoach or UnregisterCoach, so the roster may be missing
+                # students too. Rebuild it.
+                students_data = UserData.query_students_data(self.user.email())
+                self.set_roster(students_data)
+                break
+        return students_data
+
     def get_students(self):
+        # Checked against the datastore like get_students_data, since a stale roster
+        # would list the wrong students until it expires
         return map(lambda student_data: student_data.user.email(), self.get_students_data())
 
+    def get_class_points(self):
+        points_key = UserData.get_roster_points_key(self.user.email())
+        points = memcache.get(points_key)
+        if points is None:
+            points = 0
+            for student_data in self.get_students_data():
+                points += student_data.points or 0
+            # Use add so we never clobber increments made since we loaded the students
+            memcache.add(points_key, points, time=UserData._ROSTER_POINTS_SECONDS)
+        return points
+
     def add_points(self, points):
         if self.points == None:
             self.points = 0
         self.points += points
 
+        # Keep the class points of each of this user's coaches up to date
+        if points > 0:
+            for coach_email in self.coaches:
+                memcache.incr(UserData.get_roster_points_key(coach_email), delta=points)
+
+    # Background tasks read a UserData, change it and then have to save it without
+    # overwriting whatever the user's own requests saved in the meantime.
+    # put_in_transaction re-reads the UserData in a transaction, applies
+    # update_fxn to the fresh copy, puts it and returns it.
+    def put_in_transaction(self, update_fxn):
+        key = self.key()
+        def txn():
+            user_data = UserData.get(key)
+            update_fxn(user_data)
+            user_data.put()
+            return user_data
+        return db.run_in_transaction(txn)
+
+    # Returns what add_awards_to needs to tell which badges and points were awarded after this call
+    def get_awards_snapshot(self):
+        return (list(self.badges or []), self.points or 0)
+
+    # Adds the badges and points awarded to this copy since get_awards_snapshot
+    # to user_data, a fresher copy of the same UserData
+    def add_awards_to(self, user_data, awards_snapshot):
+        badges_before, points_before = awards_snapshot
+
+        for badge_name in self.badges or []:
+            if badge_name not in badges_before:
+                if user_data.badges is None:
+                    user_data.badges = []
+                if badge_name not in user_data.badges:
+                    user_data.badges.append(badge_name)
+
+        # add_points has already updated the coaches' class points
+        user_data.points = (user_data.points or 0) + (self.points or 0) - points_before
+
     def get_videos_completed(self):
         if self.videos_completed < 0:
             self.videos_completed = UserVideo.count_completed_for_user(self.user)
@@ -575,6 +859,30 @@ class UserPlaylist(db.Model):
         else:
             return UserPlaylist.get_by_key_name(key)
 
+    @staticmethod
+    def get_for_playlists_and_user(playlists, user, insert_if_missing=False):
+        # Batched get_for_playlist_and_user. Missing UserPlaylists are created
+        # but not put when insert_if_missing is set, so callers can put them
+        # along with everything else they're saving.
+
+        if not user:
+            return []
+
+        key_names = [UserPlaylist.get_key_name(playlist, user) for playlist in playlists]
+        user_playlists = UserPlaylist.get_by_key_name(key_names)
+
+        if insert_if_missing:
+            for ix in range(len(user_playlists)):
+                if user_playlists[ix] is None:
+                    user_playlists[ix] = UserPlaylist(
+                                key_name = key_names[ix],
+                                user = user,
+                                playlist = playlists[ix])
+        else:
+            user_playlists = filter(lambda user_playlist: user_playlist is not None, user_playlists)
+
+        return user_playlists
+
 class UserVideo(db.Model):
 
     @staticmethod
@@ -669,7 +977,7 @@ class VideoLog(db.Model):
 class DailyActivityLog(db.Model):
     user = db.UserProperty()
     date = db.DateTimeProperty()
-    activity_summary = object_property.ObjectProperty()
+    activity_summary = object_property.EncodedObjectProperty(daily_activity_summary.encode, daily_activity_summary.decode)
 
     @staticmethod
     def get_key_name(user, date):
@@ -746,7 +1054,7 @@ class VideoPlaylist(db.Model):
     live_association = db.BooleanProperty(default = False)  #So we can remove associations without deleting the entry.  We need this so that bulkuploading of VideoPlaylist info has the proper effect.
 
     _VIDEO_PLAYLIST_KEY_FORMAT = "VideoPlaylist_Videos_for_Playlist_%s"
-    _PLAYLIST_VIDEO_KEY_FORMAT = "VideoPlaylist_Playlists_for_Video_%s"
+    _PLAYLIST_VIDEO_KEY_FORMAT = "VideoPlaylist_Playlists_for_Video_%s_%s"
 
     @staticmethod
     def get_cached_videos_for_playlist(playlist, limit=500):
@@ -773,7 +1081,7 @@ class VideoPlaylist(db.Model):
     @staticmethod
     def get_cached_playlists_for_video(video, limit=5):
 
-        key = VideoPlaylist._PLAYLIST_VIDEO_KEY_FORMAT % video.key()
+        key = VideoPlaylist._PLAYLIST_VIDEO_KEY_FORMAT % (video.key(), limit)
         namespace = str(App.version) + "_" + str(Setting.cached_library_content_date())
 
         playlists = memcache.get(key, namespace=namespace)
@@ -821,89 +1129,335 @@ class ExercisePlaylist(db.Model):
     exercise = db.ReferenceProperty(Exercise)
     playlist = db.ReferenceProperty(Playlist)
 
+# The shape of the exercise DAG, which is the same for every user.
+# It is built once per exercises version and shared through cachepy,
+# so it must never hold any per-user state.
+class ExerciseGraphTopology(object):
+
+    def __init__(self, exercises):
+        self.exercises = exercises
+        self.index_by_name = {}
+        for ix, ex in enumerate(exercises):
+            self.index_by_name[ex.name] = ix
+
+        # Adjacency lists of exercise indexes
+        self.covers = []
+        self.coverers = [[] for ex in exercises]
+        self.prerequisites = []
+        for ix, ex in enumerate(exercises):
+            covers = self.indexes_for_names(ex.covers)
+            for covered_ix in covers:
+                self.coverers[covered_ix].append(ix)
+            self.covers.append(covers)
+            self.prerequisites.append(self.indexes_for_names(ex.prerequisites))
+
+        # Reverse of the prerequisites lists
+        self.prerequisite_of = [[] for ex in exercises]
+        for ix, prerequisites in enumerate(self.prerequisites):
+            for prereq_ix in prerequisites:
+                self.prerequisite_of[prereq_ix].append(ix)
+
+        self.summative = [ex.summative for ex in exercises]
+        self.topological_order = self.compute_topological_order()
+        self.topological_position = [0] * len(exercises)
+        for position, ix in enumerate(self.topological_order):
+            self.topological_position[ix] = position
+
+    def indexes_for_names(self, names):
+        indexes = []
+        for name in names:
+            ix = self.index_by_name.get(name)
+            if ix is not None:
+                indexes.append(ix)
+        return indexes
+
+    def compute_topological_order(self):
+        # Every exercise comes after all of its coverers
+        count_coverers_left = map(len, self.coverers)
+        order = [ix for ix in range(len(self.exercises)) if not count_coverers_left[ix]]
+        i = 0
+        while i < len(order):
+            for covered_ix in self.covers[order[i]]:
+                count_coverers_left[covered_ix] -= 1
+                if not count_coverers_left[covered_ix]:
+                    order.append(covered_ix)
+            i += 1
+
+        if len(order) < len(self.exercises):
+            # Exercises in a covering cycle don't have a proper order, keep them in their original one
+            logging.error("Exercise covering cycle found")
+            ordered = set(order)
+            order.extend([ix for ix in range(len(self.exercises)) if ix not in ordered])
+
+        return order
+
+    @staticmethod
+    @layer_cache.cache_with_key_fxn(
+            lambda *args, **kwargs: "exercise_graph_topology_%s" % Setting.cached_exercises_date(),
+            layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY
+            )
+    def get_use_cache():
+        return ExerciseGraphTopology(Exercise.get_all_use_cache())
+
+# A single user's view of an exercise in an ExerciseGraph.
+# Anything that isn't specific to the user is read
+# from the shared Exercise model, which is never modified.
+class ExerciseGraphNode(object):
+
+    _GRAPH_ATTRIBUTES = set(["proficient", "suggested", "assigned", "next_review", "is_review_candidate", "is_ancestor_review_candidate"])
+
+    def __init__(self, graph, ix):
+        self.graph = graph
+        self.index = ix
+        self.exercise = graph.topology.exercises[ix]
+
+        user_exercise = graph.user_exercises.get(ix)
+        self.user_exercise = user_exercise
+        self.streak = 0
+        self.longest_streak = 0
+        self.total_done = 0
+        if user_exercise:
+            self.streak = user_exercise.streak
+            self.longest_streak = user_exercise.longest_streak
+            self.total_done = user_exercise.total_done
+            self.last_done = user_exercise.last_done
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name == "points":
+            # Only calculated for the nodes that get displayed
+            self.points = points.ExercisePointCalculator(self, self, self.suggested, self.proficient)
+            return self.points
+        if name in ExerciseGraphNode._GRAPH_ATTRIBUTES:
+            return getattr(self.graph, name)[self.index]
+        return getattr(self.exercise, name)
+
+    @property
+    def coverers(self):
+        return self.graph.get_nodes(self.graph.topology.coverers[self.index])
+
+    @property
+    def prerequisites_ex(self):
+        return self.graph.get_nodes(self.graph.topology.prerequisites[self.index])
+
+# A user's progress through the exercise DAG.
+# Per-user state is kept in lists indexed like the shared
+# ExerciseGraphTopology's exercises, and the ExerciseGraphNodes
+# handed out for display are only created when asked for.
 class ExerciseGraph(object):
 
+    _REQUEST_CACHE_KEY_FORMAT = "ExerciseGraph_%s"
+
     def __init__(self, user_data, user=None):
         if user is None:
             user = util.get_current_user()
+        request_cache.increment("exercise_graph_builds")
         user_exercises = UserExercise.get_for_user_use_cache(user)
-        exercises = Exercise.get_all_use_cache()
-        self.exercises = exercises
-        self.exercise_by_name = {}        
-        for ex in exercises:
-            self.exercise_by_name[ex.name] = ex
-            ex.coverers = []
-            ex.user_exercise = None
-            ex.next_review = None  # Not set initially
-            ex.is_review_candidate = False
-            ex.is_ancestor_review_candidate = None  # Not set initially
-            ex.proficient = None # Not set initially
-            ex.suggested = None # Not set initially
-            ex.assigned = False
-            ex.streak = 0
-            ex.longest_streak = 0
-            ex.total_done = 0
-        for name in user_data.proficient_exercises:
-            ex = self.exercise_by_name.get(name)
-            if ex:
-                ex.proficient = True
-        for name in user_data.assigned_exercises:
-            ex = self.exercise_by_name.get(name)
-            if ex:
-                ex.assigned = True
-        for ex in exercises:
-            for covered in ex.covers:
-                self.exercise_by_name[covered].coverers.append(ex)
-            ex.prerequisites_ex = []
-            for prereq in ex.prerequisites:
-                ex.prerequisites_ex.append(self.exercise_by_name[prereq])
+
+        self.topology = topology = ExerciseGraphTopology.get_use_cache()
+        self.nodes = {}
+
+        c_exercises = len(topology.exercises)
+        self.proficient = [None] * c_exercises # Not set initially
+        self.suggested = [None] * c_exercises # Not set initially
+        self.assigned = [False] * c_exercises
+        self.next_review = [None] * c_exercises # Not set initially
+        self.is_review_candidate = [False] * c_exercises
+        self.is_ancestor_review_candidate = [None] * c_exercises # Not set initially
+
+        for ix in topology.indexes_for_names(user_data.proficient_exercises):
+            self.proficient[ix] = True
+        for ix in topology.indexes_for_names(user_data.assigned_exercises):
+            self.assigned[ix] = True
+
+        self.user_exercises = {}
         for user_ex in user_exercises:
-            ex = self.exercise_by_name.get(user_ex.exercise)
-            if ex:
-                ex.user_exercise = user_ex
-                ex.streak = user_ex.streak
-                ex.longest_streak = user_ex.longest_streak
-                ex.total_done = user_ex.total_done
-                ex.last_done = user_ex.last_done
-
-        def compute_proficient(ex):
-            # Consider an exercise proficient if it is explicitly proficient or
-            # the user has never missed a problem and a covering ancestor is proficient
-            if ex.proficient is not None:
-                return ex.proficient
-            ex.proficient = False
-            if ex.streak == ex.total_done:
-                for c in ex.coverers:
-                    if compute_proficient(c) is True:
-                        ex.proficient = True
+            ix = topology.index_by_name.get(user_ex.exercise)
+            if ix is not None:
+                self.user_exercises[ix] = user_ex
+
+        self.compute_proficient()
+        self.compute_suggested()
+
+    # The computations below are single passes over the topological order,
+    # in which every exercise comes after all of its covering ancestors,
+    # so their values are always ready when an exercise needs them.
+
+    def compute_proficient(self):
+        # Consider an exercise proficient if it is explicitly proficient or
+        # the user has never missed a problem and a covering ancestor is proficient
+        proficient = self.proficient
+        coverers = self.topology.coverers
+
+        never_missed = [True] * len(proficient)
+        for ix, user_exercise in self.user_exercises.iteritems():
+            never_missed[ix] = (user_exercise.streak == user_exercise.total_done)
+
+        for ix in self.topology.topological_order:
+            if proficient[ix] is None:
+                proficient[ix] = False
+                if never_missed[ix]:
+                    for c in coverers[ix]:
+                        if proficient[c]:
+                            proficient[ix] = True
+                            break
+
+    def compute_suggested(self):
+        # Suggest exercises the user isn't proficient at yet but is proficient in all prereqs of,
+        # unless they are covered by another suggested exercise
+        proficient = self.proficient
+        suggested = self.suggested
+        coverers = self.topology.coverers
+        prerequisites = self.topology.prerequisites
+
+        for ix in self.topology.topological_order:
+            if proficient[ix]:
+                suggested[ix] = False
+                continue
+            suggested[ix] = True
+            for c in coverers[ix]:
+                if suggested[c]:
+                    suggested[ix] = False
+                    break
+            else:
+                for prereq in prerequisites[ix]:
+                    if not proficient[prereq]:
+                        suggested[ix] = False
                         break
-            return ex.proficient
-
-        for ex in exercises:
-            compute_proficient(ex)
-            
-        def compute_suggested(ex):
-            if ex.suggested is not None:
-                return ex.suggested
-            if ex.proficient is True:
-                ex.suggested = False
-                return ex.suggested
-            ex.suggested = True
-            # Don't suggest exs that are covered by suggested exs
-            for c in ex.coverers:
-                if compute_suggested(c) is True:
-                    ex.suggested = False
-                    return ex.suggested
-            # Don't suggest exs if the user isn't proficient in all prereqs
-            for prereq in ex.prerequisites_ex:
-                if not prereq.proficient:
-                    ex.suggested = False
-                    break            
-            return ex.suggested 
-            
-        for ex in exercises:
-            compute_suggested(ex)
-            ex.points = points.ExercisePointCalculator(ex, ex, ex.suggested, ex.proficient)            
+
+    @staticmethod
+    def get_for(user_data, user=None):
+        # Reuse the graph already built for this user during the current request,
+        # as long as the user's proficient and assigned exercises haven't changed since.
+        # Saving one of the user's UserExercises clears it (see UserExercise.clear_memcache).
+        if user is None:
+            user = util.get_current_user()
+
+        key = ExerciseGraph._REQUEST_CACHE_KEY_FORMAT % user.email()
+        graphs = request_cache.get(key)
+        if graphs is None:
+            graphs = request_cache.set(key, {})
+
+        user_state = (tuple(user_data.proficient_exercises), tuple(user_data.assigned_exercises))
+        ex_graph = graphs.get(user_state)
+        if ex_graph is None:
+            ex_graph = graphs[user_state] = ExerciseGraph(user_data, user)
+        return ex_graph
+
+    @staticmethod
+    def reassess_incrementally(topology, user_data, user_exercises, exid):
+        # Recompute the user's proficient and suggested exercises after exid's explicit
+        # proficiency changed, assuming user_data's all_proficient_exercises and
+        # suggested_exercises were up to date before that change.
+        #
+        # Only exid and the exercises it covers (directly or not) can change proficiency,
+        # and only those and the exercises they are prerequisites of can change suggestion,
+        # so the DAG is walked outwards from exid in topological order and stops wherever
+        # nothing changed. Returns None if exid isn't a known exercise.
+        ix_changed = topology.index_by_name.get(exid)
+        if ix_changed is None:
+            return None
+
+        coverers = topology.coverers
+        covers = topology.covers
+        prerequisites = topology.prerequisites
+        position = topology.topological_position
+
+        explicitly_proficient = set(topology.indexes_for_names(user_data.proficient_exercises))
+        proficient = set(topology.indexes_for_names(user_data.all_proficient_exercises))
+        suggested = set(topology.indexes_for_names(user_data.suggested_exercises))
+        proficient_before = set(proficient)
+        suggested_before = set(suggested)
+
+        never_missed = {}
+        for user_exercise in user_exercises:
+            ix = topology.index_by_name.get(user_exercise.exercise)
+            if ix is not None:
+                never_missed[ix] = (user_exercise.streak == user_exercise.total_done)
+
+        def walk(ixs_start, compute, values):
+            # Recompute values for ixs_start in topological order, following
+            # the exercises each changed one covers. Returns the changed exercises.
+            heap = [(position[ix], ix) for ix in ixs_start]
+            heapq.heapify(heap)
+            queued = set(ixs_start)
+            changed = []
+            while heap:
+                ix = heapq.heappop(heap)[1]
+                value = compute(ix)
+                if value != (ix in values):
+                    if value:
+                        values.add(ix)
+                    else:
+                        values.discard(ix)
+                    changed.append(ix)
+                    for covered_ix in covers[ix]:
+                        if covered_ix not in queued:
+                            queued.add(covered_ix)
+                            heapq.heappush(heap, (position[covered_ix], covered_ix))
+            return changed
+
+        def compute_proficient(ix):
+            if ix in explicitly_proficient:
+                return True
+            if never_missed.get(ix, True):
+                for c in coverers[ix]:
+                    if c in proficient:
+                        return True
+            return False
+
+        def compute_suggested(ix):
+            if ix in proficient:
+                return False
+            for c in coverers[ix]:
+                if c in suggested:
+                    return False
+            for prereq in prerequisites[ix]:
+                if prereq not in proficient:
+                    return False
+            return True
+
+        changed_proficient = walk([ix_changed], compute_proficient, proficient)
+
+        ixs_suggested_start = set(changed_proficient)
+        for ix in changed_proficient:
+            ixs_suggested_start.update(topology.prerequisite_of[ix])
+        walk(list(ixs_suggested_start), compute_suggested, suggested)
+
+        def names(ixs):
+            ixs = list(ixs)
+            ixs.sort()
+            return [topology.exercises[ix].name for ix in ixs]
+
+        return {
+                "all_proficient_exercises": names(proficient),
+                "suggested_exercises": names(suggested),
+                "proficient_added": names(proficient - proficient_before),
+                "proficient_removed": names(proficient_before - proficient),
+                "suggested_added": names(suggested - suggested_before),
+                "suggested_removed": names(suggested_before - suggested),
+                }
+
+    @staticmethod
+    def clear_request_cache(user):
+        request_cache.delete(ExerciseGraph._REQUEST_CACHE_KEY_FORMAT % user.email())
+
+    def get_node(self, ix):
+        node = self.nodes.get(ix)
+        if node is None:
+            node = self.nodes[ix] = ExerciseGraphNode(self, ix)
+        return node
+
+    def get_nodes(self, indexes):
+        return [self.get_node(ix) for ix in indexes]
+
+    def get_nodes_where(self, values):
+        return self.get_nodes([ix for ix in range(len(values)) if values[ix]])
+
+    @property
+    def exercises(self):
+        return self.get_nodes(range(len(self.topology.exercises)))
 
     def get_review_exercises(self, now):
 
@@ -914,79 +1468,67 @@ class ExerciseGraph(object):
 #   * None of ex's covering ancestors should be reviewed
 #   * The user is proficient at ex
 # The algorithm:
-#   For each exercise:
-#     traverse it's ancestors, computing and storing the next review time (if not already done), 
-#     using now as the next review time if proficient and streak==0
+#   For each exercise, in topological order (covering ancestors first):
+#     compute and store the next review time as the latest of its own and its coverers',
+#     using now as its own next review time if proficient and streak==0
 #   Select and mark the exercises in which the user is proficient but with next review times in the past as review candidates
-#   For each of those candidates:
-#     traverse it's ancestors, computing and storing whether an ancestor is also a candidate
+#   For each exercise, in topological order:
+#     compute and store whether a covering ancestor is also a candidate
 #   All exercises that are candidates but do not have ancestors as candidates should be listed for review
 
-        def compute_next_review(ex):
-            if ex.next_review is None:
-                ex.next_review = datetime.datetime.min
-                if ex.user_exercise is not None and ex.user_exercise.last_review > datetime.datetime.min:
-                    next_review = ex.user_exercise.last_review + ex.user_exercise.get_review_interval()
-                    if next_review > now and ex.proficient and ex.user_exercise.streak == 0:
-                        next_review = now
-                    if next_review > ex.next_review:
-                        ex.next_review = next_review
-                for c in ex.coverers:
-                    c_next_review = compute_next_review(c)
-                    if c_next_review > ex.next_review:
-                        ex.next_review = c_next_review
-            return ex.next_review
-
-        def compute_is_ancestor_review_candidate(rc):
-            if rc.is_ancestor_review_candidate is None:
-                rc.is_ancestor_review_candidate = False
-                for c in rc.coverers:
-                    rc.is_ancestor_review_candidate = rc.is_ancestor_review_candidate or c.is_review_candidate or compute_is_ancestor_review_candidate(c)
-            return rc.is_ancestor_review_candidate
-
-        for ex in self.exercises:
-            compute_next_review(ex)
-        review_candidates = []
-        for ex in self.exercises:
-            if not ex.summative and ex.proficient and ex.next_review <= now:
-                ex.is_review_candidate = True
-                review_candidates.append(ex)
-            else:
-                ex.is_review_candidate = False
+        topology = self.topology
+        coverers = topology.coverers
+        proficient = self.proficient
+        next_review = self.next_review
+        is_review_candidate = self.is_review_candidate
+        is_ancestor_review_candidate = self.is_ancestor_review_candidate
+
+        order = topology.topological_order
+        user_exercises = self.user_exercises
+
+        for ix in order:
+            ex_next_review = datetime.datetime.min
+            user_exercise = user_exercises.get(ix)
+            if user_exercise is not None and user_exercise.last_review > datetime.datetime.min:
+                ex_next_review = user_exercise.last_review + user_exercise.get_review_interval()
+                if ex_next_review > now and proficient[ix] and user_exercise.streak == 0:
+                    ex_next_review = now
+            for c in coverers[ix]:
+                if next_review[c] > ex_next_review:
+                    ex_next_review = next_review[c]
+            next_review[ix] = ex_next_review
+
+        for ix in order:
+            is_review_candidate[ix] = not topology.summative[ix] and bool(proficient[ix]) and next_review[ix] <= now
+
         review_exercises = []
-        for rc in review_candidates:
-            if not compute_is_ancestor_review_candidate(rc):
-                review_exercises.append(rc)
-        return review_exercises
+        for ix in order:
+            is_ancestor_review_candidate[ix] = False
+            for c in coverers[ix]:
+                if is_review_candidate[c] or is_ancestor_review_candidate[c]:
+                    is_ancestor_review_candidate[ix] = True
+                    break
+            if is_review_candidate[ix] and not is_ancestor_review_candidate[ix]:
+                review_exercises.append(ix)
+
+        review_exercises.sort()
+        return self.get_nodes(review_exercises)
     
     def get_proficient_exercises(self):
-        proficient_exercises = []
-        for ex in self.exercises:
-            if ex.proficient:
-                proficient_exercises.append(ex)
-        return proficient_exercises
+        return self.get_nodes_where(self.proficient)
 
     def get_summative_exercises(self):
-        summative_exercises = []
-        for ex in self.exercises:
-            if ex.summative:
-                summative_exercises.append(ex)
-        return summative_exercises
+        return self.get_nodes_where(self.topology.summative)
     
     def get_suggested_exercises(self):
         # Mark an exercise as proficient if it or a a covering ancestor is proficient
         # Select all the exercises where the user is not proficient but the 
         # user is proficient in all prereqs.
-        suggested_exercises = []
-        for ex in self.exercises:
-            if ex.suggested:
-                suggested_exercises.append(ex)
-        return suggested_exercises
+        return self.get_nodes_where(self.suggested)
 
     def get_recent_exercises(self, n_recent=2):
-        recent_exercises = sorted(self.exercises, reverse=True,
-                key=lambda ex: ex.last_done if hasattr(ex, "last_done") else datetime.datetime.min)
-        
-        recent_exercises = recent_exercises[0:n_recent]
+        # Only exercises the user has done have a last_done date
+        recent_exercises = sorted(self.get_nodes(sorted(self.user_exercises.keys())), reverse=True,
+                key=lambda ex: ex.last_done or datetime.datetime.min)
 
-        return filter(lambda ex: hasattr(ex, "last_done"), recent_exercises)
+        return recent_exercises[0:n_recent]
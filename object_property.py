@@ -6,11 +6,9 @@ import pickle
 # Use this property to store objects.
 class ObjectProperty(db.BlobProperty):
 	def validate(self, value):
-		try:
-			result = pickle.dumps(value)
-			return value
-		except pickle.PicklingError, e:
-			return super(ObjectProperty, self).validate(value)
+		# Anything that can't be pickled fails when it's put,
+		# there's no need to pickle every value an extra time here
+		return value
 
 	def get_value_for_datastore(self, model_instance):
 		result = super(ObjectProperty, self).get_value_for_datastore(model_instance)
@@ -24,3 +22,33 @@ class ObjectProperty(db.BlobProperty):
 			pass
 		return super(ObjectProperty, self).make_value_from_datastore(value)
 
+# Use this property to store objects with their own versioned encoding
+# instead of pickling them. encode(value) returns a string starting with
+# the encoding's version number, decode(string) returns the value.
+#
+# Values pickled by an ObjectProperty are still read, so an ObjectProperty
+# can be switched to an EncodedObjectProperty and migrated by re-putting.
+class EncodedObjectProperty(ObjectProperty):
+	def __init__(self, encode, decode, **kwargs):
+		super(EncodedObjectProperty, self).__init__(**kwargs)
+		self.encode = encode
+		self.decode = decode
+
+	def get_value_for_datastore(self, model_instance):
+		result = db.BlobProperty.get_value_for_datastore(self, model_instance)
+		if result is None:
+			return None
+		return db.Blob(self.encode(result))
+
+	def make_value_from_datastore(self, value):
+		if value is None:
+			return None
+
+		value = str(value)
+
+		# Protocol 0 pickles always start with a printable opcode,
+		# while encodings start with a small version number
+		if value and ord(value[0]) < 32:
+			return self.decode(value)
+
+		return super(EncodedObjectProperty, self).make_value_from_datastore(value)
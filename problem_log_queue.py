@@ -0,0 +1,219 @@
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.api.labs import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+import request_handler
+import activity_summary
+import exercise_statistics
+from models import UserData
+from badges import util_badges
+from badges import last_action_cache
+
+# problem_log_queue takes the work the user doesn't need to wait for
+# out of /registeranswer: adding the ProblemLog to the user's activity summary,
+# pushing it to the LastActionCache and evaluating no-context and exercise badges.
+#
+# RegisterAnswer still saves the ProblemLog, streak and points synchronously,
+# then hands the saved ProblemLog to enqueue(). Answers are buffered
+# per user in memcache under increasing sequence numbers, and at most one task
+# per user every BATCH_SECONDS processes everything buffered for that user
+# in a single group: one activity summary delta per answer, one LastActionCache
+# update, one exercise_statistics sketch update per exercise and one pass over the badges.
+#
+# If the answer can't be buffered or the task can't be added, enqueue()
+# returns False and the caller should fall back to doing the work itself.
+# The buffer is only ever a copy of a saved ProblemLog, so memcache evicting
+# it before its task runs only loses that answer's LastActionCache push and
+# activity summary delta. Badges it would have awarded are picked up by the
+# badge mapreduce, and the user's recent activity summaries are marked
+# untrusted so they're rebuilt from the ProblemLogs.
+#
+# Tests can swap in LocalQueue to run the queued work in-process:
+#
+# problem_log_queue.QUEUE = problem_log_queue.LocalQueue()
+# ...answer some problems...
+# problem_log_queue.QUEUE.run()
+
+ENABLED = True
+
+URL = "/admin/problemlogqueue"
+BATCH_SECONDS = 5
+LOCK_SECONDS = 60
+BUFFER_SECONDS = 60 * 60 * 24
+
+SEQUENCE_KEY_FORMAT = "problem_log_queue_sequence_%s"
+PROCESSED_KEY_FORMAT = "problem_log_queue_processed_%s"
+ANSWER_KEY_FORMAT = "problem_log_queue_answer_%s_%s"
+LOCK_KEY_FORMAT = "problem_log_queue_lock_%s"
+
+class TaskQueue:
+    # Adds tasks to the App Engine task queue
+
+    def add(self, email, countdown, name=None):
+        try:
+            taskqueue.add(url=URL, params={"email": email}, countdown=countdown, name=name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # A task for this batch has already been added
+            pass
+        return True
+
+class LocalQueue:
+    # In-process stand-in for TaskQueue that only runs tasks when asked to
+
+    def __init__(self):
+        self.emails = []
+
+    def add(self, email, countdown, name=None):
+        if email not in self.emails:
+            self.emails.append(email)
+        return True
+
+    def run(self):
+        emails = self.emails
+        self.emails = []
+        for email in emails:
+            process_answers(email)
+
+QUEUE = TaskQueue()
+
+# dt_last_activity is the user's last_activity from before this answer
+def enqueue(user, problem_log, user_exercise, badge_facts_changed, dt_last_activity):
+    email = user.email()
+
+    sequence_key = SEQUENCE_KEY_FORMAT % email
+    if memcache.add(sequence_key, 0, time=BUFFER_SECONDS):
+        # The sequence is new, either the user's first or one that expired and restarted
+        # from 0, so the processed count left behind belongs to the old sequence
+        memcache.delete(PROCESSED_KEY_FORMAT % email)
+    sequence = memcache.incr(sequence_key)
+    if sequence is None:
+        return False
+
+    answer_key = ANSWER_KEY_FORMAT % (email, sequence)
+    answer = (encode_problem_log(problem_log), str(user_exercise.key()), badge_facts_changed, dt_last_activity)
+    if not memcache.set(answer_key, answer, time=BUFFER_SECONDS):
+        return False
+
+    try:
+        # Name tasks after the user and the current batch window so
+        # all answers within a window are processed by a single task
+        batch = int(time.time()) / BATCH_SECONDS
+        name = "problemlogs-%s-%s" % (hashlib.md5(email).hexdigest(), batch)
+        return QUEUE.add(email, BATCH_SECONDS, name=name)
+    except taskqueue.Error, e:
+        logging.error("Failed to add problem log task for %s: %s" % (email, e))
+        # The caller does the work itself, so make sure a later task doesn't do it again
+        memcache.delete(answer_key)
+        return False
+
+def encode_problem_log(problem_log):
+    return db.model_to_protobuf(problem_log).Encode()
+
+def decode_problem_log(encoded):
+    return db.model_from_protobuf(entity_pb.EntityProto(encoded))
+
+def process_answers(email):
+    # Returns False if another task is already processing this user's answers
+    lock_key = LOCK_KEY_FORMAT % email
+    if not memcache.add(lock_key, True, time=LOCK_SECONDS):
+        return False
+
+    try:
+        processed_key = PROCESSED_KEY_FORMAT % email
+        processed = memcache.get(processed_key) or 0
+        sequence = memcache.get(SEQUENCE_KEY_FORMAT % email) or 0
+
+        if sequence < processed:
+            # The sequence expired and restarted, and a task that was still working
+            # on the old one wrote its processed count after enqueue cleared it
+            processed = 0
+
+        if sequence > processed:
+            answer_keys = [ANSWER_KEY_FORMAT % (email, ix) for ix in range(processed + 1, sequence + 1)]
+            answers = memcache.get_multi(answer_keys)
+
+            if len(answers) < len(answer_keys):
+                logging.error("Lost %s buffered answers for %s" % (len(answer_keys) - len(answers), email))
+                # Lost answers are at most BUFFER_SECONDS old
+                dt_now = datetime.datetime.now()
+                activity_summary.invalidate_deltas(users.User(email), [dt_now - datetime.timedelta(seconds=BUFFER_SECONDS), dt_now])
+
+            answers = [answers[key] for key in answer_keys if key in answers]
+
+            problem_logs = [decode_problem_log(answer[0]) for answer in answers]
+
+            # Never process the same ProblemLogs twice, even if evaluating badges fails below
+            memcache.set(processed_key, sequence, time=BUFFER_SECONDS)
+            memcache.delete_multi(answer_keys)
+
+            for problem_log, answer in zip(problem_logs, answers):
+                # Answers buffered before deltas were queued had theirs added by RegisterAnswer
+                if len(answer) > 3:
+                    activity_summary.add_problem_log_delta(problem_log, answer[3])
+
+            try:
+                exercise_statistics.record_problem_logs(problem_logs)
+            except Exception:
+                # The answers are already marked processed, so don't let
+                # statistics keep them from being pushed and checked for badges
+                logging.exception("Failed to record exercise statistics for %s" % email)
+
+            if problem_logs:
+                user_exercise_keys = []
+                badge_facts_changed = []
+                for answer in answers:
+                    user_exercise_key, answer_badge_facts_changed = answer[1], answer[2]
+                    if user_exercise_key not in user_exercise_keys:
+                        user_exercise_keys.append(user_exercise_key)
+                    for fact in answer_badge_facts_changed:
+                        if fact not in badge_facts_changed:
+                            badge_facts_changed.append(fact)
+
+                update_badges(problem_logs, user_exercise_keys, badge_facts_changed)
+    finally:
+        memcache.delete(lock_key)
+
+    return True
+
+def update_badges(problem_logs, user_exercise_keys, badge_facts_changed):
+    user = problem_logs[0].user
+
+    action_cache = last_action_cache.LastActionCache.get_for_user(user)
+    for problem_log in problem_logs:
+        action_cache.push_problem_log(problem_log, store=False)
+    action_cache.store()
+
+    user_exercises = filter(lambda user_exercise: user_exercise is not None, db.get(user_exercise_keys))
+
+    user_data = UserData.get_for(user)
+    if user_data is None:
+        return
+
+    awards_snapshot = user_data.get_awards_snapshot()
+
+    awarded = False
+    for user_exercise in user_exercises:
+        awarded = util_badges.update_with_user_exercise(user, user_data, user_exercise, action_cache=action_cache, facts_changed=badge_facts_changed) or awarded
+    awarded = util_badges.update_with_no_context(user, user_data, action_cache=action_cache, facts_changed=util_badges.facts_changed_after_awards(badge_facts_changed, awarded)) or awarded
+
+    if awarded:
+        # The user may well have answered another problem since user_data was read,
+        # so only add the awards to the latest UserData instead of putting this copy
+        user_data.put_in_transaction(lambda user_data_latest: user_data.add_awards_to(user_data_latest, awards_snapshot))
+
+class ProcessProblemLogQueue(request_handler.RequestHandler):
+
+    # Admin-only restriction is handled by /admin/* URL pattern
+    # so this can be called by the task queue.
+    def post(self):
+        email = self.request_string("email")
+        if email and not process_answers(email):
+            # Another task is busy with this user, try again once it's done
+            QUEUE.add(email, LOCK_SECONDS)
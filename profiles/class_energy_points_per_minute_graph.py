@@ -8,9 +8,7 @@ import util
 def class_energy_points_per_minute_update(user_data):
     points = 0
     if user_data:
-        students_data = user_data.get_students_data()
-        for student_data in students_data:
-            points += student_data.points
+        points = user_data.get_class_points()
     return simplejson.dumps({"points": points})
 
 def class_energy_points_per_minute_graph_context(user_data):
@@ -26,9 +26,9 @@ def class_exercises_over_time_graph_context(user_data):
     dict_student_exercises = {}
     dict_exercises = {}
 
-    for student_email in student_emails:
-        student = users.User(student_email)
-        student_nickname = util.get_nickname_for(student)
+    students = map(lambda student_email: users.User(student_email), student_emails)
+
+    for student, student_nickname in zip(students, util.get_nicknames_for(students)):
         dict_student_exercises[student_nickname] = { "nickname": student_nickname, "email": student.email(), "exercises": [] }
 
         query = models.UserExercise.all()
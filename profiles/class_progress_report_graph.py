@@ -1,69 +1,104 @@
+import hashlib
+
 from google.appengine.api import users
 
 from django.template.defaultfilters import escape
 
 import models
 import util
+import request_cache
 
 def get_class_exercises(list_student_data):
 
     class_exercise_dict = {}
 
-    for student_data in list_student_data:
+    # Every student's UserExercises in one batched memcache round trip,
+    # only students missing from memcache are queried
+    list_user_exercises = models.UserExercise.get_for_users_use_cache(map(lambda student_data: student_data.user, list_student_data))
+
+    for student_data, user_exercises in zip(list_student_data, list_user_exercises):
 
         student = student_data.user
         student_email = student.email()
 
+        # Anything else that needs this student's UserExercises during this request,
+        # like reassessing their proficiency, shouldn't fetch them again
+        request_cache.set(models.UserExercise.get_key_for_user(student), user_exercises)
+
         class_exercise_dict[student_email] = {"student_data": student_data}
 
-        user_exercises = models.UserExercise.get_for_user_use_cache(student)
         for user_exercise in user_exercises:
             if user_exercise.exercise not in class_exercise_dict[student_email]:
                 class_exercise_dict[student_email][user_exercise.exercise] = user_exercise
 
     return class_exercise_dict
 
-def class_progress_report_graph_context(user_data):
+# Changes whenever one of the coach's students is added or removed, answers a problem,
+# watches a video or gains or loses proficiency, or the exercises themselves change
+def class_progress_report_cache_key(user_data, list_student_data):
+    student_states = []
+    for student_data in list_student_data:
+        student_states.append("%s:%s:%s:%s" % (
+            student_data.user.email(),
+            student_data.last_activity,
+            len(student_data.all_proficient_exercises),
+            len(student_data.proficient_exercises)))
+    student_states.sort()
+
+    state = "%s|%s" % (models.Setting.cached_exercises_date(), "|".join(student_states))
+    return "class_progress_report_%s_%s" % (user_data.user.email(), hashlib.md5(state.encode("utf-8")).hexdigest())
+
+def class_progress_report_graph_context(user_data, list_student_data=None):
 
     if not user_data:
         return {}
 
     user = user_data.user
 
-    list_student_data = user_data.get_students_data()
+    if list_student_data is None:
+        list_student_data = user_data.get_students_data()
     student_emails = map(lambda student_data: student_data.user.email(), list_student_data)
     class_exercises = get_class_exercises(list_student_data)
 
     exercises_all = models.Exercise.get_all_use_cache()
-    exercises_found = []
+    exercise_names_started = set()
+    for student_email in student_emails:
+        exercise_names_started.update(class_exercises[student_email].keys())
 
-    for exercise in exercises_all:
-        for student_email in student_emails:
-            if class_exercises[student_email].has_key(exercise.name):
-                exercises_found.append(exercise)
-                break
+    exercises_found = filter(lambda exercise: exercise.name in exercise_names_started, exercises_all)
 
     exercises_found_names = map(lambda exercise: exercise.name, exercises_found)
     exercise_data = {}
+    exercise_displays = {}
+    for exercise in exercises_found:
+        exercise_data[exercise.name] = {}
+        exercise_displays[exercise.name] = models.Exercise.to_display_name(exercise.name)
+
+    # Stands in for the UserExercise of exercises a student hasn't started
+    user_exercise_empty = models.UserExercise()
+
+    nicknames = util.get_nicknames_for(map(lambda student_data: student_data.user, list_student_data))
 
-    for student_email in student_emails:   
+    for student_email, name in zip(student_emails, nicknames):   
 
         student_data = class_exercises[student_email]["student_data"]
         if not student_data:
             continue
 
-        name = util.get_nickname_for(student_data.user)
-        i = 0
+        # Use the proficiencies stored on each student's UserData, only rebuilding
+        # them for the rare student whose proficiencies are out of date
+        student_data.reassess_if_necessary(student_data.user)
+        all_proficient_exercises = set(student_data.all_proficient_exercises)
+        proficient_exercises = set(student_data.proficient_exercises)
+
+        short_name = name
+        if len(short_name) > 18:
+            short_name = short_name[0:18] + "..."
 
         for exercise in exercises_found:
 
             exercise_name = exercise.name
-            user_exercise = models.UserExercise()
-            if class_exercises[student_email].has_key(exercise_name):
-                user_exercise = class_exercises[student_email][exercise_name]
-
-            if not exercise_data.has_key(exercise_name):
-                exercise_data[exercise_name] = {}
+            user_exercise = class_exercises[student_email].get(exercise_name, user_exercise_empty)
 
             link = "/profile/graph/exerciseproblems?student_email="+student_email+"&exercise_name="+exercise_name
 
@@ -71,11 +106,11 @@ def class_progress_report_graph_context(user_data):
             hover = ""
             color = "transparent"
 
-            if student_data.is_proficient_at(exercise_name):
+            if exercise_name in all_proficient_exercises:
                 status = "Proficient"
                 color = "proficient"
 
-                if not student_data.is_explicitly_proficient_at(exercise_name):
+                if exercise_name not in proficient_exercises:
                     status = "Proficient (due to proficiency in a more advanced module)"
 
             elif user_exercise.exercise is not None and models.UserExercise.is_struggling_with(user_exercise, exercise):
@@ -85,10 +120,7 @@ def class_progress_report_graph_context(user_data):
                 status = "Started"
                 color = "started"
 
-            exercise_display = models.Exercise.to_display_name(exercise_name)
-            short_name = name
-            if len(short_name) > 18:
-                short_name = short_name[0:18] + "..."
+            exercise_display = exercise_displays[exercise_name]
 
             if len(status) > 0:
                 hover = "<b>%s</b><br/><br/><b>%s</b><br/><em><nobr>Status: %s</nobr></em><br/><em>Streak: %s</em><br/><em>Problems attempted: %s</em>" % (escape(name), exercise_display, status, user_exercise.streak, user_exercise.total_done)
@@ -101,7 +133,6 @@ def class_progress_report_graph_context(user_data):
                     "hover": hover,
                     "color": color
                     }
-            i += 1
 
     return { 
             'student_emails': student_emails,
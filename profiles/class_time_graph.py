@@ -1,6 +1,7 @@
 import datetime
 import time
 import logging
+import hashlib
 
 from google.appengine.api import users
 from django.template.defaultfilters import pluralize
@@ -8,6 +9,31 @@ from django.template.defaultfilters import pluralize
 import models
 import classtime
 import util
+import layer_cache
+
+# Logs can still arrive for a little while after a day ends
+# (e.g. from problem_log_queue), so wait this long before caching its table
+CACHE_AFTER_DAY_ENDS_SECONDS = 60 * 10
+
+def get_classtime_table(classtime_analyzer, user_data, student_emails, dt_utc):
+    dt_end_utc = classtime_analyzer.dt_to_utc(classtime_analyzer.dt_to_ctz(dt_utc) + datetime.timedelta(days=1))
+    if datetime.datetime.now() < dt_end_utc + datetime.timedelta(seconds=CACHE_AFTER_DAY_ENDS_SECONDS):
+        return classtime_analyzer.get_classtime_table(student_emails, dt_utc)
+    return get_finished_classtime_table(classtime_analyzer, user_data, student_emails, dt_utc)
+
+# Nothing happens on a day that's over, so its table is cached
+# per coach, day, timezone and set of students
+@layer_cache.cache_with_key_fxn(
+        lambda classtime_analyzer, user_data, student_emails, dt_utc: "classtime_table_%s_%s_%s_%s" % (
+            user_data.user.email(),
+            dt_utc.strftime("%Y-%m-%d-%H-%M"),
+            classtime_analyzer.timezone_offset,
+            hashlib.md5("|".join(sorted(student_emails)).encode("utf-8")).hexdigest()),
+        layer=layer_cache.SINGLE_LAYER_MEMCACHE_ONLY)
+def get_finished_classtime_table(classtime_analyzer, user_data, student_emails, dt_utc):
+    classtime_table = classtime_analyzer.get_classtime_table(student_emails, dt_utc)
+    classtime_table.drop_activities()
+    return classtime_table
 
 def class_time_graph_context(user_data, dt_utc, tz_offset):
 
@@ -24,11 +50,11 @@ def class_time_graph_context(user_data, dt_utc, tz_offset):
     if classtime_analyzer.timezone_offset != -1:
         # If no timezone offset is specified, don't bother grabbing all the data
         # because we'll be redirecting back to here w/ timezone information.
-        classtime_table = classtime_analyzer.get_classtime_table(student_emails, dt_utc)
+        classtime_table = get_classtime_table(classtime_analyzer, user_data, student_emails, dt_utc)
 
-    for student_email in student_emails:
+    nicknames = util.get_nicknames_for(map(lambda student_email: users.User(email=student_email), student_emails))
 
-        short_name = util.get_nickname_for(users.User(email=student_email))
+    for student_email, short_name in zip(student_emails, nicknames):
         if len(short_name) > 18:
             short_name = short_name[0:18] + "..."
 
@@ -1,9 +1,11 @@
 import os
 import logging
+import zlib
 
 from google.appengine.ext import webapp
 
 from render import render_block_to_string
+import layer_cache
 from profiles import focus_graph, activity_graph, exercises_over_time_graph, exercise_problems_graph, exercise_progress_graph, recent_activity
 from profiles import class_exercises_over_time_graph, class_progress_report_graph, class_energy_points_per_minute_graph, class_time_graph
 
@@ -41,7 +43,22 @@ def class_profile_exercises_over_time_graph(user_data_coach):
     return render_graph_html_and_context("class_exercises_over_time_graph.html", class_exercises_over_time_graph.class_exercises_over_time_graph_context(user_data_coach))
 @register.simple_tag
 def class_profile_progress_report_graph(user_data_coach):
-    return render_graph_html_and_context("class_progress_report_graph.html", class_progress_report_graph.class_progress_report_graph_context(user_data_coach))
+    if not user_data_coach:
+        return render_graph_html_and_context("class_progress_report_graph.html", {})
+
+    list_student_data = user_data_coach.get_students_data()
+    html = zlib.decompress(class_progress_report_graph_html_compressed(user_data_coach, list_student_data)).decode("utf-8")
+    return {"html": html, "context": {}}
+
+# The rendered report is cached per coach under a key that changes with any
+# of the students' activity, compressed because it grows with students x exercises
+@layer_cache.cache_with_key_fxn(
+        lambda user_data_coach, list_student_data: class_progress_report_graph.class_progress_report_cache_key(user_data_coach, list_student_data),
+        layer=layer_cache.SINGLE_LAYER_MEMCACHE_ONLY)
+def class_progress_report_graph_html_compressed(user_data_coach, list_student_data):
+    context = class_progress_report_graph.class_progress_report_graph_context(user_data_coach, list_student_data)
+    html = render_graph_html_and_context("class_progress_report_graph.html", context)["html"]
+    return zlib.compress(html.encode("utf-8"))
 @register.simple_tag
 def class_profile_energy_points_per_minute_graph(user_data_coach):
     return render_graph_html_and_context("class_energy_points_per_minute_graph.html", class_energy_points_per_minute_graph.class_energy_points_per_minute_graph_context(user_data_coach))
@@ -31,10 +31,11 @@ class ViewClassProfile(request_handler.RequestHandler):
             if students_data:
                 class_points = reduce(lambda a,b: a + b, map(lambda student_data: student_data.points, students_data))
 
-            dict_students = map(lambda student_data: { 
-                "email": student_data.user.email(),
-                "nickname": util.get_nickname_for(student_data.user),
-            }, students_data)
+            students = map(lambda student_data: student_data.user, students_data)
+            dict_students = map(lambda (student, nickname): { 
+                "email": student.email(),
+                "nickname": nickname,
+            }, zip(students, util.get_nicknames_for(students)))
 
             selected_graph_type = self.request_string("selected_graph_type") or ClassProgressReportGraph.GRAPH_TYPE
             initial_graph_url = "/profile/graph/%s?coach_email=%s&%s" % (selected_graph_type, urllib.quote(coach.email()), urllib.unquote(self.request_string("graph_query_params", default="")))
@@ -0,0 +1,143 @@
+import array
+import math
+import random
+import struct
+
+# QuantileSketch is a KLL sketch (Karnin, Lang and Liberty, "Optimal Quantile
+# Approximation in Streams") of a stream of numbers. It answers quantile queries
+# using a small, bounded amount of memory no matter how many values it has seen,
+# and two sketches can be merged into one that summarizes both streams.
+#
+# Values are kept in levels of compactors, values at level h each standing in for
+# 2 ** h of the stream's values. Whenever the sketch gets too big, a full level is
+# sorted and every other value in it is promoted to the next level, starting at a
+# random offset. With the default k of 200, a quantile's rank is typically within
+# about 1% of the exact one.
+#
+# Sketches are stored with encode() and decode(), which write each level's values
+# as the raw bytes of an array of single precision floats after a small versioned header.
+#
+# sketch = QuantileSketch()
+# for value in values:
+#     sketch.add(value)
+# median = sketch.quantile(0.5)
+
+class QuantileSketch:
+
+    VERSION = 1
+    HEADER_FORMAT = "!BHIB" # version, k, count, c_levels
+    DEFAULT_K = 200
+    SHRINK = 2.0 / 3.0 # Each level below the top holds SHRINK times as many values as the one above it
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.count = 0
+        self.levels = [[]]
+        self.size = 0
+        self.max_size = self.level_capacity(0)
+
+    def level_capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return int(math.ceil(self.k * (QuantileSketch.SHRINK ** depth))) + 1
+
+    def grow(self):
+        self.levels.append([])
+        self.max_size = sum([self.level_capacity(level) for level in range(len(self.levels))])
+
+    def add(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.grow()
+        for level, values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.count += other.count
+        self.size = sum([len(values) for values in self.levels])
+        while self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        for level in range(len(self.levels)):
+            if len(self.levels[level]) >= self.level_capacity(level):
+                if level + 1 >= len(self.levels):
+                    self.grow()
+
+                values = sorted(self.levels[level])
+
+                # Keep the odd one out at this level so total weight is preserved
+                kept = []
+                if len(values) % 2:
+                    kept = [values.pop()]
+
+                self.levels[level + 1].extend(values[random.randint(0, 1)::2])
+                self.levels[level] = kept
+
+                self.size = sum([len(values) for values in self.levels])
+                if self.size < self.max_size:
+                    break
+
+    def quantile(self, q):
+        # Returns the smallest value whose rank is at least q of the stream, or None if empty
+        weighted = []
+        for level, values in enumerate(self.levels):
+            weight = 1 << level
+            for value in values:
+                weighted.append((value, weight))
+
+        if not weighted:
+            return None
+
+        weighted.sort()
+        total = sum([weight for value, weight in weighted])
+        target = q * total
+
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+    def encode(self):
+        header = struct.pack(QuantileSketch.HEADER_FORMAT, QuantileSketch.VERSION, self.k, self.count, len(self.levels))
+        lengths = struct.pack("!%dI" % len(self.levels), *[len(values) for values in self.levels])
+
+        values = array.array('f')
+        for level_values in self.levels:
+            values.extend(level_values)
+
+        return "".join([header, lengths, values.tostring()])
+
+    @staticmethod
+    def decode(encoded):
+        offset = struct.calcsize(QuantileSketch.HEADER_FORMAT)
+        (version, k, count, c_levels) = struct.unpack(QuantileSketch.HEADER_FORMAT, encoded[:offset])
+
+        if version != QuantileSketch.VERSION:
+            raise ValueError("unknown QuantileSketch version %s" % version)
+
+        lengths = struct.unpack_from("!%dI" % c_levels, encoded, offset)
+        offset += 4 * c_levels
+
+        values = array.array('f')
+        values.fromstring(encoded[offset:])
+
+        if len(values) != sum(lengths):
+            raise ValueError("QuantileSketch has %s values, expected %s" % (len(values), sum(lengths)))
+
+        sketch = QuantileSketch(k)
+        sketch.levels = []
+        start = 0
+        for length in lengths:
+            sketch.levels.append(values[start:start + length].tolist())
+            start += length
+
+        sketch.count = count
+        sketch.size = start
+        sketch.max_size = sum([sketch.level_capacity(level) for level in range(len(sketch.levels))])
+        return sketch
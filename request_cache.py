@@ -0,0 +1,67 @@
+import logging
+
+# request_cache memoizes values for the duration of a single request,
+# so that objects like the current user's UserData or ExerciseGraph
+# are only fetched or built once no matter how many code paths need them.
+#
+# GAE's python runtime serves one request at a time per instance, so the cache
+# is a module level dict that is flushed at the start and end of every request
+# by request_cache_middleware (see appengine_config.py).
+#
+# request_cache also keeps per-request counters for instrumentation,
+# which are logged when the request ends:
+#
+# request_cache.increment("exercise_graph_builds")
+
+CACHE = {}
+COUNTERS = {}
+
+def has(key):
+    return key in CACHE
+
+def get(key, default=None):
+    return CACHE.get(key, default)
+
+def set(key, value):
+    CACHE[key] = value
+    return value
+
+def delete(key):
+    if key in CACHE:
+        del CACHE[key]
+
+def increment(counter, delta=1):
+    COUNTERS[counter] = COUNTERS.get(counter, 0) + delta
+
+def counters():
+    return COUNTERS
+
+def flush():
+    CACHE.clear()
+    COUNTERS.clear()
+
+def cache_with_key_fxn(key_fxn):
+    # Memoize the decorated function's result under the key returned
+    # by key_fxn for the rest of the request. None is never memoized.
+    def decorator(target):
+        def wrapper(*args, **kwargs):
+            key = key_fxn(*args, **kwargs)
+            result = CACHE.get(key)
+            if result is None:
+                result = target(*args, **kwargs)
+                if result is not None:
+                    CACHE[key] = result
+            return result
+        return wrapper
+    return decorator
+
+def request_cache_middleware(app):
+    def wrapper(environ, start_response):
+        flush()
+        try:
+            return app(environ, start_response)
+        finally:
+            if COUNTERS:
+                logging.info("request_cache counters for %s: %s" % (environ.get("PATH_INFO"), COUNTERS))
+            flush()
+    return wrapper
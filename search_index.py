@@ -0,0 +1,160 @@
+import array
+import math
+
+import layer_cache
+from models import Video, Playlist, Setting
+from search import PUNCTUATION_REGEX, STOP_WORDS, SEARCH_PHRASE_MIN_LENGTH
+from search.pyporter2 import Stemmer
+
+# An in-memory inverted index over the searchable fields of a list of entities,
+# ranked with BM25F: each field's term frequency is normalized by the field's
+# length, weighted and summed before BM25's saturation is applied.
+#
+# Search terms are the same stemmed, stop-word-free keywords the datastore
+# search indexes, and like that search every term has to match. The videos and
+# playlists indexes are built once per library content version and shared through
+# cachepy, so searching them never touches the datastore:
+#
+# videos = search_index.get_videos_index().search("adding fractions", limit=50)
+
+K1 = 1.2
+B = 0.75
+
+class SearchIndex(object):
+
+    def __init__(self, entities, field_weights):
+        self.entities = entities
+        self.fields = [field for field, weight in field_weights]
+        self.weights = [weight for field, weight in field_weights]
+
+        # postings[term] is (doc indexes, term frequencies of each field),
+        # each stored as a compact array lined up with the doc indexes
+        self.postings = {}
+
+        # Stemming is most of the work of building an index, and most words come up many times
+        dict_stems = {}
+
+        self.lengths = [array.array('H') for field in self.fields]
+        for ix, entity in enumerate(entities):
+            dict_term_freqs = {}
+            for field_ix, field in enumerate(self.fields):
+                terms = get_terms(getattr(entity, field, None), dict_stems)
+                self.lengths[field_ix].append(min(len(terms), 0xFFFF))
+                for term in terms:
+                    freqs = dict_term_freqs.get(term)
+                    if freqs is None:
+                        freqs = dict_term_freqs[term] = [0] * len(self.fields)
+                    freqs[field_ix] += 1
+
+            for term, freqs in dict_term_freqs.iteritems():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array.array('I'), [array.array('H') for field in self.fields])
+                posting[0].append(ix)
+                for field_ix, freq in enumerate(freqs):
+                    posting[1][field_ix].append(min(freq, 0xFFFF))
+
+        c_docs = max(len(entities), 1)
+        self.average_lengths = [max(float(sum(lengths)) / c_docs, 1.0) for lengths in self.lengths]
+
+    def idf(self, term):
+        c_docs = len(self.entities)
+        c_docs_with_term = len(self.postings[term][0])
+        return math.log(1.0 + (c_docs - c_docs_with_term + 0.5) / (c_docs_with_term + 0.5))
+
+    def search(self, phrase, limit=10, searched_phrases_out=None):
+        # Returns up to limit entities matching every search term in phrase, best first
+        terms = []
+        for term in get_terms(phrase):
+            if term not in terms:
+                terms.append(term)
+
+        if searched_phrases_out is not None:
+            searched_phrases_out.extend(terms)
+
+        if not terms:
+            return []
+
+        for term in terms:
+            if term not in self.postings:
+                return []
+
+        # Start from the rarest term so the other terms only score its matches
+        terms.sort(key=lambda term: len(self.postings[term][0]))
+
+        dict_scores = None
+        for term in terms:
+            idf = self.idf(term)
+            doc_ixs, field_freqs = self.postings[term]
+
+            dict_term_scores = {}
+            for posting_ix, doc_ix in enumerate(doc_ixs):
+                if dict_scores is not None and doc_ix not in dict_scores:
+                    continue
+
+                weighted_freq = 0.0
+                for field_ix in range(len(self.fields)):
+                    freq = field_freqs[field_ix][posting_ix]
+                    if freq:
+                        length_ratio = self.lengths[field_ix][doc_ix] / self.average_lengths[field_ix]
+                        weighted_freq += self.weights[field_ix] * freq / (1.0 - B + B * length_ratio)
+
+                score = idf * weighted_freq * (K1 + 1.0) / (weighted_freq + K1)
+                if dict_scores is not None:
+                    score += dict_scores[doc_ix]
+                dict_term_scores[doc_ix] = score
+
+            dict_scores = dict_term_scores
+            if not dict_scores:
+                return []
+
+        # Ties are broken by the order entities were indexed in
+        ranked = sorted(dict_scores.iteritems(), key=lambda (doc_ix, score): (-score, doc_ix))
+        return [self.entities[doc_ix] for doc_ix, score in ranked[:limit]]
+
+STEMMER = Stemmer.Stemmer('english')
+
+FETCH_BATCH_SIZE = 500
+
+def fetch_all(query):
+    entities = []
+    while True:
+        batch = query.fetch(FETCH_BATCH_SIZE)
+        entities.extend(batch)
+        if len(batch) < FETCH_BATCH_SIZE:
+            return entities
+        query.with_cursor(query.cursor())
+
+# The keywords the datastore search indexes in text, stemmed and in order.
+# Stems are looked up in and added to dict_stems if it's given.
+def get_terms(text, dict_stems=None):
+    if not text:
+        return []
+
+    words = PUNCTUATION_REGEX.sub(' ', text.replace('-', ' ')).lower().split()
+    words = [word for word in words if word not in STOP_WORDS and len(word) >= SEARCH_PHRASE_MIN_LENGTH]
+
+    if dict_stems is None:
+        return STEMMER.stemWords(words)
+
+    terms = []
+    for word in words:
+        stem = dict_stems.get(word)
+        if stem is None:
+            stem = dict_stems[word] = STEMMER.stemWord(word)
+        terms.append(stem)
+    return terms
+
+@layer_cache.cache_with_key_fxn(
+        lambda *args, **kwargs: "search_index_videos_%s" % Setting.cached_library_content_date(),
+        layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY
+        )
+def get_videos_index():
+    return SearchIndex(fetch_all(Video.all()), [("title", 3.0), ("keywords", 1.5), ("description", 1.0)])
+
+@layer_cache.cache_with_key_fxn(
+        lambda *args, **kwargs: "search_index_playlists_%s" % Setting.cached_library_content_date(),
+        layer=layer_cache.SINGLE_LAYER_IN_APP_MEMORY_CACHE_ONLY
+        )
+def get_playlists_index():
+    return SearchIndex(fetch_all(Playlist.all()), [("title", 3.0), ("description", 1.0)])
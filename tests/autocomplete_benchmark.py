@@ -0,0 +1,82 @@
+import os
+import random
+import sys
+import time
+
+# Compares autocomplete's PrefixIndex with the linear substring scan it
+# replaced, on a synthetic corpus of video titles about 10 times the size of
+# the current library. Queries are typed one keystroke at a time, like the
+# search box sends them.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/autocomplete_benchmark.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("CURRENT_VERSION_ID", "1.1")
+
+from autocomplete import PrefixIndex, MAX_RESULTS_PER_TYPE
+
+C_TITLES = 20000
+C_TYPED = 40
+
+WORDS = ("adding subtracting multiplying dividing fractions decimals negative numbers equations "
+        "linear quadratic functions graphing slope intercept exponents radicals logarithms "
+        "probability statistics geometry triangles circles angles polygons vectors matrices "
+        "derivatives integrals limits sequences series trigonometry identities factoring "
+        "polynomials inequalities systems variables expressions proportions percentages ratios "
+        "introduction example word problems part").split()
+
+# Autocomplete before PrefixIndex: every title is checked for the query on every keystroke
+def search_linear(title_dicts, query, limit):
+    results = filter(lambda title_dict: query in title_dict["title"].lower(), title_dicts)
+    return sorted(results, key=lambda title_dict: title_dict["title"].lower().index(query))[:limit]
+
+def random_title_dicts(rnd):
+    title_dicts = []
+    for ix in range(C_TITLES):
+        title = " ".join([rnd.choice(WORDS) for ix_word in range(rnd.randint(2, 6))]).title()
+        if rnd.random() < 0.3:
+            title += " %s" % rnd.randint(1, 12)
+        title_dicts.append({"title": title, "url": "/video/video-%s" % ix})
+    return title_dicts
+
+def typed_queries(rnd, title_dicts):
+    # Every keystroke of the start of C_TYPED titles, up to a word and a half
+    queries = []
+    for title_dict in rnd.sample(title_dicts, C_TYPED):
+        words = title_dict["title"].lower().split()
+        typed = words[0]
+        if len(words) > 1:
+            typed += " " + words[1][:len(words[1]) / 2]
+        queries.extend([typed[:length] for length in range(1, len(typed) + 1) if not typed[:length].endswith(" ")])
+    return queries
+
+def ms_per_query(search, queries):
+    dt_start = time.time()
+    for query in queries:
+        search(query)
+    return (time.time() - dt_start) * 1000.0 / len(queries)
+
+def main():
+    rnd = random.Random(25)
+    title_dicts = random_title_dicts(rnd)
+    queries = typed_queries(rnd, title_dicts)
+
+    dt_start = time.time()
+    prefix_index = PrefixIndex(title_dicts)
+    ms_build = (time.time() - dt_start) * 1000.0
+
+    dt_start = time.time()
+    prefix_index.search(queries[0], MAX_RESULTS_PER_TYPE)
+    ms_cold = (time.time() - dt_start) * 1000.0
+
+    print "%s titles, %s keystrokes" % (C_TITLES, len(queries))
+    print "prefix index built in %.0f ms with %s entries, once per library content version" % (ms_build, len(prefix_index.suffixes))
+    print "first single letter query before it's memoized: %.2f ms" % ms_cold
+    print "linear scan:  %8.2f ms per keystroke" % ms_per_query(lambda query: search_linear(title_dicts, query, MAX_RESULTS_PER_TYPE), queries)
+    print "prefix index: %8.2f ms per keystroke" % ms_per_query(lambda query: prefix_index.search(query, MAX_RESULTS_PER_TYPE), queries)
+
+if __name__ == '__main__':
+    main()
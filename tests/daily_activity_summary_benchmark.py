@@ -0,0 +1,90 @@
+import cPickle
+import datetime
+import os
+import pickle
+import random
+import sys
+import time
+
+# Compares the versioned encoding of DailyActivityLog.activity_summary with
+# the protocol 0 pickle ObjectProperty stored before it: blob size, decode
+# time and encode time for a month of activity.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/daily_activity_summary_benchmark.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+
+from google.appengine.api import users
+from google.appengine.ext import db
+
+import daily_activity_summary
+from daily_activity_summary import DailyActivitySummary, ActivitySummaryExerciseItem, ActivitySummaryVideoItem
+
+DAYS = 30
+HOURS_PER_DAY = 4
+EXERCISES_PER_HOUR = 3
+VIDEOS_PER_HOUR = 3
+RUNS = 20
+
+EXERCISES = ["addition_1", "subtraction_2", "multiplication_1", "dividing_fractions", "linear_equations_2", "exponent_rules"]
+PLAYLISTS = ["Arithmetic", "Developmental Math", "Algebra", "Pre-algebra"]
+
+def random_summary(rnd, user, date):
+    summary = DailyActivitySummary()
+    summary.user = user
+    summary.date = date
+
+    for hour in rnd.sample(range(24), HOURS_PER_DAY):
+        hourly_summary = summary.get_hourly_summary(hour)
+
+        for exercise in rnd.sample(EXERCISES, EXERCISES_PER_HOUR):
+            item = ActivitySummaryExerciseItem()
+            item.exercise = exercise
+            item.c_problems = rnd.randint(1, 30)
+            item.c_correct = rnd.randint(0, item.c_problems)
+            item.time_taken = item.c_problems * rnd.randint(5, 60)
+            item.points_earned = item.c_correct * rnd.randint(5, 15)
+            hourly_summary.dict_exercises[exercise] = item
+
+        for ix in range(VIDEOS_PER_HOUR):
+            item = ActivitySummaryVideoItem()
+            video_id = rnd.randint(1, 3000)
+            item.video_title = u"Video %s" % video_id
+            item.seconds_watched = rnd.randint(30, 900)
+            item.points_earned = rnd.randint(0, 50)
+            item.playlist_titles = rnd.sample(PLAYLISTS, rnd.randint(1, 2))
+            hourly_summary.dict_videos[db.Key.from_path("Video", video_id)] = item
+
+    return summary
+
+def ms_per_month(fxn, values):
+    dt_start = time.time()
+    for run in range(RUNS):
+        for value in values:
+            fxn(value)
+    return (time.time() - dt_start) * 1000.0 / RUNS
+
+def main():
+    rnd = random.Random(16)
+    user = users.User("student@example.com")
+    dt_start = datetime.datetime(2011, 6, 1)
+    summaries = [random_summary(rnd, user, dt_start + datetime.timedelta(days=day)) for day in range(DAYS)]
+
+    pickled = [pickle.dumps(summary) for summary in summaries]
+    encoded = [daily_activity_summary.encode(summary) for summary in summaries]
+
+    print "One month: %s days of %s hours, each with %s exercises and %s videos" % (DAYS, HOURS_PER_DAY, EXERCISES_PER_HOUR, VIDEOS_PER_HOUR)
+    print "size:   protocol 0 pickle %7.1f KB, encoded %7.1f KB" % (
+            sum(map(len, pickled)) / 1024.0, sum(map(len, encoded)) / 1024.0)
+    print "decode: pickle %7.2f ms, cPickle %7.2f ms, encoded %7.2f ms" % (
+            ms_per_month(pickle.loads, pickled), ms_per_month(cPickle.loads, pickled), ms_per_month(daily_activity_summary.decode, encoded))
+    print "encode: pickle %7.2f ms, cPickle %7.2f ms, encoded %7.2f ms" % (
+            ms_per_month(pickle.dumps, summaries), ms_per_month(lambda summary: cPickle.dumps(summary, 0), summaries),
+            ms_per_month(daily_activity_summary.encode, summaries))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import datetime
+import os
+import random
+import sys
+import time
+
+# Compares building an ExerciseGraph and reading its proficient, suggested
+# and review lists against the recursive implementation it replaced,
+# on random exercise DAGs of 100 to 5,000 exercises.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/exercise_graph_benchmark.py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from exercise_graph_test import RecursiveExerciseGraph, FakeUser, random_exercises, random_user_exercises, copy_exercises, names
+import models
+import request_cache
+from models import UserData, ExerciseGraph, ExerciseGraphTopology
+
+SIZES = [100, 1000, 5000]
+RUNS = 10
+
+def best_ms(fxn, setup):
+    # Best of RUNS, each run given a fresh argument from setup()
+    best = None
+    for run in range(RUNS):
+        arg = setup()
+        dt_start = time.time()
+        fxn(arg)
+        ms = (time.time() - dt_start) * 1000.0
+        if best is None or ms < best:
+            best = ms
+    return best
+
+def main():
+    rnd = random.Random(6)
+    now = datetime.datetime(2011, 6, 1)
+    user = FakeUser("student@example.com")
+
+    for c_exercises in SIZES:
+        exercises = random_exercises(rnd, c_exercises)
+        user_exercises = random_user_exercises(rnd, exercises)
+        for user_exercise in user_exercises:
+            if rnd.random() < 0.7:
+                user_exercise.last_review = now - datetime.timedelta(days=rnd.randint(0, 60))
+                user_exercise.review_interval_secs = rnd.randint(0, 40) * 86400
+
+        user_data = UserData(
+                proficient_exercises=[name for name in names(exercises) if rnd.random() < 0.3],
+                assigned_exercises=[])
+
+        # The topology is shared by every user until the exercises change, so it's built outside the timing
+        topology = ExerciseGraphTopology(exercises)
+        ExerciseGraphTopology.get_use_cache = staticmethod(lambda: topology)
+        models.UserExercise.get_for_user_use_cache = staticmethod(lambda user: user_exercises)
+
+        def build_recursive(exercise_copies):
+            graph = RecursiveExerciseGraph(exercise_copies, user_data, user_exercises)
+            return (graph.get_proficient_exercises(), graph.get_suggested_exercises(), graph.get_review_exercises(now))
+
+        def build_topological(unused):
+            request_cache.flush()
+            graph = ExerciseGraph(user_data, user)
+            return (graph.get_proficient_exercises(), graph.get_suggested_exercises(), graph.get_review_exercises(now))
+
+        ms_recursive = best_ms(build_recursive, lambda: copy_exercises(exercises))
+        ms_topological = best_ms(build_topological, lambda: None)
+
+        print "%5d exercises: recursive %8.2f ms, topological order %8.2f ms" % (c_exercises, ms_recursive, ms_topological)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+import datetime
+import os
+import random
+import sys
+import unittest
+
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/exercise_graph_test.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("CURRENT_VERSION_ID", "1.1")
+
+import models
+import request_cache
+from models import UserData, ExerciseGraph, ExerciseGraphTopology
+
+class FakeUser(object):
+
+    def __init__(self, email):
+        self._email = email
+
+    def email(self):
+        return self._email
+
+class FakeExercise(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.covers = []
+        self.prerequisites = []
+        self.summative = False
+
+class FakeUserExercise(object):
+
+    def __init__(self, exercise, streak, total_done):
+        self.exercise = exercise
+        self.streak = streak
+        self.longest_streak = streak
+        self.total_done = total_done
+        self.last_done = None
+        self.last_review = datetime.datetime.min
+        self.review_interval_secs = 0
+
+    def get_review_interval(self):
+        return datetime.timedelta(seconds=self.review_interval_secs)
+
+# Exercises only cover exercises after them, so the covering graph is a DAG.
+# Prerequisites can point anywhere, like they can in the real exercise data.
+def random_exercises(rnd, c_exercises):
+    exercises = [FakeExercise("ex%s" % ix) for ix in range(c_exercises)]
+    for ix, exercise in enumerate(exercises):
+        for covered_ix in range(ix + 1, c_exercises):
+            if rnd.random() < 2.0 / c_exercises:
+                exercise.covers.append(exercises[covered_ix].name)
+        for prereq_ix in range(c_exercises):
+            if prereq_ix != ix and rnd.random() < 1.5 / c_exercises:
+                exercise.prerequisites.append(exercises[prereq_ix].name)
+    return exercises
+
+def random_user_exercises(rnd, exercises):
+    user_exercises = []
+    for exercise in exercises:
+        if rnd.random() < 0.6:
+            total_done = rnd.randint(0, 20)
+            streak = total_done
+            if total_done and rnd.random() < 0.3:
+                streak = rnd.randint(0, total_done - 1)
+            user_exercises.append(FakeUserExercise(exercise.name, streak, total_done))
+    return user_exercises
+
+# Swaps in the test's exercises and UserExercises for the cached ones
+class ExerciseGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_get_topology = ExerciseGraphTopology.__dict__["get_use_cache"]
+        self.original_get_user_exercises = models.UserExercise.__dict__["get_for_user_use_cache"]
+        self.original_cached_exercises_date = models.Setting.__dict__["cached_exercises_date"]
+
+        self.topology = None
+        self.user_exercises = []
+        self.exercises_date = "2011-01-01"
+
+        ExerciseGraphTopology.get_use_cache = staticmethod(lambda: self.topology)
+        models.UserExercise.get_for_user_use_cache = staticmethod(lambda user: self.user_exercises)
+        models.Setting.cached_exercises_date = staticmethod(lambda val=None: self.exercises_date)
+
+        self.user = FakeUser("student@example.com")
+        request_cache.flush()
+
+    def tearDown(self):
+        ExerciseGraphTopology.get_use_cache = self.original_get_topology
+        models.UserExercise.get_for_user_use_cache = self.original_get_user_exercises
+        models.Setting.cached_exercises_date = self.original_cached_exercises_date
+        request_cache.flush()
+
+class ReassessIncrementallyTest(ExerciseGraphTestCase):
+
+    def full_assessment(self, user_data):
+        # What a full ExerciseGraph build gives for user_data's current explicit proficiency
+        request_cache.flush()
+        user_data_full = UserData(proficient_exercises=list(user_data.proficient_exercises), assigned_exercises=[])
+        user_data_full.reassess_from_graph(ExerciseGraph(user_data_full, self.user))
+        return (user_data_full.all_proficient_exercises, user_data_full.suggested_exercises)
+
+    def assessed_user_data(self, proficient_exercises):
+        user_data = UserData(proficient_exercises=list(proficient_exercises), assigned_exercises=[])
+        user_data.reassess_from_graph(ExerciseGraph(user_data, self.user))
+        request_cache.flush()
+        return user_data
+
+    def toggle_and_reassess(self, user_data, exid):
+        if exid in user_data.proficient_exercises:
+            user_data.proficient_exercises.remove(exid)
+        else:
+            user_data.proficient_exercises.append(exid)
+        user_data.mark_need_to_reassess(exid)
+        request_cache.flush()
+        user_data.reassess_if_necessary(self.user)
+        return request_cache.counters().get("exercise_graph_builds", 0)
+
+    def test_incremental_matches_full(self):
+        rnd = random.Random(8)
+        for trial in range(300):
+            exercises = random_exercises(rnd, rnd.randint(1, 60))
+            self.topology = ExerciseGraphTopology(exercises)
+            self.user_exercises = random_user_exercises(rnd, exercises)
+
+            names = [exercise.name for exercise in exercises]
+            user_data = self.assessed_user_data([name for name in names if rnd.random() < 0.3])
+
+            for toggle in range(5):
+                c_builds = self.toggle_and_reassess(user_data, rnd.choice(names))
+                self.assertEqual(0, c_builds)
+                self.assertEqual(self.full_assessment(user_data),
+                        (user_data.all_proficient_exercises, user_data.suggested_exercises))
+
+    def test_missed_exercise_forces_full_reassess(self):
+        rnd = random.Random(9)
+        for trial in range(100):
+            exercises = random_exercises(rnd, rnd.randint(2, 40))
+            self.topology = ExerciseGraphTopology(exercises)
+            self.user_exercises = [FakeUserExercise(exercise.name, 5, 5) for exercise in exercises]
+
+            names = [exercise.name for exercise in exercises]
+            user_data = self.assessed_user_data([name for name in names if rnd.random() < 0.4])
+
+            # Missing a problem can drop proficiency anywhere, without any explicit change
+            user_exercise = rnd.choice(self.user_exercises)
+            user_exercise.streak = 0
+            user_exercise.total_done += 1
+
+            c_builds = self.toggle_and_reassess(user_data, rnd.choice(names))
+            self.assertEqual(1, c_builds)
+            self.assertEqual(self.full_assessment(user_data),
+                    (user_data.all_proficient_exercises, user_data.suggested_exercises))
+
+    def test_changed_exercises_force_full_reassess(self):
+        rnd = random.Random(10)
+        exercises = random_exercises(rnd, 30)
+        self.topology = ExerciseGraphTopology(exercises)
+        self.user_exercises = random_user_exercises(rnd, exercises)
+        user_data = self.assessed_user_data([exercises[0].name])
+
+        # An exercise was edited, so the stored lists may be based on the old graph
+        exercises[0].covers = [exercise.name for exercise in exercises[1:]]
+        self.topology = ExerciseGraphTopology(exercises)
+        self.exercises_date = "2011-01-02"
+
+        c_builds = self.toggle_and_reassess(user_data, exercises[1].name)
+        self.assertEqual(1, c_builds)
+        self.assertEqual(self.full_assessment(user_data),
+                (user_data.all_proficient_exercises, user_data.suggested_exercises))
+
+    def test_no_stored_version_forces_full_reassess(self):
+        rnd = random.Random(11)
+        exercises = random_exercises(rnd, 30)
+        self.topology = ExerciseGraphTopology(exercises)
+        self.user_exercises = random_user_exercises(rnd, exercises)
+        user_data = self.assessed_user_data([exercises[0].name])
+        user_data.assessment_version = None
+
+        self.assertEqual(1, self.toggle_and_reassess(user_data, exercises[1].name))
+
+# ExerciseGraph as it was before ExerciseGraphTopology: every value is computed by
+# recursing over the covering exercises, memoized on the exercises themselves.
+# Only the datastore lookups and points are left out.
+class RecursiveExerciseGraph(object):
+
+    def __init__(self, exercises, user_data, user_exercises):
+        self.exercises = exercises
+        self.exercise_by_name = {}
+        for ex in exercises:
+            self.exercise_by_name[ex.name] = ex
+            ex.coverers = []
+            ex.user_exercise = None
+            ex.next_review = None  # Not set initially
+            ex.is_review_candidate = False
+            ex.is_ancestor_review_candidate = None  # Not set initially
+            ex.proficient = None # Not set initially
+            ex.suggested = None # Not set initially
+            ex.assigned = False
+            ex.streak = 0
+            ex.longest_streak = 0
+            ex.total_done = 0
+        for name in user_data.proficient_exercises:
+            ex = self.exercise_by_name.get(name)
+            if ex:
+                ex.proficient = True
+        for name in user_data.assigned_exercises:
+            ex = self.exercise_by_name.get(name)
+            if ex:
+                ex.assigned = True
+        for ex in exercises:
+            for covered in ex.covers:
+                self.exercise_by_name[covered].coverers.append(ex)
+            ex.prerequisites_ex = []
+            for prereq in ex.prerequisites:
+                ex.prerequisites_ex.append(self.exercise_by_name[prereq])
+        for user_ex in user_exercises:
+            ex = self.exercise_by_name.get(user_ex.exercise)
+            if ex:
+                ex.user_exercise = user_ex
+                ex.streak = user_ex.streak
+                ex.longest_streak = user_ex.longest_streak
+                ex.total_done = user_ex.total_done
+                ex.last_done = user_ex.last_done
+
+        def compute_proficient(ex):
+            if ex.proficient is not None:
+                return ex.proficient
+            ex.proficient = False
+            if ex.streak == ex.total_done:
+                for c in ex.coverers:
+                    if compute_proficient(c) is True:
+                        ex.proficient = True
+                        break
+            return ex.proficient
+
+        for ex in exercises:
+            compute_proficient(ex)
+
+        def compute_suggested(ex):
+            if ex.suggested is not None:
+                return ex.suggested
+            if ex.proficient is True:
+                ex.suggested = False
+                return ex.suggested
+            ex.suggested = True
+            for c in ex.coverers:
+                if compute_suggested(c) is True:
+                    ex.suggested = False
+                    return ex.suggested
+            for prereq in ex.prerequisites_ex:
+                if not prereq.proficient:
+                    ex.suggested = False
+                    break
+            return ex.suggested
+
+        for ex in exercises:
+            compute_suggested(ex)
+
+    def get_review_exercises(self, now):
+
+        def compute_next_review(ex):
+            if ex.next_review is None:
+                ex.next_review = datetime.datetime.min
+                if ex.user_exercise is not None and ex.user_exercise.last_review > datetime.datetime.min:
+                    next_review = ex.user_exercise.last_review + ex.user_exercise.get_review_interval()
+                    if next_review > now and ex.proficient and ex.user_exercise.streak == 0:
+                        next_review = now
+                    if next_review > ex.next_review:
+                        ex.next_review = next_review
+                for c in ex.coverers:
+                    c_next_review = compute_next_review(c)
+                    if c_next_review > ex.next_review:
+                        ex.next_review = c_next_review
+            return ex.next_review
+
+        def compute_is_ancestor_review_candidate(rc):
+            if rc.is_ancestor_review_candidate is None:
+                rc.is_ancestor_review_candidate = False
+                for c in rc.coverers:
+                    rc.is_ancestor_review_candidate = rc.is_ancestor_review_candidate or c.is_review_candidate or compute_is_ancestor_review_candidate(c)
+            return rc.is_ancestor_review_candidate
+
+        for ex in self.exercises:
+            compute_next_review(ex)
+        review_candidates = []
+        for ex in self.exercises:
+            if not ex.summative and ex.proficient and ex.next_review <= now:
+                ex.is_review_candidate = True
+                review_candidates.append(ex)
+            else:
+                ex.is_review_candidate = False
+        review_exercises = []
+        for rc in review_candidates:
+            if not compute_is_ancestor_review_candidate(rc):
+                review_exercises.append(rc)
+        return review_exercises
+
+    def get_proficient_exercises(self):
+        return [ex for ex in self.exercises if ex.proficient]
+
+    def get_suggested_exercises(self):
+        return [ex for ex in self.exercises if ex.suggested]
+
+def copy_exercises(exercises):
+    copies = []
+    for exercise in exercises:
+        copy = FakeExercise(exercise.name)
+        copy.covers = list(exercise.covers)
+        copy.prerequisites = list(exercise.prerequisites)
+        copy.summative = exercise.summative
+        copies.append(copy)
+    return copies
+
+def names(exercises):
+    return [exercise.name for exercise in exercises]
+
+class RecursiveEquivalenceTest(ExerciseGraphTestCase):
+
+    def test_matches_recursive_graph(self):
+        rnd = random.Random(6)
+        now = datetime.datetime(2011, 6, 1)
+        for trial in range(300):
+            exercises = random_exercises(rnd, rnd.randint(1, 80))
+            for exercise in exercises:
+                exercise.summative = rnd.random() < 0.1
+
+            self.topology = ExerciseGraphTopology(exercises)
+            self.user_exercises = random_user_exercises(rnd, exercises)
+            for user_exercise in self.user_exercises:
+                if rnd.random() < 0.7:
+                    user_exercise.last_review = now - datetime.timedelta(days=rnd.randint(0, 60))
+                    user_exercise.review_interval_secs = rnd.randint(0, 40) * 86400
+
+            user_data = UserData(
+                    proficient_exercises=[name for name in names(exercises) if rnd.random() < 0.3],
+                    assigned_exercises=[name for name in names(exercises) if rnd.random() < 0.1])
+
+            request_cache.flush()
+            ex_graph = ExerciseGraph(user_data, self.user)
+            recursive_graph = RecursiveExerciseGraph(copy_exercises(exercises), user_data, self.user_exercises)
+
+            for node, ex in zip(ex_graph.exercises, recursive_graph.exercises):
+                self.assertEqual(ex.name, node.name)
+                self.assertEqual(bool(ex.proficient), bool(node.proficient))
+                self.assertEqual(bool(ex.suggested), bool(node.suggested))
+                self.assertEqual(ex.assigned, node.assigned)
+                self.assertEqual(names(ex.coverers), names(node.coverers))
+                self.assertEqual(names(ex.prerequisites_ex), names(node.prerequisites_ex))
+
+            self.assertEqual(names(recursive_graph.get_proficient_exercises()), names(ex_graph.get_proficient_exercises()))
+            self.assertEqual(names(recursive_graph.get_suggested_exercises()), names(ex_graph.get_suggested_exercises()))
+            self.assertEqual(names(recursive_graph.get_review_exercises(now)), names(ex_graph.get_review_exercises(now)))
+
+if __name__ == '__main__':
+    unittest.main()
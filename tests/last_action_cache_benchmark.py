@@ -0,0 +1,165 @@
+import cPickle
+import datetime
+import os
+import random
+import sys
+import time
+
+# Compares the columnar LastActionCache with the pickled list of protobuf
+# strings it replaced: bytes stored in memcache per user with a full cache,
+# the load + push + store done on every action, and a TimedProblemBadge
+# walk over the most recent problems right after loading.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/last_action_cache_benchmark.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+
+from google.appengine.api import users
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+from models import ProblemLog, VideoLog
+from badges.last_action_cache import LastActionCache
+
+RUNS = 2000
+PROBLEMS_WALKED = 75 # The most any TimedProblemBadge requires
+
+# LastActionCache as it was before the columnar format, without memcache:
+# the whole object is pickled, like memcache does, and ProblemLogs and VideoLogs
+# are only turned back into models when a badge reads them.
+class PickledLastActionCache:
+
+    CACHED_ACTIONS_PER_TYPE = 500
+
+    def __init__(self, user):
+        self.problem_logs = []
+        self.problem_log_models = {}
+        self.video_logs = []
+        self.video_log_models = {}
+        self.user = user
+
+    def push_problem_log(self, problem_log):
+        self.problem_logs.append(db.model_to_protobuf(problem_log).Encode())
+        if len(self.problem_logs) > PickledLastActionCache.CACHED_ACTIONS_PER_TYPE:
+            self.problem_logs = self.problem_logs[-1 * PickledLastActionCache.CACHED_ACTIONS_PER_TYPE:]
+
+    def get_problem_log(self, ix):
+        if not self.problem_log_models.has_key(ix):
+            self.problem_log_models[ix] = db.model_from_protobuf(entity_pb.EntityProto(self.problem_logs[ix]))
+        return self.problem_log_models[ix]
+
+    def push_video_log(self, video_log):
+        self.video_logs.append(db.model_to_protobuf(video_log).Encode())
+        if len(self.video_logs) > PickledLastActionCache.CACHED_ACTIONS_PER_TYPE:
+            self.video_logs = self.video_logs[-1 * PickledLastActionCache.CACHED_ACTIONS_PER_TYPE:]
+
+    def encode(self):
+        self.problem_log_models = {}
+        self.video_log_models = {}
+        return cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(user, encoded):
+        return cPickle.loads(encoded)
+
+def walk_pickled(action_cache, exercise):
+    c_logs = len(action_cache.problem_logs)
+    time_taken = 0
+    for i in range(PROBLEMS_WALKED):
+        problem = action_cache.get_problem_log(c_logs - i - 1)
+        time_taken += problem.time_taken
+        if not problem.correct or problem.exercise != exercise:
+            break
+    return time_taken
+
+def walk_columnar(action_cache, exercise):
+    c_logs = action_cache.get_problem_log_count()
+    time_taken = 0
+    for i in range(PROBLEMS_WALKED):
+        ix = c_logs - i - 1
+        time_taken += action_cache.get_problem_time_taken(ix)
+        if not action_cache.get_problem_correct(ix) or action_cache.get_problem_exercise(ix) != exercise:
+            break
+    return time_taken
+
+def random_problem_logs(rnd, user, dt_start, c_logs):
+    exercises = ["addition_1", "subtraction_1", "multiplication_1", "dividing_fractions", "linear_equations_2"]
+    problem_logs = []
+    for ix in range(c_logs):
+        problem_logs.append(ProblemLog(
+            user = user,
+            exercise = exercises[ix / 100 % len(exercises)],
+            correct = True,
+            time_done = dt_start + datetime.timedelta(seconds=30 * ix),
+            time_taken = rnd.randint(5, 25),
+            problem_number = rnd.randint(1, 100000),
+            points_earned = rnd.randint(5, 15),
+            ))
+    return problem_logs
+
+def random_video_logs(rnd, user, dt_start, c_logs):
+    video_logs = []
+    for ix in range(c_logs):
+        video_logs.append(VideoLog(
+            user = user,
+            video = db.Key.from_path("Video", rnd.randint(1, 3000)),
+            video_title = "Video %s" % ix,
+            time_watched = dt_start + datetime.timedelta(seconds=60 * ix),
+            seconds_watched = rnd.randint(30, 600),
+            points_earned = rnd.randint(0, 50),
+            playlist_titles = ["Arithmetic", "Developmental Math"],
+            ))
+    return video_logs
+
+def full_cache(cache_class, push_problem_log, push_video_log, user, problem_logs, video_logs):
+    action_cache = cache_class(user)
+    for problem_log in problem_logs[:cache_class.CACHED_ACTIONS_PER_TYPE]:
+        push_problem_log(action_cache, problem_log)
+    for video_log in video_logs[:cache_class.CACHED_ACTIONS_PER_TYPE]:
+        push_video_log(action_cache, video_log)
+    return action_cache.encode()
+
+def main():
+    rnd = random.Random(12)
+    user = users.User("student@example.com")
+    dt_start = datetime.datetime(2011, 6, 1)
+
+    c_logs = LastActionCache.CACHED_ACTIONS_PER_TYPE + RUNS
+    problem_logs = random_problem_logs(rnd, user, dt_start, c_logs)
+    video_logs = random_video_logs(rnd, user, dt_start, LastActionCache.CACHED_ACTIONS_PER_TYPE)
+
+    # The columnar cache's own store() also writes memcache and queues a snapshot
+    columnar_push_problem_log = lambda action_cache, problem_log: action_cache.push_problem_log(problem_log, store=False)
+    columnar_push_video_log = lambda action_cache, video_log: action_cache.push_video_log(video_log, store=False)
+    pickled_push_problem_log = lambda action_cache, problem_log: action_cache.push_problem_log(problem_log)
+    pickled_push_video_log = lambda action_cache, video_log: action_cache.push_video_log(video_log)
+
+    for name, cache_class, push_problem_log, push_video_log, walk in [
+            ("pickled protobufs", PickledLastActionCache, pickled_push_problem_log, pickled_push_video_log, walk_pickled),
+            ("columnar", LastActionCache, columnar_push_problem_log, columnar_push_video_log, walk_columnar),
+            ]:
+        encoded = full_cache(cache_class, push_problem_log, push_video_log, user, problem_logs, video_logs)
+
+        # Every action request loads the cache, pushes its log and stores it again
+        dt_start_push = time.time()
+        for problem_log in problem_logs[cache_class.CACHED_ACTIONS_PER_TYPE:]:
+            action_cache = cache_class.decode(user, encoded)
+            push_problem_log(action_cache, problem_log)
+            encoded = action_cache.encode()
+        us_push = (time.time() - dt_start_push) * 1000000.0 / RUNS
+
+        exercise = problem_logs[-1].exercise
+        dt_start_walk = time.time()
+        for run in range(RUNS):
+            walk(cache_class.decode(user, encoded), exercise)
+        us_walk = (time.time() - dt_start_walk) * 1000000.0 / RUNS
+
+        print "%-18s %7.1f KB per user, load + push + store %8.1f us, load + walk %d problems %8.1f us" % (
+                name, len(encoded) / 1024.0, us_push, PROBLEMS_WALKED, us_walk)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import sys
+import unittest
+
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/problem_log_queue_test.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("CURRENT_VERSION_ID", "1.1")
+
+import activity_summary
+import exercise_statistics
+import problem_log_queue
+
+class FakeMemcache(object):
+    # Just enough of the memcache API for problem_log_queue, with expiry left to the test
+
+    def __init__(self):
+        self.values = {}
+
+    def expire(self, key):
+        self.values.pop(key, None)
+
+    def add(self, key, value, time=0):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_multi(self, keys):
+        return dict((key, self.values[key]) for key in keys if key in self.values)
+
+    def incr(self, key, delta=1):
+        if key not in self.values:
+            return None
+        self.values[key] += delta
+        return self.values[key]
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        return 2
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.values.pop(key, None)
+        return True
+
+class FakeUser(object):
+
+    def __init__(self, email):
+        self._email = email
+
+    def email(self):
+        return self._email
+
+class FakeUserExercise(object):
+
+    def __init__(self, exercise):
+        self.exercise = exercise
+
+    def key(self):
+        return "UserExercise:%s" % self.exercise
+
+class FakeProblemLog(object):
+
+    def __init__(self, user, number):
+        self.user = user
+        self.exercise = "addition_1"
+        self.problem_number = number
+        self.correct = True
+        self.time_taken = 10
+
+class ProblemLogQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.originals = [
+            (problem_log_queue, "memcache", problem_log_queue.memcache),
+            (problem_log_queue, "QUEUE", problem_log_queue.QUEUE),
+            (problem_log_queue, "update_badges", problem_log_queue.update_badges),
+            (problem_log_queue, "encode_problem_log", problem_log_queue.encode_problem_log),
+            (problem_log_queue, "decode_problem_log", problem_log_queue.decode_problem_log),
+            (activity_summary, "add_problem_log_delta", activity_summary.add_problem_log_delta),
+            (exercise_statistics, "record_problem_logs", exercise_statistics.record_problem_logs),
+        ]
+
+        self.memcache = FakeMemcache()
+        self.badged = []
+        self.deltas = []
+        self.recorded = []
+
+        problem_log_queue.memcache = self.memcache
+        problem_log_queue.QUEUE = problem_log_queue.LocalQueue()
+        problem_log_queue.update_badges = lambda problem_logs, user_exercise_keys, facts: self.badged.extend(problem_logs)
+        problem_log_queue.encode_problem_log = lambda problem_log: problem_log
+        problem_log_queue.decode_problem_log = lambda encoded: encoded
+        activity_summary.add_problem_log_delta = lambda problem_log, dt_last_activity: self.deltas.append(problem_log)
+        exercise_statistics.record_problem_logs = lambda problem_logs: self.recorded.extend(problem_logs)
+
+        self.user = FakeUser("student@example.com")
+        self.user_exercise = FakeUserExercise("addition_1")
+        self.c_answers = 0
+
+    def tearDown(self):
+        for module, name, value in self.originals:
+            setattr(module, name, value)
+
+    def answer(self, count):
+        problem_logs = []
+        for i in range(count):
+            self.c_answers += 1
+            problem_log = FakeProblemLog(self.user, self.c_answers)
+            self.assertTrue(problem_log_queue.enqueue(self.user, problem_log, self.user_exercise, [], None))
+            problem_logs.append(problem_log)
+        return problem_logs
+
+    def assertProcessed(self, problem_logs):
+        self.assertEqual(problem_logs, self.badged)
+        self.assertEqual(problem_logs, self.deltas)
+        self.assertEqual(problem_logs, self.recorded)
+
+    def test_processes_every_answer_once(self):
+        problem_logs = self.answer(3)
+        problem_log_queue.QUEUE.run()
+        problem_logs += self.answer(2)
+        problem_log_queue.QUEUE.run()
+        problem_log_queue.QUEUE.run()
+        self.assertProcessed(problem_logs)
+
+    def test_sequence_expiring_loses_nothing(self):
+        problem_logs = self.answer(5)
+        problem_log_queue.QUEUE.run()
+
+        # The sequence was created first, so it expires while the processed count,
+        # rewritten by every task, is still around
+        self.memcache.expire(problem_log_queue.SEQUENCE_KEY_FORMAT % self.user.email())
+
+        problem_logs += self.answer(2)
+        problem_log_queue.QUEUE.run()
+        problem_logs += self.answer(4)
+        problem_log_queue.QUEUE.run()
+        self.assertProcessed(problem_logs)
+
+    def test_stale_processed_count_after_restart(self):
+        problem_logs = self.answer(5)
+        problem_log_queue.QUEUE.run()
+
+        self.memcache.expire(problem_log_queue.SEQUENCE_KEY_FORMAT % self.user.email())
+        problem_logs += self.answer(2)
+
+        # A task still working on the old sequence writes its processed count
+        # after the restart cleared it
+        self.memcache.set(problem_log_queue.PROCESSED_KEY_FORMAT % self.user.email(), 5)
+
+        problem_log_queue.QUEUE.run()
+        self.assertProcessed(problem_logs)
+
+if __name__ == '__main__':
+    unittest.main()
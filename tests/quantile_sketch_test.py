@@ -0,0 +1,103 @@
+import bisect
+import os
+import random
+import sys
+import unittest
+
+# python tests/quantile_sketch_test.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from quantile_sketch import QuantileSketch
+
+QUANTILES = [i / 100.0 for i in range(1, 100)]
+
+# The header comment promises about 1%, leave some room for unlucky compactions
+MAX_RANK_ERROR = 0.015
+
+def rank_error(sorted_values, value, q):
+    # How far q is from the range of ranks value has in the stream
+    c_values = float(len(sorted_values))
+    rank_low = bisect.bisect_left(sorted_values, value) / c_values
+    rank_high = bisect.bisect_right(sorted_values, value) / c_values
+    if q < rank_low:
+        return rank_low - q
+    if q > rank_high:
+        return q - rank_high
+    return 0.0
+
+def worst_rank_error(sketch, values):
+    sorted_values = sorted(values)
+    return max([rank_error(sorted_values, sketch.quantile(q), q) for q in QUANTILES])
+
+def sketch_of(values):
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def setUp(self):
+        # Compactions pick their offsets with the random module
+        random.seed(21)
+        self.rnd = random.Random(21)
+
+    def streams(self, c_values):
+        uniform = [self.rnd.random() for i in range(c_values)]
+        # Answer times are skewed with a long tail
+        time_taken = [float(int(self.rnd.lognormvariate(3.0, 0.8))) for i in range(c_values)]
+        return {
+            "uniform": uniform,
+            "time_taken": time_taken,
+            "ascending": sorted(uniform),
+            "descending": sorted(uniform, reverse=True),
+        }
+
+    def test_rank_error_is_bounded(self):
+        for name, values in self.streams(50000).iteritems():
+            sketch = sketch_of(values)
+            self.assertEqual(len(values), sketch.count)
+            error = worst_rank_error(sketch, values)
+            self.assertTrue(error <= MAX_RANK_ERROR, "%s: worst rank error %.4f" % (name, error))
+
+    def test_small_streams_are_exact(self):
+        values = [self.rnd.random() for i in range(QuantileSketch.DEFAULT_K / 2)]
+        self.assertEqual(0.0, worst_rank_error(sketch_of(values), values))
+
+    def test_merged_rank_error_is_bounded(self):
+        for name, values in self.streams(40000).iteritems():
+            # Like the sketch shards of an exercise, each fed a slice of the answers
+            sketch = QuantileSketch()
+            for shard in range(8):
+                sketch.merge(sketch_of(values[shard::8]))
+            self.assertEqual(len(values), sketch.count)
+            error = worst_rank_error(sketch, values)
+            self.assertTrue(error <= MAX_RANK_ERROR, "%s: worst rank error %.4f" % (name, error))
+
+    def test_size_is_bounded(self):
+        sketch = sketch_of([self.rnd.random() for i in range(200000)])
+        self.assertTrue(sketch.size < 3 * QuantileSketch.DEFAULT_K + 2 * len(sketch.levels))
+
+    def test_encode_decode(self):
+        # Whole numbers of seconds survive the single precision floats unchanged
+        values = [float(self.rnd.randint(0, 600)) for i in range(5000)]
+        sketch = sketch_of(values)
+        encoded = sketch.encode()
+
+        decoded = QuantileSketch.decode(encoded)
+        self.assertEqual(sketch.count, decoded.count)
+        self.assertEqual(sketch.levels, decoded.levels)
+        self.assertEqual(encoded, decoded.encode())
+        for q in QUANTILES:
+            self.assertEqual(sketch.quantile(q), decoded.quantile(q))
+
+    def test_decode_rejects_other_versions(self):
+        encoded = sketch_of([1.0, 2.0]).encode()
+        self.assertRaises(ValueError, QuantileSketch.decode, chr(QuantileSketch.VERSION + 1) + encoded[1:])
+
+    def test_empty(self):
+        self.assertEqual(None, QuantileSketch().quantile(0.5))
+
+if __name__ == '__main__':
+    unittest.main()
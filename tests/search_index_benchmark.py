@@ -0,0 +1,113 @@
+import os
+import random
+import sys
+import time
+
+# Compares answering /search from search_index's in-memory ranked indexes with
+# the datastore path it replaced: Playlist.search and Video.search, which query
+# the StemmedIndex entities and then get every result by key.
+#
+# The datastore path runs against the SDK's datastore stub, so its times only
+# show the work done in the app, not the RPC latency production adds to every
+# query and get. The datastore calls each search makes are counted too.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/search_index_benchmark.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+os.environ.setdefault("CURRENT_VERSION_ID", "1.1")
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+
+import search_index
+from models import Video, Playlist
+
+C_VIDEOS = 2000
+C_PLAYLISTS = 100
+C_QUERIES = 200
+
+WORDS = ("adding subtracting multiplying dividing fractions decimals negative numbers equations "
+        "linear quadratic functions graphing slope intercept exponents radicals logarithms "
+        "probability statistics geometry triangles circles angles polygons vectors matrices "
+        "derivatives integrals limits sequences series trigonometry identities factoring "
+        "polynomials inequalities systems variables expressions proportions percentages ratios").split()
+
+class RpcCounter(object):
+
+    def __init__(self):
+        self.c_rpcs = 0
+
+    def __call__(self, service, call, request, response):
+        self.c_rpcs += 1
+
+def setup_stubs(rpc_counter):
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub("datastore_v3", datastore_file_stub.DatastoreFileStub(os.environ["APPLICATION_ID"], "/dev/null", "/dev/null"))
+    apiproxy_stub_map.apiproxy.RegisterStub("memcache", memcache_stub.MemcacheService())
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("count_rpcs", rpc_counter, "datastore_v3")
+
+def random_text(rnd, c_words):
+    return " ".join([rnd.choice(WORDS) for ix in range(c_words)])
+
+def put_corpus(rnd):
+    videos = []
+    for ix in range(C_VIDEOS):
+        video = Video(title=random_text(rnd, 3).title(), keywords=random_text(rnd, 4), description=random_text(rnd, 20),
+                youtube_id="video%s" % ix)
+        video.put()
+        video.index()
+        videos.append(video)
+
+    playlists = []
+    for ix in range(C_PLAYLISTS):
+        playlist = Playlist(title=random_text(rnd, 2).title(), description=random_text(rnd, 15), youtube_id="playlist%s" % ix)
+        playlist.put()
+        playlist.index()
+        playlists.append(playlist)
+
+    return (videos, playlists)
+
+def search_datastore(query):
+    searched_phrases = []
+    return (Playlist.search(query, limit=50, searched_phrases_out=searched_phrases), Video.search(query, limit=50))
+
+def main():
+    rnd = random.Random(24)
+    rpc_counter = RpcCounter()
+    setup_stubs(rpc_counter)
+
+    videos, playlists = put_corpus(rnd)
+    queries = [random_text(rnd, rnd.randint(1, 2)) for ix in range(C_QUERIES)]
+
+    dt_start = time.time()
+    videos_index = search_index.SearchIndex(videos, [("title", 3.0), ("keywords", 1.5), ("description", 1.0)])
+    playlists_index = search_index.SearchIndex(playlists, [("title", 3.0), ("description", 1.0)])
+    ms_build = (time.time() - dt_start) * 1000.0
+
+    def search_in_memory(query):
+        searched_phrases = []
+        return (playlists_index.search(query, limit=50, searched_phrases_out=searched_phrases), videos_index.search(query, limit=50))
+
+    print "%s videos, %s playlists, %s queries of 1 or 2 words" % (C_VIDEOS, C_PLAYLISTS, C_QUERIES)
+    print "in-memory indexes built in %.0f ms, once per library content version" % ms_build
+
+    for name, search in [("datastore", search_datastore), ("in-memory", search_in_memory)]:
+        c_rpcs = rpc_counter.c_rpcs
+        c_results = 0
+        dt_start = time.time()
+        for query in queries:
+            playlists_found, videos_found = search(query)
+            c_results += len(playlists_found) + len(videos_found)
+        ms_per_query = (time.time() - dt_start) * 1000.0 / C_QUERIES
+        rpcs_per_query = (rpc_counter.c_rpcs - c_rpcs) / float(C_QUERIES)
+
+        print "%-10s %8.2f ms per query, %6.1f datastore calls per query, %6.1f results per query" % (
+                name, ms_per_query, rpcs_per_query, c_results / float(C_QUERIES))
+
+if __name__ == '__main__':
+    main()
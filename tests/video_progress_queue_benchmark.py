@@ -0,0 +1,123 @@
+import datetime
+import os
+import sys
+
+# Load test for video_progress_queue: a simulated player watches videos of
+# different lengths, sending a heartbeat every 10% of the video like the real
+# player does. Each viewing is run once with heartbeats saved one by one
+# (ENABLED = False) and once coalesced, counting the datastore puts and the
+# entities they write per watched minute. It also checks that every heartbeat
+# answered with the same points and that both end with the same UserVideo.
+#
+# Run from the repository root with the App Engine SDK on PYTHONPATH:
+#
+# python tests/video_progress_queue_benchmark.py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("APPLICATION_ID", "khanexercises")
+os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+os.environ.setdefault("CURRENT_VERSION_ID", "1.1")
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import users
+from google.appengine.api.labs.taskqueue import taskqueue_stub
+from google.appengine.api.memcache import memcache_stub
+
+import request_cache
+import video_progress_queue
+from models import Video, Playlist, VideoPlaylist, UserData, UserVideo
+
+VIDEO_MINUTES = [2, 5, 10, 20]
+HEARTBEATS_PER_VIDEO = 10
+
+class SimulatedDatetime(object):
+    # Stands in for the datetime module in video_progress_queue, so the
+    # player's time can be moved forward without waiting for it
+
+    timedelta = datetime.timedelta
+
+    def __init__(self, dt):
+        self.dt = dt
+        self.datetime = self
+
+    def now(self):
+        return self.dt
+
+    def advance(self, seconds):
+        self.dt += datetime.timedelta(seconds=seconds)
+
+class PutCounter(object):
+
+    def __init__(self):
+        self.c_rpcs = 0
+        self.c_entities = 0
+
+    def __call__(self, service, call, request, response):
+        if call == "Put":
+            self.c_rpcs += 1
+            self.c_entities += request.entity_size()
+
+def setup_stubs(put_counter):
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub("datastore_v3", datastore_file_stub.DatastoreFileStub(os.environ["APPLICATION_ID"], "/dev/null", "/dev/null"))
+    apiproxy_stub_map.apiproxy.RegisterStub("memcache", memcache_stub.MemcacheService())
+    apiproxy_stub_map.apiproxy.RegisterStub("taskqueue", taskqueue_stub.TaskQueueServiceStub())
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("count_puts", put_counter, "datastore_v3")
+
+def watch(clock, user, video):
+    # Returns the (points, video_points) the player was sent for each heartbeat
+    responses = []
+    seconds_per_heartbeat = video.duration / HEARTBEATS_PER_VIDEO
+    for ix in range(1, HEARTBEATS_PER_VIDEO + 1):
+        clock.advance(seconds_per_heartbeat)
+        # Every heartbeat is its own request
+        request_cache.flush()
+        responses.append(video_progress_queue.log_progress(user, video, seconds_per_heartbeat, ix * seconds_per_heartbeat))
+
+    # The player stops and the accumulator's task runs FLUSH_SECONDS later
+    clock.advance(video_progress_queue.FLUSH_SECONDS)
+    request_cache.flush()
+    video_progress_queue.QUEUE.run(force=False)
+    request_cache.flush()
+    return responses
+
+def main():
+    put_counter = PutCounter()
+    setup_stubs(put_counter)
+
+    clock = SimulatedDatetime(datetime.datetime(2011, 6, 1, 12))
+    video_progress_queue.datetime = clock
+    video_progress_queue.QUEUE = video_progress_queue.LocalQueue()
+
+    playlist = Playlist(title="Arithmetic")
+    playlist.put()
+
+    print "%7s %-10s %10s %10s %14s %17s %8s" % ("minutes", "mode", "puts", "entities", "puts / minute", "entities / minute", "matched")
+    for minutes in VIDEO_MINUTES:
+        video = Video(title="%s minute video" % minutes, youtube_id="video%s" % minutes, duration=minutes * 60)
+        video.put()
+        VideoPlaylist(video=video, playlist=playlist, video_position=minutes, live_association=True).put()
+
+        results = {}
+        for mode, enabled in [("one by one", False), ("coalesced", True)]:
+            video_progress_queue.ENABLED = enabled
+            user = users.User("viewer-%s-%s@example.com" % (minutes, mode.replace(" ", "-")))
+            UserData.get_or_insert_for(user)
+
+            c_rpcs, c_entities = put_counter.c_rpcs, put_counter.c_entities
+            responses = watch(clock, user, video)
+            c_rpcs, c_entities = put_counter.c_rpcs - c_rpcs, put_counter.c_entities - c_entities
+
+            user_video = UserVideo.get_for_video_and_user(video, user)
+            results[mode] = (responses, user_video.seconds_watched, user_video.last_second_watched, user_video.completed, UserData.get_for(user).points)
+
+            matched = ""
+            if mode == "coalesced":
+                matched = str(results["coalesced"] == results["one by one"])
+
+            print "%7s %-10s %10s %10s %14.2f %17.2f %8s" % (minutes, mode, c_rpcs, c_entities,
+                    c_rpcs / float(minutes), c_entities / float(minutes), matched)
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,17 @@ def get_nickname_for(user):
     else:
         return user.nickname()
 
+# Same as map(get_nickname_for, users), but looks up all the Facebook nicknames in one batch
+def get_nicknames_for(users):
+    facebook_nicknames = facebook_util.get_facebook_nicknames(filter(lambda user: facebook_util.is_facebook_email(user.email()), users))
+    nicknames = []
+    for user in users:
+        if facebook_util.is_facebook_email(user.email()):
+            nicknames.append(facebook_nicknames[user.email()])
+        else:
+            nicknames.append(user.nickname())
+    return nicknames
+
 def create_login_url(dest_url):
     return "/login?continue=%s" % urllib.quote(dest_url)
 
@@ -0,0 +1,335 @@
+import datetime
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+
+import request_handler
+import activity_summary
+import consts
+import points
+from models import UserData, UserVideo, UserPlaylist, VideoPlaylist, VideoLog
+from badges import util_badges
+from badges import last_action_cache
+from badges.badges import BadgeFact
+
+# video_progress_queue coalesces the progress heartbeats the video player
+# sends to /logvideoprogress, every 10% of a video, into fewer saves.
+#
+# Each heartbeat adds its seconds watched to an accumulator in memcache for
+# the user and the video they're watching, and answers with the points the
+# user will have once it's saved. The accumulated progress is saved as a
+# single VideoLog, along with the UserVideo, UserPlaylists, UserData and
+# badges, when:
+#
+#   - the video is completed, so completion is never delayed,
+#   - FLUSH_SECONDS_WATCHED have been accumulated,
+#   - a heartbeat comes in FLUSH_SECONDS after the first one accumulated,
+#   - the user starts watching a different video, or
+#   - a task added when the accumulator was started runs FLUSH_SECONDS later,
+#     which saves what's left after the user stops watching.
+#
+# Heartbeats and tasks only read, change or save a user's accumulator while
+# holding a lock in memcache, so seconds are never saved twice. A heartbeat
+# that finds the lock taken, or can't store the accumulator or add the task,
+# is saved right away by itself instead. Progress accumulated in memcache and
+# evicted before it's saved is lost, which costs at most FLUSH_SECONDS_WATCHED.
+#
+# Tests can swap in LocalQueue to save accumulated progress when asked to:
+#
+# video_progress_queue.QUEUE = video_progress_queue.LocalQueue()
+# ...watch some videos...
+# video_progress_queue.QUEUE.run()
+
+ENABLED = True
+
+URL = "/admin/videoprogressqueue"
+FLUSH_SECONDS = 5 * 60
+FLUSH_SECONDS_WATCHED = 3 * 60
+BUFFER_SECONDS = 60 * 60
+
+ACCUMULATOR_KEY_FORMAT = "video_progress_queue_%s"
+LOCK_KEY_FORMAT = "video_progress_queue_lock_%s"
+LOCK_SECONDS = 30
+
+# More than any video is actually in
+PLAYLIST_LIMIT = 100
+
+class TaskQueue:
+    # Adds tasks to the App Engine task queue
+
+    def add(self, email, countdown, name=None):
+        try:
+            taskqueue.add(url=URL, params={"email": email}, countdown=countdown, name=name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # A task for this accumulator has already been added
+            pass
+        return True
+
+class LocalQueue:
+    # In-process stand-in for TaskQueue that only runs tasks when asked to
+
+    def __init__(self):
+        self.emails = []
+
+    def add(self, email, countdown, name=None):
+        if email not in self.emails:
+            self.emails.append(email)
+        return True
+
+    def run(self, force=True):
+        emails = self.emails
+        self.emails = []
+        for email in emails:
+            process_progress(email, force=force)
+
+QUEUE = TaskQueue()
+
+# Returns (points, video_points) for the heartbeat, or None if it isn't credited
+def log_progress(user, video, seconds_watched, last_second_watched):
+    email = user.email()
+
+    if not ENABLED or not lock(email):
+        # Another heartbeat or task is busy with this user's accumulator,
+        # so save this heartbeat by itself rather than waiting for it
+        if overlaps_last_video(user, video, seconds_watched):
+            return None
+        return save_progress(user, video, seconds_watched, last_second_watched, datetime.datetime.now())
+
+    try:
+        return accumulate_progress(user, video, seconds_watched, last_second_watched)
+    finally:
+        unlock(email)
+
+def lock(email):
+    return memcache.add(LOCK_KEY_FORMAT % email, True, time=LOCK_SECONDS)
+
+def unlock(email):
+    memcache.delete(LOCK_KEY_FORMAT % email)
+
+# Only called while holding the user's lock, so nothing can save or
+# change the accumulator between reading it here and writing it back
+def accumulate_progress(user, video, seconds_watched, last_second_watched):
+    email = user.email()
+    key = ACCUMULATOR_KEY_FORMAT % email
+    dt_now = datetime.datetime.now()
+
+    accumulator = memcache.get(key)
+
+    if accumulator is not None and accumulator["video_key"] != str(video.key()):
+        # Switched videos, so save the last one's progress before
+        # checking whether this one overlaps it
+        memcache.delete(key)
+        save_accumulated(user, db.get(accumulator["video_key"]), accumulator)
+        accumulator = None
+
+    new_accumulator = accumulator is None
+    if new_accumulator:
+        # Later heartbeats for the same accumulator are already known not to overlap
+        if overlaps_last_video(user, video, seconds_watched):
+            return None
+        accumulator = {
+            "video_key": str(video.key()),
+            "seconds_watched": 0,
+            "last_second_watched": 0,
+            "dt_first": dt_now,
+        }
+
+    accumulator["seconds_watched"] += seconds_watched
+    accumulator["last_second_watched"] = max(accumulator["last_second_watched"], last_second_watched)
+    accumulator["dt_last"] = dt_now
+
+    user_data = UserData.get_or_insert_for(user)
+    user_video = UserVideo.get_for_video_and_user(video, user, insert_if_missing=True)
+
+    # What the UserVideo's points will be once the accumulated progress is saved
+    video_points_previous = points.VideoPointCalculator(user_video)
+    pending_user_video = UserVideo(
+            duration = video.duration,
+            seconds_watched = user_video.seconds_watched + accumulator["seconds_watched"])
+    video_points_total = points.VideoPointCalculator(pending_user_video)
+
+    completed = not user_video.completed and video_points_total >= consts.VIDEO_POINTS_BASE
+
+    if (completed or
+            accumulator["seconds_watched"] >= FLUSH_SECONDS_WATCHED or
+            dt_now - accumulator["dt_first"] >= datetime.timedelta(seconds=FLUSH_SECONDS) or
+            not memcache.set(key, accumulator, time=BUFFER_SECONDS) or
+            (new_accumulator and not add_task(email, accumulator))):
+        memcache.delete(key)
+        return save_accumulated(user, video, accumulator, user_data=user_data, user_video=user_video)
+
+    return (user_data.points + video_points_total - video_points_previous, video_points_total)
+
+def add_task(email, accumulator):
+    try:
+        # Name tasks after the user and the accumulator so each accumulator gets a single task
+        started = int(time.mktime(accumulator["dt_first"].timetuple()))
+        name = "videoprogress-%s-%s" % (hashlib.md5(email).hexdigest(), started)
+        return QUEUE.add(email, FLUSH_SECONDS, name=name)
+    except taskqueue.Error, e:
+        logging.error("Failed to add video progress task for %s: %s" % (email, e))
+        return False
+
+def process_progress(email, force=False):
+    # Saves the progress accumulated for the user if it's at least FLUSH_SECONDS old,
+    # or regardless of its age if force is set.
+    # Returns False if a heartbeat or another task is busy with the user's accumulator.
+    if not lock(email):
+        return False
+
+    try:
+        key = ACCUMULATOR_KEY_FORMAT % email
+
+        accumulator = memcache.get(key)
+        if accumulator is None:
+            return True
+
+        if not force and datetime.datetime.now() - accumulator["dt_first"] < datetime.timedelta(seconds=FLUSH_SECONDS):
+            # A newer accumulator than the one this task was added for has its own task
+            return True
+
+        memcache.delete(key)
+
+        video = db.get(accumulator["video_key"])
+        user_data = UserData.get_for(users.User(email))
+        if video is not None and user_data is not None:
+            save_accumulated(user_data.user, video, accumulator, user_data=user_data)
+    finally:
+        unlock(email)
+
+    return True
+
+def save_accumulated(user, video, accumulator, user_data=None, user_video=None):
+    if video is None:
+        return None
+    return save_progress(user, video,
+            accumulator["seconds_watched"],
+            accumulator["last_second_watched"],
+            accumulator["dt_last"],
+            user_data=user_data,
+            user_video=user_video)
+
+def overlaps_last_video(user, video, seconds_watched):
+    action_cache = last_action_cache.LastActionCache.get_for_user(user)
+    last_video_key = action_cache.get_last_video_key()
+
+    # If the last video logged is not this video and the times being credited
+    # overlap, don't give points for this video. Can only get points for one video
+    # at a time.
+    if last_video_key and last_video_key != str(video.key()):
+        dt_now = datetime.datetime.now()
+        if action_cache.get_last_video_time_watched() > (dt_now - datetime.timedelta(seconds=seconds_watched)):
+            return True
+
+    return False
+
+# Saves seconds_watched of progress on video ending at dt_watched
+# and returns (points, video_points)
+def save_progress(user, video, seconds_watched, last_second_watched, dt_watched, user_data=None, user_video=None):
+
+    if user_data is None:
+        user_data = UserData.get_or_insert_for(user)
+    if user_video is None:
+        user_video = UserVideo.get_for_video_and_user(video, user, insert_if_missing=True)
+
+    video_points_previous = points.VideoPointCalculator(user_video)
+
+    # Points and badges are awarded to user_data below, but it's only used to
+    # tell what changed, see the transaction at the end
+    awards_snapshot = user_data.get_awards_snapshot()
+
+    action_cache = last_action_cache.LastActionCache.get_for_user(user)
+
+    video_log = VideoLog()
+    video_log.user = user
+    video_log.video = video
+    video_log.video_title = video.title
+    video_log.seconds_watched = seconds_watched
+    video_log.time_watched = dt_watched
+
+    user_playlists = []
+
+    if last_second_watched > user_video.last_second_watched:
+        user_video.last_second_watched = last_second_watched
+
+    if seconds_watched > 0:
+        user_video.seconds_watched += seconds_watched
+
+        # Update seconds_watched of all associated UserPlaylists
+        playlists = VideoPlaylist.get_cached_playlists_for_video(video, limit=PLAYLIST_LIMIT)
+        user_playlists = UserPlaylist.get_for_playlists_and_user(playlists, user, insert_if_missing=True)
+
+        # Points from earlier heartbeats are added after badges are checked below,
+        # so points badges are checked on every heartbeat
+        badge_facts_changed = [BadgeFact.PLAYLIST_TIME, BadgeFact.VIDEO_LOGS, BadgeFact.POINTS, BadgeFact.TENURE]
+
+        first_video_playlist = True
+        for playlist, user_playlist in zip(playlists, user_playlists):
+            user_playlist.title = playlist.title
+            user_playlist.seconds_watched += seconds_watched
+            user_playlist.last_watched = dt_watched
+
+            video_log.playlist_titles.append(user_playlist.title)
+
+            if first_video_playlist:
+                action_cache.push_video_log(video_log)
+
+            util_badges.update_with_user_playlist(
+                    user,
+                    user_data,
+                    user_playlist,
+                    include_other_badges = first_video_playlist,
+                    action_cache = action_cache,
+                    facts_changed = badge_facts_changed)
+
+            first_video_playlist = False
+
+    user_video.last_watched = dt_watched
+    user_video.duration = video.duration
+
+    dt_last_activity = user_data.last_activity
+
+    video_points_total = points.VideoPointCalculator(user_video)
+    video_points_received = video_points_total - video_points_previous
+
+    completed = not user_video.completed and video_points_total >= consts.VIDEO_POINTS_BASE
+    if completed:
+        # Just finished this video for the first time
+        user_video.completed = True
+
+    if video_points_received > 0:
+        video_log.points_earned = video_points_received
+        user_data.add_points(video_points_received)
+
+    activity_summary.add_video_log_delta(video_log, dt_last_activity)
+
+    db.put([user_video, video_log] + user_playlists)
+
+    # Accumulated progress is often saved by a task while the user keeps answering
+    # problems or watching, so only this progress is added to the latest UserData
+    def add_progress(user_data_latest):
+        user_data.add_awards_to(user_data_latest, awards_snapshot)
+        user_data_latest.total_seconds_watched += seconds_watched
+        if user_data_latest.last_activity is None or user_data_latest.last_activity < dt_watched:
+            user_data_latest.last_activity = dt_watched
+        if completed:
+            user_data_latest.videos_completed = -1
+
+    user_data = user_data.put_in_transaction(add_progress)
+
+    return (user_data.points, video_points_total)
+
+class ProcessVideoProgressQueue(request_handler.RequestHandler):
+
+    # Admin-only restriction is handled by /admin/* URL pattern
+    # so this can be called by the task queue.
+    def post(self):
+        email = self.request_string("email")
+        if email and not process_progress(email):
+            # A heartbeat or another task is busy with this user, try again once it's done
+            QUEUE.add(email, LOCK_SECONDS)